@@ -0,0 +1,314 @@
+#Async variant of the text-to-SQL pipeline with bounded LLM and database concurrency
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+
+import config
+from metrics import record, record_cache, record_rows, span
+from multi_period import concat_periods, for_period, period_template, select_periods, split_for_periods
+from period import table_for_period
+from query import answer_path, to_dataframe
+from question_cache import normalize_question
+
+
+class CapacityError(Exception):
+    """Raised when a request waited longer than the queue timeout for a slot."""
+
+    def __init__(self, gate, waited):
+        super().__init__(f"{gate} capacity exhausted after waiting {waited:.1f}s")
+        self.gate = gate
+
+
+class ConcurrencyGate:
+    """Semaphore with a bounded queue: callers wait up to queue_timeout, then fail fast."""
+
+    def __init__(self, name, limit, queue_timeout, max_waiting=None):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.max_waiting = max_waiting
+        self._semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.max_waiting is not None and self.waiting >= self.max_waiting and self._semaphore.locked():
+            self.rejected += 1
+            raise CapacityError(self.name, 0.0)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise CapacityError(self.name, self.queue_timeout)
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {"limit": self.limit, "in_flight": self.in_flight, "waiting": self.waiting, "rejected": self.rejected}
+
+
+class SingleFlight:
+    """Shares one in-flight computation among concurrent callers with the same key.
+
+    The first caller starts the computation as its own task; callers that
+    arrive while it runs await that task and get its result or exception.
+    The task is shielded, so a caller that goes away does not cancel it for
+    the others. A follower that waits longer than wait_timeout gives up on
+    the shared task and computes on its own.
+    """
+
+    def __init__(self, name, wait_timeout, enabled=True):
+        self.name = name
+        self.wait_timeout = wait_timeout
+        self.enabled = enabled
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    async def run(self, key, compute):
+        #(result, coalesced) of compute(), an async callable, shared with concurrent run() calls for key
+        if not self.enabled:
+            return await compute(), False
+        task = self._flights.get(key)
+        if task is None:
+            self.leaders += 1
+            record_cache(self.name, "leader")
+            task = asyncio.create_task(compute())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            return await asyncio.shield(task), False
+
+        self.coalesced += 1
+        record_cache(self.name, "coalesced")
+        try:
+            with span("coalesced_wait"):
+                return await asyncio.wait_for(asyncio.shield(task), self.wait_timeout), True
+        except asyncio.TimeoutError:
+            if task.done():
+                # The shared computation itself timed out
+                raise
+        self.timeouts += 1
+        record_cache(self.name, "timeout")
+        return await compute(), False
+
+    def _finish(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # Retrieve the outcome so an error nobody is waiting for any more is not logged as unhandled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {"enabled": self.enabled, "in_flight": len(self._flights), "leaders": self.leaders,
+                "coalesced": self.coalesced, "timeouts": self.timeouts}
+
+
+class AsyncText2SqlPipeline:
+    """Awaitable front end over a started Text2SqlPipeline.
+
+    Shares the synchronous pipeline's state, caches and connection pool.
+    The LLM call is awaited natively; blocking database work runs in the
+    default thread pool behind its own gate, so neither can starve the
+    event loop or oversubscribe the pool.
+    """
+
+    def __init__(self, pipeline, llm_concurrency=None, db_concurrency=None, queue_timeout=None, max_waiting=None,
+                 coalesce=None):
+        self.pipeline = pipeline
+        queue_timeout = config.QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+        max_waiting = config.QUEUE_MAX_WAITING if max_waiting is None else max_waiting
+        self.llm_gate = ConcurrencyGate(
+            "llm", config.LLM_CONCURRENCY if llm_concurrency is None else llm_concurrency, queue_timeout, max_waiting)
+        self.db_gate = ConcurrencyGate(
+            "db", config.DB_CONCURRENCY if db_concurrency is None else db_concurrency, queue_timeout, max_waiting)
+        self.flights = SingleFlight(
+            "coalesce", config.COALESCE_WAIT_TIMEOUT, config.COALESCE_ENABLED if coalesce is None else coalesce)
+
+    def stats(self):
+        return {"llm": self.llm_gate.stats(), "db": self.db_gate.stats(), "coalescing": self.flights.stats()}
+
+    async def _flight_key(self, kind, question):
+        #Same normalized question against the same period table
+        this_table = await asyncio.to_thread(self.pipeline.periods.current_table)
+        return kind, normalize_question(question), this_table
+
+    async def _embed(self, question):
+        async with self.llm_gate.slot():
+            with span("embed"):
+                return await asyncio.to_thread(self.pipeline.question_cache.embed, question)
+
+    async def generate_sql(self, question, state, embedding=None):
+        pipeline = self.pipeline
+        # Template matching is a few regexes and stays on the loop; the cache lookup scores every cached question
+        lookup = pipeline.match_template(question, state)
+        cache = pipeline.question_cache
+        if lookup is None and cache is not None:
+            # prepare() skips the embedding for an exact repeat in the held state, which may since have expired
+            # or belong to another period
+            if embedding is None and cache.embed_fn is not None and not cache.has_exact(question, state.this_table):
+                embedding = await self._embed(question)
+            lookup = await asyncio.to_thread(pipeline.lookup_question, question, state, embedding)
+        record("path", answer_path(lookup))
+        if lookup is not None and lookup.hit:
+            return lookup.sql, lookup
+
+        # Column retrieval embeds the question unless the cache lookup already did
+        prompt = await asyncio.to_thread(
+            pipeline.build_prompt, question, state, lookup.embedding if lookup is not None else embedding)
+        async with self.llm_gate.slot():
+            with span("llm"):
+                response_list, metadata_dict = await state.nl_sql_retriever.aretrieve_with_metadata(prompt.text)
+        query = metadata_dict["sql_query"]
+        pipeline.record_completion(query)
+        return query, lookup
+
+    async def run_sql(self, query, state):
+        async with self.db_gate.slot():
+            return await asyncio.to_thread(self.pipeline.run_sql, query, state)
+
+    async def prepare(self, question):
+        #Current state plus, when the semantic cache will need it, the question embedding
+        pipeline = self.pipeline
+        cache = pipeline.question_cache
+
+        # Resolve the period (cached, or a DB read plus possibly a rebuild) while embedding the question
+        state_task = asyncio.create_task(asyncio.to_thread(pipeline.current_state))
+        embed_task = None
+        held_state = pipeline.state
+        # Template questions and exact repeats never need the embedding
+        if cache is not None and cache.embed_fn is not None and not (held_state is not None and (
+                cache.has_exact(question, held_state.this_table) or pipeline.match_template(question, held_state, count=False))):
+            embed_task = asyncio.create_task(self._embed(question))
+        try:
+            state = await state_task
+            embedding = await embed_task if embed_task is not None else None
+        except BaseException:
+            if embed_task is not None:
+                embed_task.cancel()
+            raise
+        return state, embedding
+
+    async def aanswer_question(self, question: str):
+        #(query_string, col_keys, rows, query) with the rows as the cursor returned them, for encoding as they are
+        async def compute():
+            state, embedding = await self.prepare(question)
+            query, lookup = await self.generate_sql(question, state, embedding=embedding)
+            col_keys, result = await self.run_sql(query, state)
+            return (self.pipeline.finish(question, query, lookup, state, result), col_keys, result, query), lookup
+
+        # Identical questions in flight at the same time (a dashboard loading for several users) are answered once
+        if not self.flights.enabled:
+            return (await compute())[0]
+        ((query_string, col_keys, rows, query), lookup), coalesced = await self.flights.run(
+            await self._flight_key("answer", question), compute)
+        if coalesced:
+            record("path", answer_path(lookup))
+            record("coalesced", True)
+            query_string = "Question: \n" + question + "\n" + "\n" + "Query: \n" + query + "\n"
+        return query_string, col_keys, rows, query
+
+    async def aprocess_question(self, question: str):
+        query_string, col_keys, rows, query = await self.aanswer_question(question)
+        with span("dataframe"):
+            output_df = to_dataframe(col_keys, rows)
+        return query_string, output_df, question, query
+
+    async def aprocess_periods(self, question: str, periods=None, last_periods=None):
+        """Answer question over a range of weekly tables.
+
+        The range comes from periods (codes), last_periods (the N most recent)
+        or the question itself. SQL is generated once against the current
+        table and run on every period concurrently; aggregates are split so
+        each period returns counts, which are merged on the database.
+        Returns (query template, period codes, by_period, combined, lookup);
+        by_period and combined are (col_keys, rows), combined None when the
+        query's results cannot be merged across periods.
+        """
+        pipeline = self.pipeline
+        available = await asyncio.to_thread(pipeline.periods.available_periods)
+        codes, period_question = select_periods(question, available, periods=periods, last=last_periods)
+        state, embedding = await self.prepare(period_question)
+        query, lookup = await self.generate_sql(period_question, state, embedding=embedding)
+        template = period_template(query, state.this_table)
+        split = split_for_periods(template)
+        record("periods", len(codes))
+
+        # Past weeks never change: each period's result is cached on its own and reused by later ranges
+        period_gate = asyncio.Semaphore(config.PERIOD_PARALLELISM)
+
+        async def run_period(code, sql):
+            async with period_gate:
+                return await self.run_sql(sql, pipeline.period_state(state, table_for_period(code)))
+
+        with span("periods"):
+            if split is not None:
+                partials = await asyncio.gather(*(run_period(code, for_period(split.partial, code)) for code in codes))
+                async with self.db_gate.slot():
+                    merged = await asyncio.to_thread(pipeline.merge_periods, split, codes, partials)
+                if merged is not None:
+                    pipeline.remember(period_question, query, lookup, state)
+                    return template, codes, merged[0], merged[1], lookup
+            results = await asyncio.gather(*(run_period(code, for_period(template, code)) for code in codes))
+        pipeline.remember(period_question, query, lookup, state)
+        return template, codes, concat_periods(codes, results), None, lookup
+
+    async def astream_question(self, question: str, batch_size=None, row_cap=None):
+        """Generate SQL and open a capped, batched stream over its result.
+
+        Returns (meta, stream, batches). The DB slot is taken and the query
+        started before returning, so capacity and SQL errors surface before
+        any response bytes are sent; iterating batches to the end (or
+        closing it) releases both.
+        """
+        async def compute():
+            state, embedding = await self.prepare(question)
+            query, lookup = await self.generate_sql(question, state, embedding=embedding)
+            return query, lookup, state
+
+        # Each stream runs its own cursor, but concurrent identical questions share the SQL generation
+        if self.flights.enabled:
+            (query, lookup, state), coalesced = await self.flights.run(
+                await self._flight_key("sql", question), compute)
+            if coalesced:
+                record("path", answer_path(lookup))
+                record("coalesced", True)
+        else:
+            query, lookup, state = await compute()
+        stack = AsyncExitStack()
+        await stack.enter_async_context(self.db_gate.slot())
+        stream = None
+        try:
+            # The guard's EXPLAIN is a database round trip too, so it runs in the DB slot
+            stream = await asyncio.to_thread(self.pipeline.open_stream, query, state, batch_size, row_cap)
+            await asyncio.to_thread(stream.open)
+        except BaseException:
+            if stream is not None:
+                await asyncio.to_thread(stream.close)
+            await stack.aclose()
+            raise
+
+        async def batches():
+            try:
+                while True:
+                    batch = await asyncio.to_thread(stream.next_batch)
+                    if not batch:
+                        break
+                    yield batch
+                record_rows(stream.row_count)
+                self.pipeline.remember(question, query, lookup, state)
+            finally:
+                await asyncio.to_thread(stream.close)
+                await stack.aclose()
+
+        query_string = "Question: \n" + question + "\n" + "\n" + "Query: \n" + query + "\n"
+        meta = {"question": question, "query": query, "query_string": query_string, "path": answer_path(lookup)}
+        return meta, stream, batches()
@@ -0,0 +1,191 @@
+#Batch question answering: deduplicate, generate SQL with bounded parallelism, write results as they finish
+#
+#   python batch.py questions.jsonl --out results.jsonl
+#   python batch.py requests.jsonl --field title --out results.parquet
+import argparse
+import asyncio
+import json
+import os
+import traceback
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import config
+from query import answer_path
+from question_cache import normalize_question
+from streaming import json_default
+
+
+@dataclass
+class BatchItem:
+    id: str
+    question: str
+
+
+def read_questions(path, field="question"):
+    #One JSON object per line; ids come from "id" / "request_id" or the line number
+    items = []
+    with open(path, 'r') as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            question = record.get(field)
+            if not question:
+                raise ValueError(f"{path}:{line_number} has no {field!r} field")
+            item_id = record.get("id", record.get("request_id", line_number))
+            items.append(BatchItem(id=str(item_id), question=question))
+    return items
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self._file = open(path, 'w')
+
+    def write(self, record):
+        self._file.write(json.dumps(record, default=json_default) + "\n")
+        # Flush per record so a long batch can be followed (and survives a crash)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """One Parquet row per item; result rows are kept as a JSON string since each query has its own columns."""
+
+    def __init__(self, path, row_group_size=50):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema([
+            ("id", pa.string()),
+            ("question", pa.string()),
+            ("query", pa.string()),
+            ("path", pa.string()),
+            ("columns", pa.list_(pa.string())),
+            ("rows_json", pa.string()),
+            ("row_count", pa.int64()),
+            ("error", pa.string()),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._pending = []
+        self.row_group_size = row_group_size
+
+    def write(self, record):
+        self._pending.append({
+            "id": record["id"],
+            "question": record["question"],
+            "query": record.get("query"),
+            "path": record.get("path"),
+            "columns": record.get("columns"),
+            "rows_json": json.dumps(record["rows"], default=json_default) if record.get("rows") is not None else None,
+            "row_count": record.get("row_count"),
+            "error": record.get("error"),
+        })
+        if len(self._pending) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._writer.write_table(self._pa.Table.from_pylist(self._pending, schema=self._schema))
+            self._pending = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def open_writer(path, output_format=None):
+    output_format = output_format or ("parquet" if path.endswith(".parquet") else "jsonl")
+    if output_format == "parquet":
+        return ParquetWriter(path)
+    if output_format == "jsonl":
+        return JsonlWriter(path)
+    raise ValueError(f"Unknown output format {output_format!r}, expected 'jsonl' or 'parquet'")
+
+
+async def run_batch(async_pipeline, items, write, parallelism=None, include_rows=True):
+    """Answer every item, calling write(record) as each unique question finishes.
+
+    Items whose normalized question is identical share one LLM call and one
+    query. A failure is recorded on that item's record and does not stop
+    the batch. Returns summary counts.
+    """
+    parallelism = config.BATCH_PARALLELISM if parallelism is None else parallelism
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(normalize_question(item.question), []).append(item)
+
+    semaphore = asyncio.Semaphore(parallelism)
+    summary = {"items": len(items), "unique_questions": len(groups), "succeeded": 0, "failed": 0}
+
+    async def answer(group):
+        question = group[0].question
+        query = None
+        lookup = None
+        async with semaphore:
+            try:
+                state, embedding = await async_pipeline.prepare(question)
+                query, lookup = await async_pipeline.generate_sql(question, state, embedding=embedding)
+                col_keys, result = await async_pipeline.run_sql(query, state)
+                async_pipeline.pipeline.remember(question, query, lookup, state)
+                outcome = {"query": query, "path": answer_path(lookup), "columns": list(col_keys), "row_count": len(result),
+                           "error": None}
+                if include_rows:
+                    outcome["rows"] = [dict(zip(col_keys, row)) for row in result]
+            except Exception as e:
+                # Keep the SQL when only execution failed, it is what needs fixing
+                outcome = {"query": query, "path": answer_path(lookup) if query is not None else None, "columns": None,
+                           "row_count": None, "error": f"{type(e).__name__}: {e}"}
+        for item in group:
+            write({"id": item.id, "question": item.question, **outcome})
+            summary["failed" if outcome["error"] else "succeeded"] += 1
+
+    await asyncio.gather(*(answer(group) for group in groups.values()))
+    return summary
+
+
+async def _run_cli(args):
+    from async_query import AsyncText2SqlPipeline
+    from query import Text2SqlPipeline
+
+    items = read_questions(args.input, field=args.field)
+    pipeline = Text2SqlPipeline().start()
+    writer = open_writer(args.out, args.format)
+    try:
+        async_pipeline = AsyncText2SqlPipeline(pipeline, queue_timeout=args.queue_timeout)
+        summary = await run_batch(async_pipeline, items, writer.write, parallelism=args.parallelism,
+                                  include_rows=not args.no_rows)
+    finally:
+        writer.close()
+        pipeline.close()
+    print(json.dumps(summary))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions in one run")
+    parser.add_argument("input", help="JSONL file, one object per line")
+    parser.add_argument("--out", required=True, help="results file (.jsonl or .parquet)")
+    parser.add_argument("--format", choices=("jsonl", "parquet"), help="defaults to the --out extension")
+    parser.add_argument("--field", default="question", help="key holding the question text")
+    parser.add_argument("--parallelism", type=int, default=config.BATCH_PARALLELISM)
+    parser.add_argument("--queue-timeout", type=float, default=600.0,
+                        help="seconds a question may wait for an LLM/DB slot")
+    parser.add_argument("--no-rows", action="store_true", help="write SQL and row counts only")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.input):
+        parser.error(f"{args.input} does not exist")
+    try:
+        summary = asyncio.run(_run_cli(args))
+    except Exception:
+        traceback.print_exc()
+        return 2
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,72 @@
+#Throughput of the async /query path at increasing concurrency, with a stub LLM and a local Postgres
+#
+#   DB_TRANSPORT=direct DB_HOST=localhost DB_USER=... DB_PASSWORD=... DB_NAME=... \
+#       python -m benchmarks.bench_async --setup --llm-latency 0.3 --concurrency 1,2,4,8,16
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+# Measure the LLM and the database, not the caches
+os.environ.setdefault("QUESTION_CACHE_ENABLED", "0")
+os.environ.setdefault("RESULT_CACHE_ENABLED", "0")
+os.environ.setdefault("TUNNEL_CHECK_INTERVAL", "0")
+
+from llama_index.core import Settings  # noqa: E402
+
+from async_query import AsyncText2SqlPipeline  # noqa: E402
+from connection import ConnectionManager  # noqa: E402
+from benchmarks.fixture import load_fixture  # noqa: E402
+from benchmarks.stubs import StubLLM, stub_embed_model  # noqa: E402
+from query import Text2SqlPipeline  # noqa: E402
+
+
+async def run_level(async_pipeline, concurrency, requests):
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(f"benchmark question {i}")
+
+    async def worker():
+        while not queue.empty():
+            question = queue.get_nowait()
+            started = time.perf_counter()
+            await async_pipeline.aprocess_question(question)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return requests / elapsed, latencies
+
+
+async def main(args):
+    Settings.embed_model = stub_embed_model()
+    connections = ConnectionManager().start()
+    if args.setup:
+        load_fixture(connections.engine, rows=args.rows)
+    pipeline = Text2SqlPipeline(connections=connections, llm=StubLLM(latency=args.llm_latency)).start()
+    async_pipeline = AsyncText2SqlPipeline(
+        pipeline, llm_concurrency=args.llm_limit, db_concurrency=args.db_limit, queue_timeout=60)
+
+    print(f"{'concurrency':>11} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        throughput, latencies = await run_level(async_pipeline, concurrency, args.requests)
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000
+        p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+        print(f"{concurrency:>11} {throughput:>8.1f} {p50:>8.1f} {p95:>8.1f}")
+    pipeline.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--setup", action="store_true", help="(re)create the expanded_hts_prep fixture first")
+    parser.add_argument("--rows", type=int, default=5000, help="rows per weekly fixture table")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", default="1,2,4,8,16")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds per stub completion")
+    parser.add_argument("--llm-limit", type=int, default=16)
+    parser.add_argument("--db-limit", type=int, default=8)
+    asyncio.run(main(parser.parse_args()))
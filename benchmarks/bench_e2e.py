@@ -0,0 +1,296 @@
+#End-to-end load benchmark of main.py's /query, offline: stub LLM, fixture warehouse on a local Postgres
+#
+#   DB_TRANSPORT=direct DB_HOST=localhost DB_USER=... DB_PASSWORD=... DB_NAME=... \
+#       python -m benchmarks.bench_e2e --setup --rows 50000 --periods 4 --requests 400 --concurrency 8 --save main
+#   ... python -m benchmarks.bench_e2e --requests 400 --concurrency 8 --compare main
+#
+#The app runs in a child process (uvicorn, one worker) with StubLLM answering the corpus' canned SQL, so the driver
+#does not share its GIL. The fixture has every column of the data dictionary. Requests ask for the debug breakdown,
+#which gives per-stage timings. Results can be saved as a named baseline under benchmarks/baselines/ and later
+#runs compared against it; a comparison exits 1 when a metric regressed by more than --tolerance.
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+os.environ.setdefault("TUNNEL_CHECK_INTERVAL", "0")
+# The stub embedding is constant, so semantic cache lookups would match any question
+os.environ["QUESTION_CACHE_ENABLED"] = "0"
+
+import httpx  # noqa: E402
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_QUESTIONS = os.path.join(BENCH_DIR, "sample_questions.jsonl")
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+#Settings that change what is measured; comparing runs with different values warns
+_SETTINGS = ("rows", "periods", "questions", "requests", "concurrency", "rate", "llm_latency", "result_cache")
+
+#Stages shorter than this (ms at the median), or seen in fewer requests, are too noisy to flag
+_MIN_STAGE_MS = 1.0
+_MIN_STAGE_COUNT = 20
+
+
+def serve(args):
+    #Child process: the app with the stub LLM installed before startup
+    from llama_index.core import Settings
+    import uvicorn
+
+    from benchmarks.stubs import StubLLM, canned_sql, stub_embed_model
+
+    Settings.embed_model = stub_embed_model()
+    import main
+    main.pipeline._llm = StubLLM(latency=args.llm_latency, canned=canned_sql(args.questions))
+    uvicorn.run(main.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def start_server(args):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = {**os.environ, "RESULT_CACHE_ENABLED": "1" if args.result_cache else "0"}
+    # The pipeline logs every question and query at INFO; without --verbose the server logs warnings only
+    if not args.verbose:
+        env["LOG_LEVEL"] = "WARNING"
+    command = [sys.executable, "-m", "benchmarks.bench_e2e", "--serve", "--port", str(port),
+               "--llm-latency", str(args.llm_latency), "--questions", args.questions]
+    process = subprocess.Popen(command, env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode} during startup")
+        try:
+            if httpx.get(f"{url}/stats", timeout=1.0).status_code == 200:
+                return process, url, time.monotonic() - (deadline - args.startup_timeout)
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"Server not ready after {args.startup_timeout}s")
+
+
+def read_corpus(path):
+    with open(path, 'r') as file:
+        return [json.loads(line)["question"] for line in file if line.strip()]
+
+
+async def send(client, url, question, scheduled):
+    #One /query request; latency counts from when it was due, so a backed-up driver does not hide queueing
+    try:
+        response = await client.post(f"{url}/query", json={"question": question, "debug": True})
+        body = response.json() if response.headers.get("content-type", "").startswith("application/json") else {}
+        status = response.status_code
+    except httpx.HTTPError as e:
+        body, status = {}, type(e).__name__
+    debug = body.get("debug") or {}
+    return {"status": status, "latency_ms": (time.perf_counter() - scheduled) * 1000, "path": body.get("path"),
+            "stages_ms": debug.get("stages_ms", {}), "server_ms": debug.get("total_ms")}
+
+
+async def drive(url, questions, args):
+    #Closed loop with --concurrency clients, or open loop at --rate requests/s
+    limits = httpx.Limits(max_connections=max(args.concurrency, 1) * 2)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for i in range(args.warmup):
+            await send(client, url, questions[i % len(questions)], time.perf_counter())
+        records = []
+        started = time.perf_counter()
+        if args.rate:
+            tasks = []
+            for i in range(args.requests):
+                due = started + i / args.rate
+                await asyncio.sleep(max(due - time.perf_counter(), 0))
+                tasks.append(asyncio.create_task(send(client, url, questions[i % len(questions)], due)))
+            records = await asyncio.gather(*tasks)
+        else:
+            counter = iter(range(args.requests))
+
+            async def client_loop():
+                for i in counter:
+                    records.append(await send(client, url, questions[i % len(questions)], time.perf_counter()))
+
+            await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    return records, elapsed
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def at(q):
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 2)
+
+    return {"p50": at(0.5), "p90": at(0.9), "p95": at(0.95), "p99": at(0.99), "max": round(ordered[-1], 2),
+            "mean": round(statistics.fmean(ordered), 2)}
+
+
+def summarize(records, elapsed):
+    ok = [record for record in records if record["status"] == 200]
+    statuses, paths, stages = {}, {}, {}
+    for record in records:
+        statuses[str(record["status"])] = statuses.get(str(record["status"]), 0) + 1
+    for record in ok:
+        paths[record["path"]] = paths.get(record["path"], 0) + 1
+        for stage, ms in record["stages_ms"].items():
+            stages.setdefault(stage, []).append(ms)
+    return {
+        "requests": len(records),
+        "ok": len(ok),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": percentiles([record["latency_ms"] for record in ok]),
+        "server_ms": percentiles([record["server_ms"] for record in ok if record["server_ms"] is not None]),
+        "status": statuses,
+        "paths": paths,
+        # Per request, so a stage some requests skip (llm on template hits) is measured only where it ran
+        "stages_ms": {stage: {**percentiles(values), "count": len(values)} for stage, values in sorted(stages.items())},
+    }
+
+
+def print_summary(summary):
+    latency = summary["latency_ms"]
+    print(f"\n{summary['ok']}/{summary['requests']} ok in {summary['elapsed_s']}s, "
+          f"{summary['throughput_rps']} req/s   status {summary['status']}   paths {summary['paths']}")
+    if latency:
+        print("latency ms   " + "  ".join(f"{key} {value:8.1f}" for key, value in latency.items()))
+    print(f"\n{'stage':<18} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    for stage, values in summary["stages_ms"].items():
+        print(f"{stage:<18} {values['count']:>6} {values['p50']:>9.1f} {values['p95']:>9.1f} {values['p99']:>9.1f} "
+              f"{values['mean']:>9.1f}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(BENCH_DIR), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def baseline_path(name):
+    return name if name.endswith(".json") else os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def save_baseline(name, settings, summary):
+    path = baseline_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "settings": settings,
+                   "summary": summary}, file, indent=2)
+    print(f"\nbaseline saved to {path}")
+
+
+def compare(name, settings, summary, tolerance):
+    #Prints metric changes against the baseline; returns the regressions beyond tolerance
+    with open(baseline_path(name), 'r') as file:
+        baseline = json.load(file)
+    print(f"\ncompared with baseline {name} (commit {baseline.get('commit')}, {baseline.get('created')})")
+    changed = {key: (baseline["settings"].get(key), value) for key, value in settings.items()
+               if baseline["settings"].get(key) != value}
+    if changed:
+        print(f"  warning: settings differ from the baseline: {changed}")
+
+    old, new = baseline["summary"], summary
+    # (metric, baseline value, current value, higher is better)
+    metrics = [("throughput_rps", old["throughput_rps"], new["throughput_rps"], True)]
+    for key in ("p50", "p95", "p99"):
+        metrics.append((f"latency {key}", old["latency_ms"].get(key), new["latency_ms"].get(key), False))
+    for stage, values in old["stages_ms"].items():
+        if values["p50"] >= _MIN_STAGE_MS and values["count"] >= _MIN_STAGE_COUNT and stage in new["stages_ms"]:
+            metrics.append((f"stage {stage} p50", values["p50"], new["stages_ms"][stage]["p50"], False))
+
+    regressions = []
+    print(f"  {'metric':<28} {'baseline':>10} {'current':>10} {'change':>8}")
+    for metric, before, after, higher_better in metrics:
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_better else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(metric)
+        print(f"  {metric:<28} {before:>10.1f} {after:>10.1f} {change:>+8.0%}{flag}")
+    if old.get("ok") == old.get("requests") and new["ok"] < new["requests"]:
+        regressions.append("errors")
+        print(f"  errors: {new['requests'] - new['ok']} failed requests, the baseline had none")
+    return regressions
+
+
+def setup_fixture(args):
+    from benchmarks.fixture import dictionary_columns, load_fixture, week_codes
+    from connection import ConnectionManager
+
+    connections = ConnectionManager().start()
+    try:
+        started = time.perf_counter()
+        load_fixture(connections.engine, rows=args.rows, periods=week_codes(args.periods),
+                     columns=dictionary_columns())
+        print(f"fixture: {args.periods} weekly tables x {args.rows} rows in {time.perf_counter() - started:.1f}s")
+    finally:
+        connections.close()
+
+
+def main(args):
+    if args.setup:
+        setup_fixture(args)
+    process = None
+    url = args.url
+    if url is None:
+        process, url, startup = start_server(args)
+        print(f"server ready in {startup:.1f}s")
+    try:
+        records, elapsed = asyncio.run(drive(url, read_corpus(args.questions), args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    summary = summarize(records, elapsed)
+    print_summary(summary)
+
+    settings = {key: getattr(args, key) for key in _SETTINGS}
+    settings["questions"] = os.path.basename(args.questions)
+    if args.save:
+        save_baseline(args.save, settings, summary)
+    if args.compare:
+        regressions = compare(args.compare, settings, summary, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--setup", action="store_true", help="(re)create the expanded_hts_prep fixture first")
+    parser.add_argument("--rows", type=int, default=20000, help="rows per weekly fixture table")
+    parser.add_argument("--periods", type=int, default=4, help="weekly tables to create with --setup")
+    parser.add_argument("--questions", default=SAMPLE_QUESTIONS, help="JSONL corpus with question and sql fields")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8, help="closed-loop clients")
+    parser.add_argument("--rate", type=float, default=None, help="open-loop arrival rate in requests/s instead")
+    parser.add_argument("--warmup", type=int, default=20, help="requests sent before measuring")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per stub completion")
+    parser.add_argument("--result-cache", action="store_true", help="leave the result cache on")
+    parser.add_argument("--url", default=None, help="drive an already running server instead of starting one")
+    parser.add_argument("--verbose", action="store_true", help="show the server's output")
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--save", metavar="NAME", help="store the results as baseline NAME")
+    parser.add_argument("--compare", metavar="NAME", help="compare against baseline NAME")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=8000, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+    else:
+        sys.exit(main(args))
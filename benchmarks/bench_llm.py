@@ -0,0 +1,154 @@
+#Tail latency and error handling of llm_client.ResilientLLM against the local stub OpenAI server, fully offline
+#
+#   python -m benchmarks.bench_llm --calls 300 --slow-rate 0.05 --slow-latency 5
+#
+#Three scenarios, each through the real OpenAI client:
+#  tail     a share of requests are very slow: plain client vs hedged requests (p50/p99, extra requests sent)
+#  errors   injected 500s and 429s: no retries vs jittered retries (success rate)
+#  outage   the primary model is down: circuit breaker opens, calls go to the fallback, primary recovers
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+from llama_index.llms.openai import OpenAI  # noqa: E402
+
+from benchmarks.stub_openai import StubOpenAI  # noqa: E402
+from llm_client import ResilientLLM  # noqa: E402
+
+
+PROMPT = "Given an input question, create a syntactically correct postgresql query against expanded_hts_weekly_2024W32."
+PRIMARY = "gpt-3.5-turbo"
+FALLBACK = "gpt-4o-mini"
+
+
+def openai_llm(stub, model, deadline):
+    return OpenAI(temperature=0, model=model, api_key="stub", api_base=stub.url, max_retries=0, timeout=deadline)
+
+
+async def drive(llm, calls, concurrency):
+    #Latencies of the calls that succeeded, and the number that failed
+    gate = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one():
+        nonlocal failures
+        async with gate:
+            started = time.perf_counter()
+            try:
+                await llm.acomplete(PROMPT)
+            except Exception:
+                failures += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one() for _ in range(calls)))
+    return latencies, failures
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def report(label, latencies, failures, calls, sent, stats=None):
+    print(f"  {label:<10} ok {len(latencies):4d}/{calls}  p50 {percentile(latencies, 0.5) * 1000:7.0f} ms  "
+          f"p95 {percentile(latencies, 0.95) * 1000:7.0f} ms  p99 {percentile(latencies, 0.99) * 1000:7.0f} ms  "
+          f"max {max(latencies, default=float('nan')) * 1000:7.0f} ms  requests sent {sent}")
+    if stats is not None:
+        counters = {key: value for key, value in stats.items() if key != "models"}
+        print(f"  {'':<10} {counters}")
+
+
+def sent(stub, before, model=PRIMARY):
+    return stub.requests.get(model, 0) - before
+
+
+async def tail(stub, args):
+    print(f"tail: {args.slow_rate:.0%} of requests take {args.slow_latency}s")
+    stub.set_faults(PRIMARY, slow_rate=args.slow_rate, slow_latency=args.slow_latency, error_rate=0.0,
+                    rate_limit_rate=0.0, down=False)
+    before = stub.requests.get(PRIMARY, 0)
+    latencies, failures = await drive(openai_llm(stub, PRIMARY, args.deadline), args.calls, args.concurrency)
+    report("plain", latencies, failures, args.calls, sent(stub, before))
+
+    llm = ResilientLLM(openai_llm(stub, PRIMARY, args.deadline), deadline=args.deadline, retries=0)
+    # Warm the latency window so the hedge delay is the observed percentile
+    await drive(llm, 30, args.concurrency)
+    llm = _reset_counters(llm)
+    before = stub.requests.get(PRIMARY, 0)
+    latencies, failures = await drive(llm, args.calls, args.concurrency)
+    report("hedged", latencies, failures, args.calls, sent(stub, before), llm.stats())
+
+
+async def errors(stub, args):
+    print(f"errors: {args.error_rate:.0%} answered 500, {args.rate_limit_rate:.0%} answered 429")
+    stub.set_faults(PRIMARY, slow_rate=0.0, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                    down=False)
+    for label, retries in (("no retry", 0), ("retried", 2)):
+        # A high breaker threshold keeps this scenario about retries alone
+        llm = ResilientLLM(openai_llm(stub, PRIMARY, args.deadline), deadline=args.deadline, hedge=False,
+                           retries=retries)
+        llm._primary.breaker.failure_threshold = args.calls
+        before = stub.requests.get(PRIMARY, 0)
+        latencies, failures = await drive(llm, args.calls, args.concurrency)
+        report(label, latencies, failures, args.calls, sent(stub, before), llm.stats())
+
+
+async def outage(stub, args):
+    print(f"outage: {PRIMARY} answers 503, fallback {FALLBACK}, breaker reset {args.breaker_reset}s")
+    stub.set_faults(PRIMARY, slow_rate=0.0, error_rate=0.0, rate_limit_rate=0.0, down=True)
+    stub.set_faults(FALLBACK, down=False)
+    llm = ResilientLLM(openai_llm(stub, PRIMARY, args.deadline), fallback=openai_llm(stub, FALLBACK, args.deadline),
+                       deadline=args.deadline, hedge=False, retries=1)
+    llm._primary.breaker.reset_timeout = args.breaker_reset
+    before = stub.requests.get(PRIMARY, 0)
+    latencies, failures = await drive(llm, args.calls, args.concurrency)
+    report("down", latencies, failures, args.calls, sent(stub, before), llm.stats())
+    print(f"  {'':<10} primary breaker {llm.stats()['models'][PRIMARY]}, fallback requests "
+          f"{stub.requests.get(FALLBACK, 0)}")
+
+    stub.set_faults(PRIMARY, down=False)
+    await asyncio.sleep(args.breaker_reset)
+    before = stub.requests.get(PRIMARY, 0)
+    latencies, failures = await drive(llm, args.calls // 4, args.concurrency)
+    report("recovered", latencies, failures, args.calls // 4, sent(stub, before))
+    print(f"  {'':<10} primary breaker {llm.stats()['models'][PRIMARY]}")
+
+
+def _reset_counters(llm):
+    with llm._lock:
+        for key in llm._counters:
+            llm._counters[key] = 0
+    return llm
+
+
+async def main(args):
+    stub = StubOpenAI(faults={"*": {"latency": args.latency, "jitter": args.jitter}}, seed=args.seed).start()
+    try:
+        for scenario in args.scenarios:
+            await {"tail": tail, "errors": errors, "outage": outage}[scenario](stub, args)
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", default=["tail", "errors", "outage"])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-latency", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.1)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.05)
+    parser.add_argument("--deadline", type=float, default=10.0)
+    parser.add_argument("--breaker-reset", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(main(parser.parse_args()))
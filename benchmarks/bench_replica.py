@@ -0,0 +1,69 @@
+#Latency of the local DuckDB replica against the Postgres path (through the configured transport)
+#
+#   DB_TRANSPORT=direct DB_HOST=localhost DB_USER=... DB_PASSWORD=... DB_NAME=... \
+#       python -m benchmarks.bench_replica --setup --rows 200000
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+os.environ.setdefault("TUNNEL_CHECK_INTERVAL", "0")
+
+from sqlalchemy import text  # noqa: E402
+
+from connection import ConnectionManager  # noqa: E402
+from benchmarks.fixture import PERIODS, load_fixture  # noqa: E402
+from benchmarks.verify_rollups import QUERIES  # noqa: E402
+from period import table_for_period  # noqa: E402
+from replica import LocalReplica  # noqa: E402
+
+
+def timed(run, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return statistics.median(latencies)
+
+
+def main(args):
+    connections = ConnectionManager().start()
+    try:
+        if args.setup:
+            load_fixture(connections.engine, rows=args.rows)
+        table = table_for_period(PERIODS[-1])
+        with tempfile.TemporaryDirectory() as directory:
+            replica = LocalReplica(connections.engine, directory=directory)
+            started = time.perf_counter()
+            replica.prepare(table, wait=True)
+            print(f"snapshot of {table}: {(time.perf_counter() - started) * 1000:.0f} ms, "
+                  f"{os.path.getsize(replica.snapshot_path(table)) / 1e6:.1f} MB parquet")
+
+            def on_postgres(sql):
+                with connections.engine.connect() as conn:
+                    conn.execute(text(sql)).fetchall()
+
+            print(f"{'query':>5} {'postgres p50 ms':>16} {'replica p50 ms':>15} {'speedup':>8}")
+            totals = [0.0, 0.0]
+            for number, template in enumerate(QUERIES, start=1):
+                sql = template.format(table=table)
+                remote = timed(lambda: on_postgres(sql), args.repeat)
+                local = timed(lambda: replica.run_sql(sql), args.repeat)
+                totals[0] += remote
+                totals[1] += local
+                print(f"{number:>5} {remote:>16.2f} {local:>15.2f} {remote / local:>7.1f}x")
+            print(f"{'all':>5} {totals[0]:>16.2f} {totals[1]:>15.2f} {totals[0] / totals[1]:>7.1f}x")
+            print(replica.stats())
+            replica.close()
+    finally:
+        connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--setup", action="store_true", help="(re)create the expanded_hts_prep fixture first")
+    parser.add_argument("--rows", type=int, default=200000, help="rows per weekly fixture table")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query and path")
+    main(parser.parse_args())
@@ -0,0 +1,95 @@
+#/query body encoding, fully offline: result rows through a DataFrame and the QueryResponse model (the old path)
+#against response_json encoding them straight from the cursor's tuples, with orjson and with the json module
+#
+#   python -m benchmarks.bench_serialize --rows 100 1000 10000 50000
+#
+#The old path is what FastAPI does for a response_model: dump the returned model, validate the dump against the
+#model, dump it again in JSON mode and json.dumps it.
+import argparse
+import datetime
+import decimal
+import json
+import random
+import time
+
+import pandas as pd
+from pydantic import TypeAdapter
+
+import response_json
+from main import QueryResponse
+
+
+COL_KEYS = ["stateofresidence", "sex", "age", "positives", "positivity", "datevisit", "clientcode"]
+
+_ADAPTER = TypeAdapter(QueryResponse)
+
+
+def make_rows(count, seed=0):
+    #Tuples shaped like psycopg2 returns them: text, int, Decimal from numeric math, date and NULLs
+    rnd = random.Random(seed)
+    start = datetime.date(2024, 8, 5)
+    return [(rnd.choice(["Lagos", "Kano", "Abuja", "Rivers", "Oyo", "Benue"]), rnd.choice(["Male", "Female", None]),
+             rnd.randint(1, 80), rnd.randint(0, 500), decimal.Decimal(rnd.randint(0, 10000)) / 100,
+             start + datetime.timedelta(days=rnd.randrange(7)), f"C{rnd.randrange(10 ** 8):08d}")
+            for _ in range(count)]
+
+
+def fields(output_df):
+    return {"query_string": "SELECT ...", "output_df": output_df, "question": "positives by state", "query": "SELECT ...",
+            "path": "llm", "debug": None}
+
+
+def through_model(col_keys, rows):
+    output_df = pd.DataFrame(rows, columns=col_keys).to_dict(orient="records")
+    content = QueryResponse(**fields(output_df)).model_dump(by_alias=True)
+    value = _ADAPTER.validate_python(content)
+    return json.dumps(_ADAPTER.dump_python(value, mode="json"), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode()
+
+
+def direct(col_keys, rows):
+    return response_json.encode_object(fields(response_json.RawJSON(response_json.encode_records(col_keys, rows))))
+
+
+def with_json_module(col_keys, rows):
+    orjson, response_json.orjson = response_json.orjson, None
+    try:
+        return direct(col_keys, rows)
+    finally:
+        response_json.orjson = orjson
+
+
+def timed(encode, rows, budget):
+    #Best of as many runs as fit in budget seconds (at least three)
+    best = float("inf")
+    runs = 0
+    deadline = time.perf_counter() + budget
+    while runs < 3 or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        body = encode(COL_KEYS, rows)
+        best = min(best, time.perf_counter() - started)
+        runs += 1
+    return best, len(body)
+
+
+def main(args):
+    paths = [("model", through_model), ("json", with_json_module)]
+    if response_json.orjson_available():
+        paths.append(("orjson", direct))
+    else:
+        print("orjson is not installed, only the json module fallback is measured")
+    print(f"{'rows':>8}  " + "  ".join(f"{label:>16}" for label, _ in paths) + "   body")
+    for count in args.rows:
+        rows = make_rows(count)
+        results = [timed(encode, rows, args.budget) for _, encode in paths]
+        baseline = results[0][0]
+        cells = [f"{seconds * 1000:9.2f} ms" + (f" {baseline / seconds:4.1f}x" if index else "      ")
+                 for index, (seconds, _) in enumerate(results)]
+        print(f"{count:>8}  " + "  ".join(cells) + f"   {results[-1][1] / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000, 10000, 50000])
+    parser.add_argument("--budget", type=float, default=1.0, help="seconds of runs per measurement")
+    main(parser.parse_args())
@@ -0,0 +1,139 @@
+#Worker startup cost, fully offline: import time of main, preload() with and without an index snapshot, and
+#how much memory forked workers share when the pipeline is preloaded
+#
+#   python -m benchmarks.bench_startup --runs 5 --embed-latency 0.3 --workers 4
+#
+#Every measurement runs in a fresh interpreter so nothing is already imported. The embedding model is the stub
+#one, waiting --embed-latency seconds per batch the way a remote embedding API would.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from query import _HEAVY_MODULES
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHECKED_MODULES = ("llama_index.core", "pandas", "numpy", "openai", "sshtunnel", "nltk")
+
+_IMPORT = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter() - started
+for name in {heavy!r}:
+    __import__(name)
+print(json.dumps({{"import": imported, "eager": time.perf_counter() - started,
+                  "loaded": [name for name in {checked!r} if name in sys.modules]}}))
+"""
+
+_PRELOAD = """
+import json, time
+from llama_index.core import Settings
+from benchmarks.stubs import stub_embed_model
+Settings.embed_model = stub_embed_model({latency!r})
+from query import Text2SqlPipeline
+started = time.perf_counter()
+Text2SqlPipeline().preload()
+print(json.dumps({{"preload": time.perf_counter() - started, "embed_calls": Settings.embed_model.calls}}))
+"""
+
+_FORK = """
+import json, os
+from llama_index.core import Settings
+from benchmarks.stubs import stub_embed_model
+Settings.embed_model = stub_embed_model(0.0)
+from query import Text2SqlPipeline
+pipeline = Text2SqlPipeline()
+if {preload!r}:
+    pipeline.preload()
+
+def memory():
+    #kB of this process's own pages, and its proportional share of the pages it shares
+    fields = {{}}
+    with open("/proc/self/smaps_rollup") as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {{"private": fields["Private_Clean"] + fields["Private_Dirty"], "pss": fields["Pss"]}}
+
+readers = []
+for _ in range({workers!r}):
+    read, write = os.pipe()
+    if os.fork() == 0:
+        os.close(read)
+        pipeline.preload()
+        pipeline.prompt_builder.relevant_columns("positives by state of residence")
+        os.write(write, json.dumps(memory()).encode())
+        os._exit(0)
+    os.close(write)
+    readers.append(read)
+samples = []
+for read in readers:
+    samples.append(json.loads(os.read(read, 4096)))
+    os.close(read)
+while True:
+    try:
+        os.wait()
+    except ChildProcessError:
+        break
+print(json.dumps(samples))
+"""
+
+
+def run(script, env=None):
+    output = subprocess.run([sys.executable, "-c", script], cwd=REPO, env={**os.environ, **(env or {})},
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def imports(args):
+    samples = [run(_IMPORT.format(heavy=_HEAVY_MODULES, checked=_CHECKED_MODULES)) for _ in range(args.runs)]
+    lazy = statistics.median(sample["import"] for sample in samples)
+    eager = statistics.median(sample["eager"] for sample in samples)
+    print(f"import main: {lazy * 1000:.0f} ms (median of {args.runs}); with the deferred modules imported "
+          f"up front {eager * 1000:.0f} ms")
+    print(f"  heavy modules loaded by import main: {', '.join(samples[0]['loaded']) or 'none'}")
+
+
+def preload(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "index_snapshot.json")
+        from index_snapshot import build_snapshot, save_snapshot
+        from prompt_builder import PromptBuilder
+        from query import load_data_dictionary
+        from benchmarks.stubs import stub_embed_model
+        lines = PromptBuilder(load_data_dictionary()).column_lines()
+        save_snapshot(path, build_snapshot(lines, stub_embed_model()))
+
+        print(f"preload(), embedding model waits {args.embed_latency}s per batch, {len(lines)} columns:")
+        for label, snapshot in (("no snapshot", os.path.join(directory, "missing.json")), ("snapshot", path)):
+            samples = [run(_PRELOAD.format(latency=args.embed_latency), {"INDEX_SNAPSHOT_PATH": snapshot})
+                       for _ in range(args.runs)]
+            seconds = statistics.median(sample["preload"] for sample in samples)
+            print(f"  {label:<12} {seconds * 1000:7.0f} ms  embedding calls {samples[0]['embed_calls']}")
+
+
+def forked(args):
+    print(f"{args.workers} forked workers after the index is built (kB per worker):")
+    for label, preloaded in (("per worker", False), ("preloaded", True)):
+        samples = run(_FORK.format(preload=preloaded, workers=args.workers))
+        private = statistics.mean(sample["private"] for sample in samples)
+        pss = statistics.mean(sample["pss"] for sample in samples)
+        print(f"  {label:<12} private {private:9.0f}  pss {pss:9.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", default=["imports", "preload", "forked"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--embed-latency", type=float, default=0.3, help="stub seconds per embedding batch")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        {"imports": imports, "preload": preload, "forked": forked}[scenario](args)
@@ -0,0 +1,65 @@
+#Template fast path hit rate and latency against the LLM path, on benchmarks/sample_questions.jsonl
+#
+#   DB_TRANSPORT=direct DB_HOST=localhost DB_USER=... DB_PASSWORD=... DB_NAME=... \
+#       python -m benchmarks.bench_templates --setup --llm-latency 1.0
+import argparse
+import os
+import statistics
+import time
+
+# Measure the fast path, not the caches
+os.environ.setdefault("QUESTION_CACHE_ENABLED", "0")
+os.environ.setdefault("RESULT_CACHE_ENABLED", "0")
+os.environ.setdefault("TUNNEL_CHECK_INTERVAL", "0")
+
+from llama_index.core import Settings  # noqa: E402
+
+from batch import read_questions  # noqa: E402
+from connection import ConnectionManager  # noqa: E402
+from benchmarks.fixture import load_fixture  # noqa: E402
+from benchmarks.stubs import StubLLM, stub_embed_model  # noqa: E402
+from query import Text2SqlPipeline, answer_path  # noqa: E402
+
+
+SAMPLE_QUESTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_questions.jsonl")
+
+
+def main(args):
+    Settings.embed_model = stub_embed_model()
+    connections = ConnectionManager().start()
+    if args.setup:
+        load_fixture(connections.engine, rows=args.rows)
+    pipeline = Text2SqlPipeline(connections=connections, llm=StubLLM(latency=args.llm_latency)).start()
+    latencies = {"template": [], "llm": []}
+    try:
+        state = pipeline.current_state()
+        for item in read_questions(args.questions):
+            started = time.perf_counter()
+            query, lookup = pipeline.generate_sql(item.question, state)
+            try:
+                pipeline.run_sql(query, state)
+                error = ""
+            except Exception as e:
+                # The stub's canned SQL need not fit the fixture; the path and its latency are what is measured
+                error = type(e).__name__
+            elapsed = (time.perf_counter() - started) * 1000
+            path = answer_path(lookup)
+            latencies[path].append(elapsed)
+            print(f"{item.id:>5} {path:>8} {elapsed:>9.1f} ms  {error}{item.question}")
+    finally:
+        pipeline.close()
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"\nfast path hit rate: {len(latencies['template'])}/{total} ({len(latencies['template']) / total:.0%})")
+    for path, values in latencies.items():
+        if values:
+            print(f"{path:>8}: p50 {statistics.median(values):8.1f} ms  max {max(values):8.1f} ms  ({len(values)} questions)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--setup", action="store_true", help="(re)create the expanded_hts_prep fixture first")
+    parser.add_argument("--rows", type=int, default=5000, help="rows per weekly fixture table")
+    parser.add_argument("--questions", default=SAMPLE_QUESTIONS, help="JSONL file with id and question fields")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="seconds per stub completion")
+    main(parser.parse_args())
@@ -0,0 +1,123 @@
+#Synthetic expanded_hts_prep fixture for running the pipeline against a local Postgres
+import csv
+import datetime
+import random
+
+from sqlalchemy import text
+
+import config
+
+
+PERIODS = ["2024W31", "2024W32"]
+
+_INSERT_BATCH = 5000
+
+_COLUMNS = {
+    "datimcode": lambda rnd, period: rnd.choice(["dt001", "dt002", "dt003", "dt004"]),
+    "sex": lambda rnd, period: rnd.choice(["Male", "Female", "MALE", "FEMALE"]),
+    "stateofresidence": lambda rnd, period: rnd.choice(["Lagos", "Kano", "Abuja", "Rivers", "Oyo", "Benue"]),
+    "targetgroup": lambda rnd, period: rnd.choice(["FSW", "MSM", "PWID", "GENERAL_POPULATION"]),
+    "prepoffered": lambda rnd, period: rnd.choice(["Yes", "No"]),
+    "prepaccepted": lambda rnd, period: rnd.choice(["Yes", "No"]),
+    "finalhivtestresult": lambda rnd, period: rnd.choice(["Positive", "Negative", "Negative", "Negative", None]),
+}
+
+_STATES = ["Lagos", "Kano", "Abuja", "Rivers", "Oyo", "Benue", "Kaduna", "Enugu", "Akwa Ibom", "Plateau"]
+
+#Values for the data dictionary's columns, as its descriptions spell them (mixed case included)
+_VALUES = {
+    "sex": ["Male", "Female", "MALE", "FEMALE", "TRANS FEMALE", "TRANS MALE"],
+    "maritalstatus": ["Single", "Married", "MARRIED", "divorced", "Widowed", "Separated", "Co-Habiting"],
+    "stateofresidence": _STATES,
+    "state": _STATES,
+    "targetgroup": ["CHILDREN_OF_KP", "FSW", "GEN_POP", "GEN_POP", "GEN_POP", "MSM", "PD", "PRISON", "PWID",
+                    "SEXUAL_PARTNER", "TRANSGENDER", None],
+    "referredfrom": ["Self", "OPD", "Others", "Self"],
+    "testingsetting": ["Outreach", "CT", "OPD", "Standalone HTS", "CPMTCT", "SNT", "PNS", "Ward", "TB"],
+    "counselingtype": ["Individual", "Couple", "Group"],
+    "finalhivtestresult": ["Positive", "Negative", "Negative", "Negative", "Negative", None],
+    "syphilistestresult": ["Positive", "Negative", "Negative", None],
+    "hepatitisbtestresult": ["Positive", "Negative", "Negative", None],
+    "hepatitisctestresult": ["Positive", "Negative", "Negative", None],
+}
+_YES_NO = ["Yes", "No", "TRUE", "FALSE"]
+_YES_NO_COLUMNS = {"firsttimevisit", "indexclient", "prepoffered", "prepaccepted", "previouslytested"}
+
+
+def week_start(period):
+    #Monday of the ISO week a period code like 2024W32 names
+    year, week = period.upper().split("W")
+    return datetime.date.fromisocalendar(int(year), int(week), 1)
+
+
+def week_codes(count, last="2024W32"):
+    #count consecutive period codes ending with last, oldest first
+    end = week_start(last)
+    codes = []
+    for weeks_back in range(count - 1, -1, -1):
+        year, week, _ = (end - datetime.timedelta(weeks=weeks_back)).isocalendar()
+        codes.append(f"{year}W{week:02d}")
+    return codes
+
+
+def _column_spec(name):
+    #(SQL type, generator) for one data dictionary column
+    if name == "period":
+        return "text", lambda rnd, period: period
+    if name == "period_start_date":
+        return "date", lambda rnd, period: week_start(period)
+    if name == "datevisit":
+        return "date", lambda rnd, period: week_start(period) + datetime.timedelta(days=rnd.randrange(7))
+    if name == "dateofbirth":
+        return "date", lambda rnd, period: datetime.date(1950, 1, 1) + datetime.timedelta(days=rnd.randrange(25000))
+    if name == "age":
+        return "integer", lambda rnd, period: rnd.randint(1, 80)
+    if name.startswith("numberof"):
+        return "integer", lambda rnd, period: rnd.choice([0, 0, 0, 1, 2, 3, 5, 10])
+    if name in _YES_NO_COLUMNS:
+        return "text", lambda rnd, period: rnd.choice(_YES_NO)
+    if name in _VALUES:
+        values = _VALUES[name]
+        return "text", lambda rnd, period: rnd.choice(values)
+    if name == "clientcode":
+        return "text", lambda rnd, period: f"C{rnd.randrange(10 ** 8):08d}"
+    if name == "datimcode":
+        return "text", lambda rnd, period: f"dt{rnd.randrange(1, 200):03d}"
+    # Facility and LGA names, and anything added to the dictionary later
+    return "text", lambda rnd, period: f"{name}_{rnd.randrange(1, 40):02d}"
+
+
+def dictionary_columns(path=None, parent="expanded_hts_prep"):
+    #Column name -> (SQL type, generator) for every column the data dictionary documents
+    with open(path or config.DATA_DICTIONARY_PATH, 'r') as file:
+        return {row["name"]: _column_spec(row["name"]) for row in csv.DictReader(file) if row["parent"] == parent}
+
+
+def load_fixture(db_engine, rows=5000, periods=PERIODS, seed=0, columns=None):
+    """(Re)create expanded_hts_prep with a period table and one weekly table per period code.
+
+    columns maps column name -> (SQL type, generator(rnd, period)); the
+    default is the few text columns the checks in this directory use, and
+    dictionary_columns() gives the full warehouse shape.
+    """
+    rnd = random.Random(seed)
+    if columns is None:
+        columns = {name: ("text", make) for name, make in _COLUMNS.items()}
+    definitions = ", ".join(f"{name} {sql_type}" for name, (sql_type, _) in columns.items())
+    placeholders = ", ".join(f":{name}" for name in columns)
+    with db_engine.begin() as conn:
+        # Pipeline connections default to read-only transactions (DB_READ_ONLY)
+        conn.execute(text("SET TRANSACTION READ WRITE"))
+        conn.execute(text("DROP SCHEMA IF EXISTS expanded_hts_prep CASCADE"))
+        conn.execute(text("CREATE SCHEMA expanded_hts_prep"))
+        conn.execute(text("CREATE TABLE expanded_hts_prep.period (periodcode text, is_current boolean)"))
+        for periodcode in periods:
+            conn.execute(text("INSERT INTO expanded_hts_prep.period VALUES (:periodcode, :is_current)"),
+                         {"periodcode": periodcode, "is_current": periodcode == periods[-1]})
+            table = "expanded_hts_prep.expanded_hts_weekly_" + periodcode.lower()
+            conn.execute(text(f"CREATE TABLE {table} ({definitions})"))
+            for start in range(0, rows, _INSERT_BATCH):
+                batch = [{name: make(rnd, periodcode) for name, (_, make) in columns.items()}
+                         for _ in range(min(_INSERT_BATCH, rows - start))]
+                conn.execute(text(f"INSERT INTO {table} VALUES ({placeholders})"), batch)
+            conn.execute(text(f"ANALYZE {table}"))
@@ -0,0 +1,165 @@
+#OpenAI-compatible stub server with injected latency and errors, for exercising llm_client.py offline
+#
+#   python -m benchmarks.stub_openai --port 8900 --latency 0.3 --slow-rate 0.05 --slow-latency 8 --error-rate 0.05
+#   OPENAI_API_BASE=http://127.0.0.1:8900/v1 OPENAI_API_KEY=stub uvicorn main:app
+#
+#Answers /v1/chat/completions and /v1/completions with canned SQL for the table named in the prompt. Faults are
+#set per model (a "*" entry applies to the others) and can be changed while running with POST /faults.
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.stubs import DEFAULT_SQL
+
+
+_TABLE = re.compile(r"expanded_hts_weekly_\w+")
+
+DEFAULT_FAULTS = {
+    "latency": 0.2,  # seconds, every request
+    "jitter": 0.1,  # plus up to this much
+    "slow_rate": 0.0,  # share of requests that take slow_latency instead
+    "slow_latency": 10.0,
+    "error_rate": 0.0,  # share answered 500
+    "rate_limit_rate": 0.0,  # share answered 429
+    "down": False,  # every request answered 503
+}
+
+
+class StubOpenAI:
+    """Runs the stub in a background thread; url is the api_base to hand the OpenAI client."""
+
+    def __init__(self, port=0, faults=None, seed=None):
+        self.faults = {"*": dict(DEFAULT_FAULTS)}
+        for model, overrides in (faults or {}).items():
+            self.set_faults(model, **overrides)
+        self.random = random.Random(seed)
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def set_faults(self, model="*", **overrides):
+        unknown = set(overrides) - set(DEFAULT_FAULTS)
+        if unknown:
+            raise ValueError(f"Unknown fault settings: {sorted(unknown)}")
+        self.faults[model] = {**self.faults.get(model, self.faults["*"]), **overrides}
+
+    def faults_for(self, model):
+        return self.faults.get(model, self.faults["*"])
+
+    def outcome(self, model):
+        #(status, seconds to wait) for one request to model
+        faults = self.faults_for(model)
+        with self._lock:
+            self.requests[model] = self.requests.get(model, 0) + 1
+            draw = self.random.random()
+            slow = self.random.random() < faults["slow_rate"]
+            jitter = self.random.uniform(0, faults["jitter"])
+        latency = (faults["slow_latency"] if slow else faults["latency"]) + jitter
+        if faults["down"]:
+            return 503, 0.0
+        if draw < faults["error_rate"]:
+            return 500, latency
+        if draw < faults["error_rate"] + faults["rate_limit_rate"]:
+            return 429, 0.0
+        return 200, latency
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _prompt_text(body):
+    if "messages" in body:
+        return "\n".join(str(message.get("content") or "") for message in body["messages"])
+    prompt = body.get("prompt", "")
+    return "\n".join(prompt) if isinstance(prompt, list) else str(prompt)
+
+
+def _completion(body, chat):
+    match = _TABLE.search(_prompt_text(body))
+    text = "SQLQuery: " + DEFAULT_SQL.format(table=match.group(0) if match else "expanded_hts_weekly")
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    if chat:
+        choice = {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+        kind = "chat.completion"
+    else:
+        choice = {"index": 0, "text": text, "logprobs": None, "finish_reason": "stop"}
+        kind = "text_completion"
+    return {"id": f"stub-{uuid.uuid4().hex}", "object": kind, "created": int(time.time()),
+            "model": body.get("model", "stub"), "choices": [choice], "usage": usage}
+
+
+def _handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, payload, headers=None):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            try:
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up (a cancelled hedge or a deadline)
+                pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if self.path == "/faults":
+                try:
+                    stub.set_faults(body.pop("model", "*"), **body)
+                except (TypeError, ValueError) as e:
+                    return self._send(400, {"error": {"message": str(e)}})
+                return self._send(200, stub.faults)
+            if self.path not in ("/v1/chat/completions", "/v1/completions"):
+                return self._send(404, {"error": {"message": f"No route {self.path}"}})
+
+            status, seconds = stub.outcome(body.get("model", "stub"))
+            time.sleep(seconds)
+            if status != 200:
+                error = {"message": f"Injected {status}", "type": "stub_error", "code": status}
+                return self._send(status, {"error": error}, {"Retry-After": "0"} if status == 429 else None)
+            self._send(200, _completion(body, chat=self.path == "/v1/chat/completions"))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--seed", type=int, default=None)
+    for name, default in DEFAULT_FAULTS.items():
+        if isinstance(default, bool):
+            parser.add_argument(f"--{name.replace('_', '-')}", action="store_true")
+        else:
+            parser.add_argument(f"--{name.replace('_', '-')}", type=float, default=default)
+    args = parser.parse_args()
+    stub = StubOpenAI(port=args.port, faults={"*": {name: getattr(args, name) for name in DEFAULT_FAULTS}},
+                      seed=args.seed)
+    print(f"stub OpenAI API on {stub.url}")
+    stub.serve()
@@ -0,0 +1,119 @@
+#Offline stand-ins for OpenAI: a canned-SQL LLM and a constant embedding model
+import asyncio
+import json
+import re
+import time
+
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import CompletionResponse, CustomLLM, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+
+_TABLE = re.compile(r"expanded_hts_weekly_\w+")
+
+DEFAULT_SQL = (
+    "SELECT stateofresidence, COUNT(*) AS TotalTests, "
+    "SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) AS TotalPositives "
+    "FROM {table} GROUP BY stateofresidence ORDER BY TotalPositives DESC"
+)
+
+
+class StubLLM(CustomLLM):
+    """Returns canned SQL after a fixed latency.
+
+    canned maps a substring of the question to a SQL template; {table} is
+    filled with the weekly table named in the prompt.
+    """
+
+    latency: float = 0.0
+    canned: dict = {}
+    default_sql: str = DEFAULT_SQL
+
+    @property
+    def metadata(self):
+        return LLMMetadata(model_name="stub")
+
+    def _sql_for(self, prompt):
+        match = _TABLE.search(prompt)
+        table = match.group(0) if match else "expanded_hts_weekly"
+        prompt_lower = prompt.lower()
+        sql = self.default_sql
+        # The question follows the prompt's few-shot examples, so the key found last in the prompt is the question
+        found = [(prompt_lower.rfind(key.lower()), template) for key, template in self.canned.items()
+                 if key.lower() in prompt_lower]
+        if found:
+            sql = max(found, key=lambda position_template: position_template[0])[1]
+        return "SQLQuery: " + sql.format(table=table)
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        time.sleep(self.latency)
+        return CompletionResponse(text=self._sql_for(prompt))
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt, formatted=False, **kwargs):
+        await asyncio.sleep(self.latency)
+        return CompletionResponse(text=self._sql_for(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        def chunks():
+            time.sleep(self.latency)
+            yield from _chunks(self._sql_for(prompt))
+        return chunks()
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt, formatted=False, **kwargs):
+        async def chunks():
+            await asyncio.sleep(self.latency)
+            for chunk in _chunks(self._sql_for(prompt)):
+                yield chunk
+        return chunks()
+
+
+def _chunks(text):
+    #Word by word, as streamed completions arrive: text so far plus the new delta
+    sent = ""
+    for delta in re.findall(r"\S+\s*", text):
+        sent += delta
+        yield CompletionResponse(text=sent, delta=delta)
+
+
+class SlowMockEmbedding(MockEmbedding):
+    """MockEmbedding that waits latency seconds per call (per batch for batches), like a remote API."""
+
+    latency: float = 0.0
+    calls: int = 0
+
+    def _get_text_embedding(self, text):
+        self.calls += 1
+        time.sleep(self.latency)
+        return super()._get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts):
+        self.calls += 1
+        time.sleep(self.latency)
+        return [super(SlowMockEmbedding, self)._get_text_embedding(text) for text in texts]
+
+    def _get_query_embedding(self, query):
+        self.calls += 1
+        time.sleep(self.latency)
+        return super()._get_query_embedding(query)
+
+
+def stub_embed_model(latency=0.0):
+    if latency:
+        return SlowMockEmbedding(embed_dim=8, latency=latency)
+    return MockEmbedding(embed_dim=8)
+
+
+def canned_sql(path):
+    #Question -> SQL template for StubLLM.canned, from a JSONL corpus with question and sql fields
+    canned = {}
+    with open(path, 'r') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                if record.get("sql"):
+                    canned[record["question"]] = record["sql"]
+    return canned
@@ -0,0 +1,110 @@
+#Checks that multi-period answers merged from per-period partials equal the query run over all periods at once
+#
+#   DB_TRANSPORT=direct DB_HOST=localhost DB_USER=... DB_PASSWORD=... DB_NAME=... \
+#       python -m benchmarks.verify_periods --setup --periods 6
+#
+#Ground truth is each query against a UNION ALL view of the period tables. Exits 1 on any mismatch, or when a
+#query the merge should handle was not split.
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault("TUNNEL_CHECK_INTERVAL", "0")
+
+from sqlalchemy import text  # noqa: E402
+
+from connection import ConnectionManager  # noqa: E402
+from benchmarks.fixture import load_fixture  # noqa: E402
+from benchmarks.verify_rollups import QUERIES, fetch, same_rows  # noqa: E402
+from multi_period import TABLE_PLACEHOLDER, merge_statements, split_for_periods  # noqa: E402
+from period import resolve_available_periods, table_for_period  # noqa: E402
+
+
+ALL_PERIODS_VIEW = "expanded_hts_weekly_all_periods"
+
+#Shapes only the merge handles (the rollups do not): AVG, output-name ordering, LIMIT within each period
+EXTRA_QUERIES = [
+    "SELECT sex, AVG(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) AS share FROM {table} "
+    "GROUP BY sex ORDER BY share DESC, sex",
+    "SELECT stateofresidence AS state, SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) AS positives "
+    "FROM {table} GROUP BY 1 ORDER BY positives DESC, state LIMIT 3",
+    "SELECT 'All' AS label, ROUND(SUM(CASE WHEN prepaccepted = 'Yes' THEN 1 ELSE 0 END) * 100.0 / COUNT(*), 2) AS pct "
+    "FROM {table}",
+]
+
+#The rollup checks' queries, except the distinct count that cannot be merged
+SPLIT_QUERIES = [query for query in QUERIES if "COUNT(DISTINCT" not in query] + EXTRA_QUERIES
+
+#Row-level queries, distinct counts, windows and subqueries are answered per period only
+PER_PERIOD_ONLY = [
+    "SELECT * FROM {table} WHERE sex = 'Male'",
+    "SELECT COUNT(DISTINCT stateofresidence) FROM {table}",
+    "SELECT sex, COUNT(*) FROM {table} WHERE sex IN (SELECT sex FROM {table}) GROUP BY sex",
+    "SELECT sex, COUNT(*) OVER () FROM {table}",
+    "SELECT sex, string_agg(datimcode, ',') FROM {table} GROUP BY sex",
+]
+
+
+def create_view(db_engine, codes):
+    with db_engine.begin() as conn:
+        conn.execute(text("SET TRANSACTION READ WRITE"))
+        union = " UNION ALL ".join(f"SELECT * FROM {table_for_period(code)}" for code in codes)
+        conn.execute(text(f"CREATE OR REPLACE VIEW {ALL_PERIODS_VIEW} AS {union}"))
+
+
+def main(args):
+    connections = ConnectionManager().start()
+    engine = connections.engine
+    failures = 0
+    try:
+        if args.setup:
+            load_fixture(engine, rows=args.rows, periods=[f"2024W{week}" for week in range(33 - args.periods, 33)])
+        codes = resolve_available_periods(engine)
+        create_view(engine, codes)
+        print("periods:", ", ".join(codes))
+        with engine.connect() as conn:
+            for template in SPLIT_QUERIES:
+                split = split_for_periods(template)
+                if split is None:
+                    failures += 1
+                    print(f"NOT SPLIT   {template}")
+                    continue
+                started = time.perf_counter()
+                partials = []
+                for code in codes:
+                    partials.append(fetch(conn, split.partial.replace(TABLE_PLACEHOLDER, table_for_period(code))))
+                by_period_sql, combined_sql, params = merge_statements(split, codes, partials)
+                combined_keys, combined = fetch(conn, combined_sql, params)
+                _, by_period = fetch(conn, by_period_sql, params)
+                merged_ms = (time.perf_counter() - started) * 1000
+
+                col_keys, truth = fetch(conn, template.replace(TABLE_PLACEHOLDER, ALL_PERIODS_VIEW))
+                ok = combined_keys == col_keys and same_rows(truth, combined, template, col_keys)
+                for code in codes:
+                    _, expected = fetch(conn, template.replace(TABLE_PLACEHOLDER, table_for_period(code)))
+                    got = [row[1:] for row in by_period if row[0] == code]
+                    ok = ok and same_rows(expected, got, template, col_keys)
+                failures += not ok
+                print(f"{'ok' if ok else 'MISMATCH':<11} merged {merged_ms:7.1f} ms  {len(combined)} rows  "
+                      f"{template[:70]}")
+                if not ok:
+                    print(f"  truth:    {col_keys} {truth}\n  combined: {combined_keys} {combined}\n"
+                          f"  sql:      {combined_sql}")
+        for template in PER_PERIOD_ONLY:
+            if split_for_periods(template) is not None:
+                failures += 1
+                print(f"SPLIT       {template}")
+    finally:
+        connections.close()
+    print(f"{len(SPLIT_QUERIES)} merged queries and {len(PER_PERIOD_ONLY)} per-period-only queries checked, "
+          f"{failures} failures")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--setup", action="store_true", help="(re)create the expanded_hts_prep fixture first")
+    parser.add_argument("--rows", type=int, default=5000, help="rows per weekly fixture table")
+    parser.add_argument("--periods", type=int, default=4, help="weekly tables to create with --setup")
+    sys.exit(main(parser.parse_args()))
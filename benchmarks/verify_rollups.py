@@ -0,0 +1,163 @@
+#Checks that queries routed onto rollups return exactly what the raw weekly table returns, on the local fixture
+#
+#   DB_TRANSPORT=direct DB_HOST=localhost DB_USER=... DB_PASSWORD=... DB_NAME=... \
+#       python -m benchmarks.verify_rollups --setup
+#
+#Exits 1 if any query was not routed or returned different rows, or a raw-only query was routed.
+import argparse
+import os
+import re
+import sys
+import time
+from itertools import groupby
+
+os.environ.setdefault("TUNNEL_CHECK_INTERVAL", "0")
+
+from sqlalchemy import text  # noqa: E402
+
+from connection import ConnectionManager  # noqa: E402
+from benchmarks.fixture import PERIODS, load_fixture  # noqa: E402
+from period import table_for_period  # noqa: E402
+from rollups import RollupManager  # noqa: E402
+
+
+#The few-shot patterns from the prompt plus the other shapes the rewriter accepts; {table} is the weekly table
+QUERIES = [
+    # Positivity rate by state, excluding 100%
+    "SELECT stateofresidence, COUNT(*) AS TotalTests, SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) "
+    "AS TotalPositives, SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) * 100.0 / COUNT(*) AS "
+    "PositivityRate FROM {table} GROUP BY stateofresidence HAVING SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 "
+    "ELSE 0 END) * 100.0 / COUNT(*) < 100 ORDER BY PositivityRate DESC;",
+    # Positivity rate by sex
+    "SELECT sex, SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) * 100.0 / COUNT(*) AS rate "
+    "FROM {table} GROUP BY sex ORDER BY rate DESC",
+    # PrEP offered / accepted by key population
+    "SELECT targetgroup, SUM(CASE WHEN prepoffered = 'Yes' THEN 1 ELSE 0 END) AS TotalOfferedPrep, "
+    "SUM(CASE WHEN prepoffered = 'Yes' AND prepaccepted = 'Yes' THEN 1 ELSE 0 END) AS TotalAcceptedPrep, "
+    "SUM(CASE WHEN prepoffered = 'Yes' AND prepaccepted = 'Yes' THEN 1 ELSE 0 END) * 100.0 / "
+    "NULLIF(SUM(CASE WHEN prepoffered = 'Yes' THEN 1 ELSE 0 END), 0) AS ProportionAcceptedPrep "
+    "FROM {table} GROUP BY targetgroup ORDER BY ProportionAcceptedPrep DESC",
+    # Counts by facility
+    "SELECT datimcode, COUNT(*) AS tests FROM {table} GROUP BY datimcode ORDER BY tests DESC, datimcode",
+    "SELECT t.datimcode, COUNT(t.finalhivtestresult) AS with_result FROM {table} AS t "
+    "WHERE t.sex IN ('Male', 'MALE') GROUP BY t.datimcode ORDER BY t.datimcode",
+    # Filters, distinct counts, empty results, no GROUP BY
+    "SELECT COUNT(*) FROM {table} WHERE finalhivtestresult = 'Positive' AND stateofresidence = 'Lagos'",
+    "SELECT COUNT(*) AS n, SUM(CASE WHEN sex = 'Male' THEN 1 END) AS males FROM {table} WHERE sex = 'nobody'",
+    "SELECT COUNT(DISTINCT stateofresidence) AS states, MIN(targetgroup), MAX(targetgroup) FROM {table}",
+    "SELECT DISTINCT targetgroup FROM {table} ORDER BY targetgroup",
+    "SELECT stateofresidence, sex, COUNT(*) FROM {table} -- by state and sex\n"
+    "GROUP BY stateofresidence, sex ORDER BY 3 DESC, 1, 2 LIMIT 5",
+]
+
+_ORDER_BY = re.compile(r"\border\s+by\s+(?P<items>.+?)\s*(?:\blimit\b|\boffset\b|\bfetch\b|;|$)", re.I | re.S)
+
+#Shapes whose answer a rollup cannot reproduce; these must stay on the raw table
+RAW_ONLY = [
+    "SELECT * FROM {table} WHERE sex = 'Male'",
+    "SELECT sex FROM {table} WHERE stateofresidence = 'Lagos'",
+    "SELECT sex, AVG(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) FROM {table} GROUP BY sex",
+    "SELECT a.sex, COUNT(*) FROM {table} a JOIN {table} b ON a.datimcode = b.datimcode GROUP BY a.sex",
+    "SELECT sex, COUNT(*) FROM {table} WHERE sex IN (SELECT sex FROM {table}) GROUP BY sex",
+    "SELECT sex, COUNT(*) OVER () FROM {table}",
+]
+
+
+def fetch(conn, sql, params=None):
+    #(col_keys, rows)
+    result = conn.execute(text(sql), params or {})
+    return list(result.keys()), [tuple(row) for row in result]
+
+
+def order_positions(sql, col_keys):
+    #Indexes of the output columns sql's ORDER BY sorts on: [] without one, None when an item is an expression
+    found = _ORDER_BY.search(sql)
+    if found is None:
+        return []
+    names = [key.lower() for key in col_keys]
+    positions = []
+    for item in found.group("items").split(","):
+        item = re.sub(r"\s+(asc|desc)$", "", item.strip(), flags=re.I).split(".")[-1].strip('"').lower()
+        if item.isdigit():
+            positions.append(int(item) - 1)
+        elif item in names:
+            positions.append(names.index(item))
+        else:
+            return None
+    return positions
+
+
+def same_rows(expected, got, sql, col_keys=()):
+    """True when got is the result expected for sql.
+
+    Unordered results are compared as multisets. Ordered ones must agree
+    row by row, except that rows whose sort keys tie may come in any order
+    (and a LIMIT may cut through the last such run).
+    """
+    if len(expected) != len(got):
+        return False
+    positions = order_positions(sql, col_keys)
+    if positions == []:
+        return sorted(expected, key=repr) == sorted(got, key=repr)
+    if positions is None:
+        return expected == got
+
+    def sort_key(row):
+        return tuple(row[i] for i in positions)
+
+    if [sort_key(row) for row in expected] != [sort_key(row) for row in got]:
+        return False
+    runs = [list(run) for _, run in groupby(range(len(expected)), key=lambda i: sort_key(expected[i]))]
+    if runs and re.search(r"\blimit\b", sql, re.I):
+        runs = runs[:-1]
+    return all(sorted((expected[i] for i in run), key=repr) == sorted((got[i] for i in run), key=repr)
+               for run in runs)
+
+
+def main(args):
+    connections = ConnectionManager().start()
+    try:
+        if args.setup:
+            load_fixture(connections.engine, rows=args.rows)
+        table = table_for_period(PERIODS[-1])
+        manager = RollupManager(connections.engine, max_ratio=1.0, enabled=True)
+        manager.prepare(table, wait=True)
+        print("rollups:", ", ".join(f"{rollup.name} ({rollup.rows} rows)" for rollup in manager.rollups_for(table)))
+
+        failures = 0
+        with connections.engine.connect() as conn:
+            for template in QUERIES:
+                sql = template.format(table=table)
+                routed = manager.route(sql, table)
+                if routed is None:
+                    failures += 1
+                    print(f"NOT ROUTED  {sql}")
+                    continue
+                started = time.perf_counter()
+                col_keys, raw = fetch(conn, sql)
+                raw_ms = (time.perf_counter() - started) * 1000
+                started = time.perf_counter()
+                routed_keys, rolled = fetch(conn, routed.sql)
+                routed_ms = (time.perf_counter() - started) * 1000
+                ok = routed_keys == col_keys and same_rows(raw, rolled, sql, col_keys)
+                failures += not ok
+                print(f"{'ok' if ok else 'MISMATCH':<11} {routed.rollup.name:<40} raw {raw_ms:7.1f} ms"
+                      f"  rollup {routed_ms:7.1f} ms  {len(raw)} rows")
+                if not ok:
+                    print(f"  raw:    {col_keys} {raw}\n  rollup: {routed_keys} {rolled}\n  sql:    {routed.sql}")
+        for template in RAW_ONLY:
+            sql = template.format(table=table)
+            if manager.route(sql, table) is not None:
+                failures += 1
+                print(f"ROUTED      {sql}")
+    finally:
+        connections.close()
+    print(f"{len(QUERIES) - failures}/{len(QUERIES)} queries match, {len(RAW_ONLY)} raw-only queries checked")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--setup", action="store_true", help="(re)create the expanded_hts_prep fixture first")
+    parser.add_argument("--rows", type=int, default=20000, help="rows per weekly fixture table")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,163 @@
+#Service configuration, read once from the environment
+import os
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(default)).strip().lower() in ("1", "true", "yes", "on")
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# SSH tunnel to the warehouse host --> adjust to private key location/login as needed
+SSH_HOST = os.environ.get("SSH_HOST", "******")
+SSH_PORT = _env_int("SSH_PORT", 2422)
+SSH_USERNAME = os.environ.get("SSH_USERNAME", "****")
+SSH_PASSWORD = os.environ.get("SSH_PASSWORD", "*****")
+SSH_PRIVATE_KEY = os.environ.get("SSH_PRIVATE_KEY", "******")
+SSH_PRIVATE_KEY_PASSWORD = os.environ.get("SSH_PRIVATE_KEY_PASSWORD", "****")
+# 0 binds an ephemeral local port per worker
+SSH_LOCAL_PORT = _env_int("SSH_LOCAL_PORT", 0)
+SSH_KEEPALIVE = _env_float("SSH_KEEPALIVE", 15.0)
+
+# Warehouse database (reached through the tunnel)
+DB_HOST = os.environ.get("DB_HOST", "127.0.0.1")
+DB_REMOTE_PORT = _env_int("DB_REMOTE_PORT", 5432)
+DB_USER = os.environ.get("DB_USER", "isaac")
+# No default: startup fails without it, except for a direct connection (a local Postgres may use trust auth)
+DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
+DB_NAME = os.environ.get("DB_NAME", "lamisplus_ods_dwh")
+# Searches left-to-right --> need to identify expanded_hts_prep else tables hidden
+DB_SCHEMA = os.environ.get("DB_SCHEMA", "expanded_hts_prep,public")
+# "ssh" goes through the tunnel, "direct" connects to DB_HOST:DB_REMOTE_PORT (e.g. a local Postgres)
+DB_TRANSPORT = os.environ.get("DB_TRANSPORT", "ssh")
+
+# Connection pool, per worker
+DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 5)
+DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 5)
+DB_POOL_TIMEOUT = _env_float("DB_POOL_TIMEOUT", 30.0)
+DB_POOL_RECYCLE = _env_int("DB_POOL_RECYCLE", 1800)
+# Seconds between tunnel health checks, 0 disables the supervisor thread
+TUNNEL_CHECK_INTERVAL = _env_float("TUNNEL_CHECK_INTERVAL", 30.0)
+
+# LLM
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
+LLM_MODEL = os.environ.get("LLM_MODEL", "gpt-3.5-turbo")
+# OpenAI-compatible endpoint, e.g. benchmarks/stub_openai.py for offline runs
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE") or None
+# Model used while LLM_MODEL's circuit breaker is open or its retries are exhausted; empty disables the fallback
+LLM_FALLBACK_MODEL = os.environ.get("LLM_FALLBACK_MODEL", "")
+
+DATA_DICTIONARY_PATH = os.environ.get(
+    "DATA_DICTIONARY_PATH", os.path.join(BASE_DIR, "Nigeria_Text2Code_DataDictionary.csv")
+)
+# Column embeddings written by index_snapshot.py; loaded at startup instead of embedding the data dictionary
+INDEX_SNAPSHOT_PATH = os.environ.get("INDEX_SNAPSHOT_PATH", os.path.join(BASE_DIR, "index_snapshot.json"))
+# Build the shareable part of the pipeline when main.py is imported, so gunicorn --preload workers share it
+PRELOAD_PIPELINE = _env_bool("PRELOAD_PIPELINE", False)
+
+# Question -> SQL cache in front of the LLM
+QUESTION_CACHE_ENABLED = _env_bool("QUESTION_CACHE_ENABLED", True)
+# Cosine similarity needed to reuse SQL generated for a paraphrased question
+QUESTION_CACHE_THRESHOLD = _env_float("QUESTION_CACHE_THRESHOLD", 0.95)
+QUESTION_CACHE_MAX_ENTRIES = _env_int("QUESTION_CACHE_MAX_ENTRIES", 1000)
+QUESTION_CACHE_TTL = _env_int("QUESTION_CACHE_TTL", 7 * 24 * 3600)
+# Optional JSON file the cache is loaded from at startup and saved to at shutdown
+QUESTION_CACHE_PATH = os.environ.get("QUESTION_CACHE_PATH", "")
+
+# Query result cache, keyed by normalized SQL + weekly table
+RESULT_CACHE_ENABLED = _env_bool("RESULT_CACHE_ENABLED", True)
+RESULT_CACHE_MAX_BYTES = _env_int("RESULT_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+# Results larger than this are never cached
+RESULT_CACHE_MAX_ENTRY_BYTES = _env_int("RESULT_CACHE_MAX_ENTRY_BYTES", 32 * 1024 * 1024)
+
+# Seconds the current period is trusted before expanded_hts_prep.period is read again
+PERIOD_TTL = _env_float("PERIOD_TTL", 300.0)
+# Optional Postgres NOTIFY channel raised when expanded_hts_prep.period changes
+PERIOD_NOTIFY_CHANNEL = os.environ.get("PERIOD_NOTIFY_CHANNEL", "")
+
+# Async /query path: concurrent LLM calls and DB queries per worker, and how long a request may queue
+LLM_CONCURRENCY = _env_int("LLM_CONCURRENCY", 8)
+DB_CONCURRENCY = _env_int("DB_CONCURRENCY", DB_POOL_SIZE + DB_MAX_OVERFLOW)
+QUEUE_TIMEOUT = _env_float("QUEUE_TIMEOUT", 10.0)
+QUEUE_MAX_WAITING = _env_int("QUEUE_MAX_WAITING", 100)
+
+# Streaming /query responses (NDJSON / Arrow IPC)
+STREAM_BATCH_SIZE = _env_int("STREAM_BATCH_SIZE", 1000)
+# Hard upper bound on rows streamed per request; requests may ask for fewer
+STREAM_ROW_CAP = _env_int("STREAM_ROW_CAP", 100000)
+
+# Prompt assembly: data dictionary columns retrieved per question, and the token budget they must fit in. Columns are
+# added while the whole prompt fits; the instructions, schema and question are never trimmed
+PROMPT_TOP_K_COLUMNS = _env_int("PROMPT_TOP_K_COLUMNS", 8)
+PROMPT_TOKEN_BUDGET = _env_int("PROMPT_TOKEN_BUDGET", 1500)
+
+# Batch answering (/query/batch and batch.py)
+BATCH_PARALLELISM = _env_int("BATCH_PARALLELISM", 4)
+BATCH_MAX_QUESTIONS = _env_int("BATCH_MAX_QUESTIONS", 100)
+
+# Observability
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# Send the per-stage timings of each request in a Server-Timing response header
+SERVER_TIMING_HEADER = _env_bool("SERVER_TIMING_HEADER", True)
+
+# Generated SQL execution guard
+SQL_GUARD_ENABLED = _env_bool("SQL_GUARD_ENABLED", True)
+# Queries whose planner cost (EXPLAIN's Total Cost) is above this are refused
+SQL_MAX_COST = _env_float("SQL_MAX_COST", 10000000.0)
+# Queries the planner expects to return more rows than this get a LIMIT, and reading stops there regardless
+SQL_ROW_LIMIT = _env_int("SQL_ROW_LIMIT", 10000)
+# Applied to every pooled connection; 0 disables
+DB_STATEMENT_TIMEOUT_MS = _env_int("DB_STATEMENT_TIMEOUT_MS", 30000)
+# Pooled connections start read-only transactions unless a caller asks for READ WRITE
+DB_READ_ONLY = _env_bool("DB_READ_ONLY", True)
+
+# Pre-aggregated rollups of the current weekly table (see rollups.py)
+ROLLUPS_ENABLED = _env_bool("ROLLUPS_ENABLED", True)
+# Rollups with more rows than this fraction of their weekly table are not routed to
+ROLLUP_MAX_RATIO = _env_float("ROLLUP_MAX_RATIO", 0.5)
+
+# Local replica (needs duckdb): queries run in-process against a Parquet snapshot of the current weekly table
+REPLICA_ENABLED = _env_bool("REPLICA_ENABLED", False)
+# Shared by all workers on the host; one snapshot per weekly table
+REPLICA_DIR = os.environ.get("REPLICA_DIR", os.path.join(BASE_DIR, "replica"))
+REPLICA_KEEP_SNAPSHOTS = _env_int("REPLICA_KEEP_SNAPSHOTS", 2)
+# DuckDB threads per worker
+REPLICA_THREADS = _env_int("REPLICA_THREADS", 2)
+
+# Answer known question shapes from SQL templates without calling the LLM (see templates.py)
+TEMPLATES_ENABLED = _env_bool("TEMPLATES_ENABLED", True)
+
+# Concurrent /query requests for the same question and period share one computation
+COALESCE_ENABLED = _env_bool("COALESCE_ENABLED", True)
+# Seconds a request waits on another's computation before running its own
+COALESCE_WAIT_TIMEOUT = _env_float("COALESCE_WAIT_TIMEOUT", 30.0)
+
+# Multi-period questions (/query/periods): weekly tables queried at once per request, and the longest range allowed
+PERIOD_PARALLELISM = _env_int("PERIOD_PARALLELISM", 4)
+PERIOD_MAX_RANGE = _env_int("PERIOD_MAX_RANGE", 52)
+
+# LLM calls (see llm_client.py): seconds one SQL generation may take, hedges and retries included
+LLM_DEADLINE = _env_float("LLM_DEADLINE", 20.0)
+# A second request is sent when the first is slower than this percentile of recent latencies
+LLM_HEDGE_ENABLED = _env_bool("LLM_HEDGE_ENABLED", True)
+LLM_HEDGE_QUANTILE = _env_float("LLM_HEDGE_QUANTILE", 0.9)
+# Hedge delay until enough latencies have been seen, and the floor under the percentile
+LLM_HEDGE_DELAY = _env_float("LLM_HEDGE_DELAY", 3.0)
+LLM_HEDGE_MIN_DELAY = _env_float("LLM_HEDGE_MIN_DELAY", 0.5)
+# Retries on timeouts, rate limits and 5xx, with full-jitter exponential backoff
+LLM_RETRIES = _env_int("LLM_RETRIES", 2)
+LLM_RETRY_BACKOFF = _env_float("LLM_RETRY_BACKOFF", 0.25)
+LLM_RETRY_BACKOFF_MAX = _env_float("LLM_RETRY_BACKOFF_MAX", 2.0)
+# Consecutive failures that open a model's circuit breaker, and seconds before a trial call
+LLM_BREAKER_FAILURES = _env_int("LLM_BREAKER_FAILURES", 5)
+LLM_BREAKER_RESET = _env_float("LLM_BREAKER_RESET", 30.0)
+# Seconds of LLM_DEADLINE kept for LLM_FALLBACK_MODEL when the primary times out (at most half the deadline)
+LLM_FALLBACK_RESERVE = _env_float("LLM_FALLBACK_RESERVE", 6.0)
@@ -0,0 +1,231 @@
+#Pooled warehouse connectivity over a supervised transport (SSH tunnel or direct)
+import threading
+import time
+
+from sqlalchemy import create_engine, engine, event
+
+import config
+from metrics import span
+
+
+class SSHTransport:
+    """One SSH tunnel per worker, bound to an ephemeral local port."""
+
+    def __init__(self, ssh_host=None, ssh_port=None, remote_port=None, local_port=None):
+        self.ssh_host = ssh_host or config.SSH_HOST
+        self.ssh_port = ssh_port or config.SSH_PORT
+        self.remote_port = remote_port or config.DB_REMOTE_PORT
+        # 0 lets the OS pick a free port, so workers never collide
+        self.local_port = config.SSH_LOCAL_PORT if local_port is None else local_port
+        self._server = None
+
+    def start(self):
+        # sshtunnel pulls in paramiko; imported here so direct connections never load it
+        from sshtunnel import SSHTunnelForwarder
+
+        #Connect to the server clone via SSH Tunnel
+        self._server = SSHTunnelForwarder(
+            (self.ssh_host, self.ssh_port),
+            ssh_username=config.SSH_USERNAME,
+            ssh_password=config.SSH_PASSWORD,
+            ssh_private_key=config.SSH_PRIVATE_KEY,
+            ssh_private_key_password=config.SSH_PRIVATE_KEY_PASSWORD,
+            remote_bind_address=('localhost', self.remote_port),
+            local_bind_address=('localhost', self.local_port),
+            set_keepalive=config.SSH_KEEPALIVE,
+        )
+        self._server.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    def is_alive(self):
+        if self._server is None or not self._server.is_active:
+            return False
+        self._server.check_tunnels()
+        return all(self._server.tunnel_is_up.values())
+
+    @property
+    def address(self):
+        return ('127.0.0.1', self._server.local_bind_port)
+
+
+class DirectTransport:
+    """Connect straight to a database host, e.g. a local Postgres in development."""
+
+    def __init__(self, host=None, port=None):
+        self.host = host or config.DB_HOST
+        self.port = port or config.DB_REMOTE_PORT
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def is_alive(self):
+        return True
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+
+def transport_from_config():
+    if config.DB_TRANSPORT == "direct":
+        return DirectTransport()
+    if config.DB_TRANSPORT == "ssh":
+        if not config.DB_PASSWORD:
+            raise ValueError("DB_PASSWORD is not set; the warehouse password has no default")
+        return SSHTransport()
+    raise ValueError(f"Unknown DB_TRANSPORT {config.DB_TRANSPORT!r}, expected 'ssh' or 'direct'")
+
+
+class ConnectionManager:
+    """Bounded SQLAlchemy pool on top of a transport that reconnects when it drops.
+
+    The engine is created once and reads the transport address at connect
+    time, so a restarted tunnel on a new port does not invalidate engines
+    already handed to SQLDatabase objects.
+    """
+
+    def __init__(self, transport=None, pool_size=None, max_overflow=None,
+                 pool_timeout=None, pool_recycle=None, check_interval=None):
+        self.transport = transport or transport_from_config()
+        self.pool_size = config.DB_POOL_SIZE if pool_size is None else pool_size
+        self.max_overflow = config.DB_MAX_OVERFLOW if max_overflow is None else max_overflow
+        self.pool_timeout = config.DB_POOL_TIMEOUT if pool_timeout is None else pool_timeout
+        self.pool_recycle = config.DB_POOL_RECYCLE if pool_recycle is None else pool_recycle
+        self.check_interval = config.TUNNEL_CHECK_INTERVAL if check_interval is None else check_interval
+        self._engine = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._supervisor = None
+        self._started_at = None
+        self._restarts = 0
+        self._last_error = None
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self.start()
+        return self._engine
+
+    def start(self):
+        with self._lock:
+            if self._engine is not None:
+                return self
+            with span("tunnel_start"):
+                self.transport.start()
+            self._started_at = time.time()
+            self._engine = self._create_engine()
+        if self.check_interval > 0:
+            self._stop_event.clear()
+            self._supervisor = threading.Thread(target=self._supervise, name="db-transport-supervisor", daemon=True)
+            self._supervisor.start()
+        return self
+
+    def close(self):
+        self._stop_event.set()
+        if self._supervisor is not None:
+            self._supervisor.join(timeout=5)
+            self._supervisor = None
+        with self._lock:
+            if self._engine is not None:
+                self._engine.dispose()
+                self._engine = None
+            self.transport.stop()
+
+    def session_options(self):
+        #Per-session settings: schema, a statement_timeout so one runaway query cannot hold the warehouse,
+        #and read-only transactions by default (writers must ask for SET TRANSACTION READ WRITE)
+        options = ['-csearch_path={}'.format(config.DB_SCHEMA)]
+        if config.DB_STATEMENT_TIMEOUT_MS > 0:
+            options.append('-cstatement_timeout={}'.format(config.DB_STATEMENT_TIMEOUT_MS))
+        if config.DB_READ_ONLY:
+            options.append('-cdefault_transaction_read_only=on')
+        return ' '.join(options)
+
+    def _create_engine(self):
+        host, port = self.transport.address
+        url = engine.URL.create(
+            "postgresql",
+            username=config.DB_USER,
+            password=config.DB_PASSWORD,
+            host=host,
+            port=int(port),
+            database=config.DB_NAME,
+        )
+        db_engine = create_engine(
+            url,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=self.pool_timeout,
+            pool_recycle=self.pool_recycle,
+            pool_pre_ping=True,
+            connect_args={'options': self.session_options()},
+        )
+
+        @event.listens_for(db_engine, "do_connect")
+        def _connect_through_transport(dialect, conn_rec, cargs, cparams):
+            # New DBAPI connections always go to the live tunnel's current port
+            self.ensure_transport()
+            cparams["host"], cparams["port"] = self.transport.address
+
+        return db_engine
+
+    def ensure_transport(self):
+        #Restart the transport if it dropped; returns True when a restart happened
+        if self.transport.is_alive():
+            return False
+        with self._lock:
+            if self.transport.is_alive():
+                return False
+            try:
+                self.transport.stop()
+            except Exception:
+                pass
+            try:
+                with span("tunnel_start"):
+                    self.transport.start()
+            except Exception as e:
+                self._last_error = repr(e)
+                raise
+            self._restarts += 1
+            self._started_at = time.time()
+            self._last_error = None
+        # Pooled connections went through the old tunnel; pre-ping would catch them, this is faster
+        if self._engine is not None:
+            self._engine.dispose(close=False)
+        return True
+
+    def _supervise(self):
+        while not self._stop_event.wait(self.check_interval):
+            try:
+                self.ensure_transport()
+            except Exception:
+                # Recorded in _last_error; retried on the next tick or the next connect
+                pass
+
+    def stats(self):
+        pool = self._engine.pool if self._engine is not None else None
+        alive = self.transport.is_alive() if self._engine is not None else False
+        return {
+            "pool": {
+                "size": self.pool_size,
+                "max_overflow": self.max_overflow,
+                "checked_in": pool.checkedin() if pool is not None else 0,
+                "checked_out": pool.checkedout() if pool is not None else 0,
+                "overflow": max(pool.overflow(), 0) if pool is not None else 0,
+            },
+            "transport": {
+                "type": type(self.transport).__name__,
+                "alive": alive,
+                "address": "{}:{}".format(*self.transport.address) if alive else None,
+                "restarts": self._restarts,
+                "uptime_seconds": round(time.time() - self._started_at, 1) if self._started_at else None,
+                "last_error": self._last_error,
+            },
+        }
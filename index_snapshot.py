@@ -0,0 +1,75 @@
+#Prebuilt column index: the data dictionary's column embeddings, computed once and loaded at startup
+#
+#   python index_snapshot.py            # writes INDEX_SNAPSHOT_PATH with the configured embedding model
+#
+#Without a snapshot every worker embeds all column descriptions when it starts. Lines whose description changed
+#since the snapshot was built are embedded as before; a snapshot made with another embedding model is ignored.
+import argparse
+import json
+import logging
+import os
+import tempfile
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def embed_model_name(embed_model):
+    return getattr(embed_model, "model_name", None) or type(embed_model).__name__
+
+
+def build_snapshot(lines, embed_model):
+    vectors = embed_model.get_text_embedding_batch(lines)
+    return {"version": SNAPSHOT_VERSION, "model": embed_model_name(embed_model), "embeddings": dict(zip(lines, vectors))}
+
+
+def save_snapshot(path, snapshot):
+    # Written aside and renamed, so a worker starting meanwhile never reads half a file
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as file:
+        json.dump(snapshot, file)
+    os.replace(file.name, path)
+
+
+def load_snapshot(path, embed_model=None):
+    #Column line -> embedding; None when there is no usable snapshot at path
+    if embed_model is None:
+        from llama_index.core import Settings
+        embed_model = Settings.embed_model
+    try:
+        with open(path, 'r') as file:
+            snapshot = json.load(file)
+    except FileNotFoundError:
+        logger.info("No index snapshot at %s, column descriptions will be embedded", path)
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable index snapshot %s: %s", path, e)
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("model") != embed_model_name(embed_model):
+        logger.warning("Ignoring index snapshot %s built for %s, the embedding model is %s",
+                       path, snapshot.get("model"), embed_model_name(embed_model))
+        return None
+    return snapshot["embeddings"]
+
+
+def main(args):
+    from llama_index.core import Settings
+
+    from prompt_builder import PromptBuilder
+    from query import load_data_dictionary
+
+    lines = PromptBuilder(load_data_dictionary(args.data_dictionary)).column_lines()
+    snapshot = build_snapshot(lines, Settings.embed_model)
+    save_snapshot(args.path, snapshot)
+    print(f"{len(lines)} column embeddings ({snapshot['model']}) written to {args.path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default=config.INDEX_SNAPSHOT_PATH)
+    parser.add_argument("--data-dictionary", default=config.DATA_DICTIONARY_PATH)
+    main(parser.parse_args())
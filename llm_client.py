@@ -0,0 +1,432 @@
+#LLM client layer: per-call deadlines, hedged requests, jittered retries, a circuit breaker and a fallback model
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms import CompletionResponse, CustomLLM, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.llms.openai import OpenAI
+
+import config
+from llm_errors import LLMError, LLMTimeout, LLMUnavailable  # noqa: F401
+from metrics import record_llm
+
+
+logger = logging.getLogger(__name__)
+
+#Latencies kept per model for the hedge delay, and how many are needed before the percentile is trusted
+_LATENCY_WINDOW = 200
+_MIN_SAMPLES = 20
+
+
+def is_transient(error):
+    #Worth retrying (or falling back on): timeouts, connection problems, rate limits and server errors
+    if isinstance(error, (LLMTimeout, TimeoutError, asyncio.TimeoutError, ConnectionError, openai.APITimeoutError,
+                          openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and rejects calls for reset_timeout seconds.
+
+    After that one trial call is let through (half-open); its success
+    closes the breaker, its failure opens it again. A trial that ends any
+    other way (cancelled, or an error that says nothing about the model)
+    gives its slot back through release().
+    """
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=None):
+        self.name = name
+        self.failure_threshold = config.LLM_BREAKER_FAILURES if failure_threshold is None else failure_threshold
+        self.reset_timeout = config.LLM_BREAKER_RESET if reset_timeout is None else reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        #False while open; "trial" for the one call let through half-open, to be handed back to release()
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return "trial"
+            return False
+
+    def release(self, permit):
+        # No-op when the trial already recorded its outcome
+        if permit == "trial":
+            with self._lock:
+                self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            reopen = self._trial_running
+            self._trial_running = False
+            if reopen or (self._opened_at is None and self._failures >= self.failure_threshold):
+                if self._opened_at is None or reopen:
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+                record_llm(self.name, "breaker_open")
+                logger.warning("Circuit breaker for %s opened after %d failures", self.name, self._failures)
+
+    def stats(self):
+        return {"state": self.state, "consecutive_failures": self._failures, "trips": self.trips}
+
+
+class LatencyTracker:
+    """Recent successful call latencies; quantile() once enough have been seen."""
+
+    def __init__(self, window=_LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q):
+        with self._lock:
+            if len(self._samples) < _MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class _Model:
+    #One underlying LLM with its breaker and latency history
+    def __init__(self, llm, name):
+        self.llm = llm
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+        self.latencies = LatencyTracker()
+
+
+class ResilientLLM(CustomLLM):
+    """Wraps the SQL-generating LLM so one slow or failing completion does not decide the request.
+
+    Every call has a deadline (LLM_DEADLINE seconds). If the first request
+    has not answered after the hedge delay (the LLM_HEDGE_QUANTILE latency
+    of recent calls), a second identical request is sent and the first
+    response wins. Transient errors are retried with jittered exponential
+    backoff. Consecutive failures (timeouts included) open a circuit
+    breaker, and calls then go to the fallback model (LLM_FALLBACK_MODEL)
+    when one is configured. The primary gives up LLM_FALLBACK_RESERVE
+    seconds before the deadline so a fallback still has time to answer.
+    Streamed completions get the same treatment up to their first chunk.
+    """
+
+    _primary = PrivateAttr()
+    _fallback = PrivateAttr()
+    _settings = PrivateAttr()
+    _executor = PrivateAttr()
+    _counters = PrivateAttr()
+    _lock = PrivateAttr()
+
+    def __init__(self, primary, fallback=None, deadline=None, hedge=None, hedge_quantile=None, hedge_delay=None,
+                 retries=None, backoff=None, backoff_max=None, fallback_reserve=None):
+        super().__init__()
+        self._primary = _Model(primary, getattr(primary, "model", None) or primary.metadata.model_name)
+        self._fallback = None
+        if fallback is not None:
+            self._fallback = _Model(fallback, getattr(fallback, "model", None) or fallback.metadata.model_name)
+        self._settings = {
+            "deadline": config.LLM_DEADLINE if deadline is None else deadline,
+            "hedge": config.LLM_HEDGE_ENABLED if hedge is None else hedge,
+            "hedge_quantile": config.LLM_HEDGE_QUANTILE if hedge_quantile is None else hedge_quantile,
+            "hedge_delay": config.LLM_HEDGE_DELAY if hedge_delay is None else hedge_delay,
+            "retries": config.LLM_RETRIES if retries is None else retries,
+            "backoff": config.LLM_RETRY_BACKOFF if backoff is None else backoff,
+            "backoff_max": config.LLM_RETRY_BACKOFF_MAX if backoff_max is None else backoff_max,
+            "fallback_reserve": config.LLM_FALLBACK_RESERVE if fallback_reserve is None else fallback_reserve,
+        }
+        # Threads for the synchronous path; a losing hedge runs on until the client's own timeout
+        self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-call")
+        self._counters = {"calls": 0, "hedges": 0, "hedge_wins": 0, "retries": 0, "fallbacks": 0, "timeouts": 0,
+                          "failures": 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls):
+        return "resilient_llm"
+
+    @property
+    def metadata(self):
+        primary = self._primary.llm.metadata
+        return LLMMetadata(model_name=self._primary.name, context_window=primary.context_window,
+                           num_output=primary.num_output)
+
+    def _count(self, counter, model=None):
+        with self._lock:
+            self._counters[counter] += 1
+        if model is not None:
+            record_llm(model.name, counter)
+
+    def hedge_delay(self, model):
+        #Seconds to wait on the first request before sending a second one
+        observed = model.latencies.quantile(self._settings["hedge_quantile"])
+        if observed is None:
+            return self._settings["hedge_delay"]
+        return max(observed, config.LLM_HEDGE_MIN_DELAY)
+
+    def _backoff(self, attempt):
+        # Full jitter: spreads the retries of many concurrent requests
+        return random.uniform(0, min(self._settings["backoff_max"], self._settings["backoff"] * 2 ** attempt))
+
+    def _models(self):
+        #(model, breaker permit) to try in order, skipping those whose breaker is open
+        for model in (self._primary, self._fallback):
+            if model is None:
+                continue
+            permit = model.breaker.allow()
+            if permit:
+                yield model, permit
+            elif model is self._primary and self._fallback is not None:
+                self._count("fallbacks", model)
+
+    def _model_deadline(self, model, deadline):
+        #The primary stops early enough to leave the fallback part of the deadline
+        if model is self._primary and self._fallback is not None:
+            return deadline - min(self._settings["fallback_reserve"], self._settings["deadline"] / 2)
+        return deadline
+
+    def _give_up(self, error):
+        #What to raise once no model is left to try
+        if isinstance(error, LLMTimeout):
+            self._count("failures")
+            return error
+        return self._unavailable(error)
+
+    # Synchronous path (Text2SqlPipeline.process_question)
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        return self._run(lambda llm: llm.complete(prompt, formatted=formatted, **kwargs))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        #Everything up to the first chunk is a call like complete(); the rest of the stream is bounded by the
+        #client's own timeout, since text already handed out cannot be retried
+        stream, first = self._run(lambda llm: _opened(llm.stream_complete(prompt, formatted=formatted, **kwargs)))
+        return _chained(first, stream)
+
+    def _run(self, call):
+        #call(llm) on the first model that answers within the deadline
+        self._count("calls")
+        deadline = time.monotonic() + self._settings["deadline"]
+        last_error = None
+        for model, permit in self._models():
+            try:
+                return self._attempts(model, call, self._model_deadline(model, deadline))
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                last_error = e
+                if model is self._primary and self._fallback is not None:
+                    self._count("fallbacks", model)
+            finally:
+                model.breaker.release(permit)
+            if time.monotonic() >= deadline:
+                break
+        raise self._give_up(last_error)
+
+    def _attempts(self, model, call, deadline):
+        for attempt in range(self._settings["retries"] + 1):
+            try:
+                response = self._hedged(model, call, deadline)
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                model.breaker.record_failure()
+                pause = self._backoff(attempt)
+                # After a timeout the deadline has passed, so this also ends the attempts
+                if attempt == self._settings["retries"] or time.monotonic() + pause >= deadline:
+                    raise
+                self._count("retries", model)
+                time.sleep(pause)
+                continue
+            model.breaker.record_success()
+            return response
+
+    def _hedged(self, model, call, deadline):
+        started = time.monotonic()
+        futures = {self._executor.submit(call, model.llm): False}
+        hedge_at = started + self.hedge_delay(model)
+        last_error = None
+        while futures:
+            hedged = any(futures.values())
+            until = deadline if hedged or not self._settings["hedge"] else min(hedge_at, deadline)
+            done, _ = wait(list(futures), timeout=max(until - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                is_hedge = futures.pop(future)
+                if future.exception() is None:
+                    return self._won(model, started, is_hedge, future.result())
+                last_error = future.exception()
+                if not is_transient(last_error):
+                    raise last_error
+            if time.monotonic() >= deadline:
+                self._count("timeouts", model)
+                raise LLMTimeout(f"No completion from {model.name} within {deadline - started:.1f}s")
+            if futures and not hedged and self._settings["hedge"] and time.monotonic() >= hedge_at:
+                self._count("hedges", model)
+                futures[self._executor.submit(call, model.llm)] = True
+        raise last_error
+
+    # Asynchronous path (AsyncText2SqlPipeline, /query)
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt, formatted=False, **kwargs):
+        return await self._arun(lambda llm: llm.acomplete(prompt, formatted=formatted, **kwargs))
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt, formatted=False, **kwargs):
+        async def opened(llm):
+            stream = await llm.astream_complete(prompt, formatted=formatted, **kwargs)
+            return stream, await anext(stream, None)
+
+        stream, first = await self._arun(opened)
+        return _achained(first, stream)
+
+    async def _arun(self, call):
+        self._count("calls")
+        deadline = time.monotonic() + self._settings["deadline"]
+        last_error = None
+        for model, permit in self._models():
+            try:
+                return await self._aattempts(model, call, self._model_deadline(model, deadline))
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                last_error = e
+                if model is self._primary and self._fallback is not None:
+                    self._count("fallbacks", model)
+            finally:
+                # Cancellation (a lost race, the client going away) is neither a success nor a failure
+                model.breaker.release(permit)
+            if time.monotonic() >= deadline:
+                break
+        raise self._give_up(last_error)
+
+    async def _aattempts(self, model, call, deadline):
+        for attempt in range(self._settings["retries"] + 1):
+            try:
+                response = await self._ahedged(model, call, deadline)
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                model.breaker.record_failure()
+                pause = self._backoff(attempt)
+                if attempt == self._settings["retries"] or time.monotonic() + pause >= deadline:
+                    raise
+                self._count("retries", model)
+                await asyncio.sleep(pause)
+                continue
+            model.breaker.record_success()
+            return response
+
+    async def _ahedged(self, model, call, deadline):
+        started = time.monotonic()
+        tasks = {asyncio.ensure_future(call(model.llm)): False}
+        hedge_at = started + self.hedge_delay(model)
+        last_error = None
+        try:
+            while tasks:
+                hedged = any(tasks.values())
+                until = deadline if hedged or not self._settings["hedge"] else min(hedge_at, deadline)
+                done, _ = await asyncio.wait(list(tasks), timeout=max(until - time.monotonic(), 0),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    is_hedge = tasks.pop(task)
+                    if task.exception() is None:
+                        return self._won(model, started, is_hedge, task.result())
+                    last_error = task.exception()
+                    if not is_transient(last_error):
+                        raise last_error
+                if time.monotonic() >= deadline:
+                    self._count("timeouts", model)
+                    raise LLMTimeout(f"No completion from {model.name} within {deadline - started:.1f}s")
+                if tasks and not hedged and self._settings["hedge"] and time.monotonic() >= hedge_at:
+                    self._count("hedges", model)
+                    tasks[asyncio.ensure_future(call(model.llm))] = True
+            raise last_error
+        finally:
+            # The losing request is cancelled, closing its HTTP request
+            for task in tasks:
+                task.cancel()
+
+    def _won(self, model, started, is_hedge, response):
+        model.latencies.add(time.monotonic() - started)
+        if is_hedge:
+            self._count("hedge_wins", model)
+        record_llm(model.name, "completion")
+        return response
+
+    def _unavailable(self, error):
+        self._count("failures")
+        if error is None:
+            return LLMUnavailable("Every LLM circuit breaker is open")
+        return LLMUnavailable(f"LLM unavailable after retries: {type(error).__name__}: {error}")
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        models = [model for model in (self._primary, self._fallback) if model is not None]
+        return {
+            **counters,
+            "models": {model.name: {**model.breaker.stats(), "hedge_delay": round(self.hedge_delay(model), 3)}
+                       for model in models},
+        }
+
+
+def _opened(stream):
+    #Pull the first chunk, so a stream that fails or stalls before it is retried like a completion
+    return stream, next(stream, None)
+
+
+def _chained(first, stream):
+    if first is not None:
+        yield first
+    yield from stream
+
+
+async def _achained(first, stream):
+    if first is not None:
+        yield first
+    async for chunk in stream:
+        yield chunk
+
+
+def build_llm():
+    #The OpenAI model behind LLM_MODEL (and LLM_FALLBACK_MODEL), wrapped in a ResilientLLM
+    def openai_llm(model):
+        # Retries and timeouts are ResilientLLM's; the client only bounds each request by the deadline
+        return OpenAI(temperature=0, model=model, api_key=config.OPENAI_API_KEY, api_base=config.OPENAI_API_BASE,
+                      max_retries=0, timeout=config.LLM_DEADLINE)
+
+    fallback = openai_llm(config.LLM_FALLBACK_MODEL) if config.LLM_FALLBACK_MODEL else None
+    return ResilientLLM(openai_llm(config.LLM_MODEL), fallback=fallback)
@@ -0,0 +1,15 @@
+#Errors raised by llm_client.ResilientLLM; kept apart so main.py can map them without importing llama_index
+
+
+class LLMError(Exception):
+    """SQL generation could not get a completion; status_code is the HTTP status to answer with."""
+
+    status_code = 503
+
+
+class LLMTimeout(LLMError):
+    status_code = 504
+
+
+class LLMUnavailable(LLMError):
+    status_code = 503
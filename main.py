@@ -1,13 +1,43 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import pandas as pd
+import logging
+from contextlib import asynccontextmanager
+
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
 
+from async_query import AsyncText2SqlPipeline, CapacityError
+from batch import BatchItem, run_batch
+import config
+from llm_errors import LLMError
+from metrics import REQUEST_SECONDS, current_trace, render_latest, span, start_trace
+from multi_period import PeriodQueryError
+from query import Text2SqlPipeline, answer_path
+from response_json import RawJSON, dumps, encode_object, encode_records
+from sql_guard import QueryRejected
+from streaming import ARROW_MEDIA_TYPE, NDJSON_MEDIA_TYPE, arrow_available, arrow_body, ndjson_body
+
+logging.basicConfig(level=config.LOG_LEVEL)
+
+# One pipeline per worker process: tunnel, engine, LLM client and indexes are built at startup
+pipeline = Text2SqlPipeline()
+async_pipeline = AsyncText2SqlPipeline(pipeline)
+if config.PRELOAD_PIPELINE:
+    # Under gunicorn --preload this runs once in the master, and forked workers share the result copy-on-write;
+    # start() in each worker then replaces the HTTP clients inherited from the master
+    pipeline.preload()
 
-# Assuming your main processing logic is in a function `process_question` in your script.
-from query import process_question  # Adjust import based on your script's name
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    pipeline.start()
+    yield
+    pipeline.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,34 +45,217 @@ app.add_middleware(
     allow_credentials=True,  # Allows cookies to be included in cross-origin requests
     allow_methods=["*"],  # Allows all HTTP methods (GET, POST, etc.)
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["Server-Timing"],  # Lets browser clients read the per-stage timings
 )
 
+_TRACED_PATHS = {"/query", "/query/batch", "/query/periods", "/refresh", "/stats", "/metrics"}
+
+
+@app.middleware("http")
+async def trace_requests(http_request: Request, call_next):
+    # Every request gets a trace that the pipeline's spans report into
+    trace = start_trace()
+    endpoint = http_request.url.path if http_request.url.path in _TRACED_PATHS else "other"
+    outcome = "exception"
+    try:
+        response = await call_next(http_request)
+        outcome = str(response.status_code)
+    finally:
+        REQUEST_SECONDS.labels(endpoint=endpoint, outcome=outcome).observe(trace.elapsed())
+    if config.SERVER_TIMING_HEADER:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
 # Define the request body
 class QuestionRequest(BaseModel):
     question: str
+    # Streaming responses only: rows to send before truncating (capped at STREAM_ROW_CAP)
+    max_rows: Optional[int] = None
+    # Adds the per-stage timing breakdown, token counts and cache outcomes to the response
+    debug: bool = False
 
 # Define the response structure
+# Documents the /query body; the handler encodes it directly (response_json.py) rather than through this model
 class QueryResponse(BaseModel):
     query_string: str
-    output_df: list[dict]  # We'll return the DataFrame as a dictionary
+    output_df: list[dict]  # one {column: value} object per row
     question: str
     query: str
+    path: Optional[str] = None  # how the SQL was produced: "template", "cache" or "llm"
+    debug: Optional[dict] = None
+
+
+async def stream_query_result(request: QuestionRequest, media_type: str):
+    # Metadata first, then rows in batches from a server-side cursor, then truncation info
+    if media_type == ARROW_MEDIA_TYPE and not arrow_available():
+        raise HTTPException(status_code=406, detail="Arrow responses need pyarrow installed")
+    try:
+        meta, stream, batches = await async_pipeline.astream_question(request.question, row_cap=request.max_rows)
+    except CapacityError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except QueryRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.to_dict())
+    except LLMError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": "5"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    body = arrow_body if media_type == ARROW_MEDIA_TYPE else ndjson_body
+    return StreamingResponse(body(meta, stream, batches), media_type=media_type)
 
 
 @app.post("/query", response_model=QueryResponse)
-def get_query_result(request: QuestionRequest):
+async def get_query_result(request: QuestionRequest, http_request: Request):
+    # Clients opt in to streaming with Accept: application/x-ndjson or application/vnd.apache.arrow.stream
+    accept = http_request.headers.get("accept", "")
+    for media_type in (NDJSON_MEDIA_TYPE, ARROW_MEDIA_TYPE):
+        if media_type in accept:
+            return await stream_query_result(request, media_type)
+
     try:
         # Process the question
-        query_string, output_df, question, query = process_question(request.question)
-        
-        # Convert DataFrame to a list of dictionaries for JSON serialization
-        output_df_dict = output_df.to_dict(orient='records')
-        
-        return QueryResponse(query_string=query_string, output_df=output_df_dict, question=question, query=query)
+        query_string, col_keys, rows, query = await async_pipeline.aanswer_question(request.question)
+
+        # Rows go from the cursor to JSON in one pass: no DataFrame, and no QueryResponse validation per row
+        with span("serialize"):
+            output_df = RawJSON(encode_records(col_keys, rows))
+
+        trace = current_trace()
+        debug = trace.breakdown() if request.debug else None
+        body = encode_object({"query_string": query_string, "output_df": output_df, "question": request.question,
+                              "query": query, "path": trace.attributes.get("path"), "debug": debug})
+        return Response(content=body, media_type="application/json")
+    except CapacityError as e:
+        # Over capacity after queueing: tell the client to back off instead of piling up
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except QueryRejected as e:
+        # Generated SQL refused by the guard or cancelled by statement_timeout: {"error", "message", "query", ...}
+        raise HTTPException(status_code=e.status_code, detail=e.to_dict())
+    except LLMError as e:
+        # No completion within LLM_DEADLINE (504), or every model failing or behind an open breaker (503)
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": "5"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+class BatchRequest(BaseModel):
+    questions: list[str]
+
+
+class BatchItemResult(BaseModel):
+    question: str
+    query: Optional[str] = None
+    path: Optional[str] = None
+    output_df: Optional[list[dict]] = None
+    error: Optional[str] = None
+
+
+# Documents the /query/batch body; the handler encodes it directly, as /query does
+class BatchResponse(BaseModel):
+    results: list[BatchItemResult]  # same order as the request
+    unique_questions: int
+    succeeded: int
+    failed: int
+
+
+@app.post("/query/batch", response_model=BatchResponse)
+async def get_batch_result(request: BatchRequest):
+    # Duplicate questions are answered once; one failing question does not fail the batch
+    if len(request.questions) > config.BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"At most {config.BATCH_MAX_QUESTIONS} questions per batch")
+    records = {}
+    items = [BatchItem(id=str(i), question=question) for i, question in enumerate(request.questions)]
+    summary = await run_batch(async_pipeline, items, lambda record: records.__setitem__(record["id"], record))
+    with span("serialize"):
+        # Duplicates of a question share its rows, which are encoded once
+        encoded = {}
+        results = []
+        for record in (records[item.id] for item in items):
+            rows = record.get("rows")
+            if rows is not None and id(rows) not in encoded:
+                encoded[id(rows)] = RawJSON(dumps(rows))
+            results.append(encode_object({"question": record["question"], "query": record["query"],
+                                          "path": record["path"],
+                                          "output_df": encoded[id(rows)] if rows is not None else None,
+                                          "error": record["error"]}))
+        body = encode_object({"results": RawJSON(b"[" + b",".join(results) + b"]"),
+                              "unique_questions": summary["unique_questions"], "succeeded": summary["succeeded"],
+                              "failed": summary["failed"]})
+    return Response(content=body, media_type="application/json")
+
+
+class PeriodQuestionRequest(BaseModel):
+    question: str
+    # Period codes to answer over (e.g. ["2024W30", "2024W31"]) or the N most recent periods;
+    # without either the range is read from the question ("over the last 8 weeks")
+    periods: Optional[list[str]] = None
+    last_periods: Optional[int] = Field(None, ge=1)
+    debug: bool = False
+
+
+class PeriodQueryResponse(BaseModel):
+    question: str
+    query: str  # run against every period, {table} standing for its weekly table
+    periods: list[str]
+    output_df: list[dict]  # per-period rows, each with its periodcode
+    combined: Optional[list[dict]] = None  # the whole range as one answer, when the query's aggregates can be merged
+    path: Optional[str] = None
+    debug: Optional[dict] = None
+
+
+@app.post("/query/periods", response_model=PeriodQueryResponse)
+async def get_period_query_result(request: PeriodQuestionRequest):
+    # Trend questions: the same SQL over several weekly tables, ratios re-derived from the merged counts
+    try:
+        query, codes, by_period, combined, lookup = await async_pipeline.aprocess_periods(
+            request.question, periods=request.periods, last_periods=request.last_periods)
+        with span("serialize"):
+            output_df = RawJSON(encode_records(*by_period))
+            combined_df = RawJSON(encode_records(*combined)) if combined is not None else None
+        debug = current_trace().breakdown() if request.debug else None
+        body = encode_object({"question": request.question, "query": query, "periods": codes, "output_df": output_df,
+                              "combined": combined_df, "path": answer_path(lookup), "debug": debug})
+        return Response(content=body, media_type="application/json")
+    except PeriodQueryError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except CapacityError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except QueryRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.to_dict())
+    except LLMError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": "5"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+class RefreshResponse(BaseModel):
+    rebuilt: bool
+    this_table: str
+
+
+@app.post("/refresh", response_model=RefreshResponse)
+def refresh_pipeline():
+    # Rebuild the pipeline if the current period table changed; in-flight requests keep the old one
+    try:
+        rebuilt = pipeline.refresh()
+        return RefreshResponse(rebuilt=rebuilt, this_table=pipeline.state.this_table)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/stats")
+def get_stats():
+    # Pool/tunnel statistics (for sizing DB_POOL_SIZE / DB_MAX_OVERFLOW), cache counters and concurrency gates
+    return {**pipeline.stats(), "concurrency": async_pipeline.stats()}
+
+
+@app.get("/metrics")
+def get_metrics():
+    # Prometheus exposition: per-stage latency, tokens, rows and cache outcome histograms/counters
+    content, content_type = render_latest()
+    return Response(content=content, media_type=content_type)
+
+
 # Run the server with Uvicorn
 if __name__ == "__main__":
     import uvicorn
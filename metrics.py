@@ -0,0 +1,134 @@
+#Per-stage latency tracing and Prometheus metrics for the text-to-SQL pipeline
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    REGISTRY,
+)
+from prometheus_client import multiprocess
+
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_TOKEN_BUCKETS = (50, 100, 250, 500, 750, 1000, 1500, 2000, 3000, 4000, 8000)
+_ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+STAGE_SECONDS = Histogram(
+    "text2sql_stage_seconds", "Time spent in one pipeline stage", ["stage"], buckets=_LATENCY_BUCKETS)
+REQUEST_SECONDS = Histogram(
+    "text2sql_request_seconds", "End-to-end request latency", ["endpoint", "outcome"], buckets=_LATENCY_BUCKETS)
+PROMPT_TOKENS = Histogram("text2sql_prompt_tokens", "Tokens sent to the LLM per SQL generation", buckets=_TOKEN_BUCKETS)
+COMPLETION_TOKENS = Histogram(
+    "text2sql_completion_tokens", "Tokens of generated SQL per LLM call", buckets=_TOKEN_BUCKETS)
+ROWS_RETURNED = Histogram("text2sql_rows_returned", "Rows returned per query", buckets=_ROW_BUCKETS)
+CACHE_LOOKUPS = Counter("text2sql_cache_lookups", "Cache lookups by cache and outcome", ["cache", "outcome"])
+LLM_EVENTS = Counter(
+    "text2sql_llm_events", "LLM completions, hedges, retries, fallbacks, timeouts and breaker trips", ["model", "event"])
+
+
+class Trace:
+    """Timings and attributes of one request, filled in by span() and record()."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.attributes = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def breakdown(self):
+        #Milliseconds per stage plus the total and recorded attributes, for the debug field
+        return {
+            "total_ms": round(self.elapsed() * 1000, 1),
+            "stages_ms": {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()},
+            **self.attributes,
+        }
+
+    def server_timing(self):
+        #Server-Timing header value, readable in browser dev tools
+        parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current_trace = contextvars.ContextVar("text2sql_trace", default=None)
+
+
+def start_trace():
+    # asyncio.to_thread copies the context, so work in threads reports to the same trace
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage=stage).observe(seconds)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, seconds)
+
+
+def record(name, value):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes[name] = value
+
+
+def record_cache(cache, outcome):
+    CACHE_LOOKUPS.labels(cache=cache, outcome=outcome).inc()
+    record(f"{cache}_cache", outcome)
+
+
+def record_llm(model, event):
+    LLM_EVENTS.labels(model=model, event=event).inc()
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    # The model that answered, and how many hedges/retries/fallbacks it took
+    if event == "completion":
+        trace.attributes["llm_model"] = model
+    else:
+        trace.attributes[f"llm_{event}"] = trace.attributes.get(f"llm_{event}", 0) + 1
+
+
+def record_tokens(prompt_tokens=None, completion_tokens=None):
+    if prompt_tokens is not None:
+        PROMPT_TOKENS.observe(prompt_tokens)
+        record("prompt_tokens", prompt_tokens)
+    if completion_tokens is not None:
+        COMPLETION_TOKENS.observe(completion_tokens)
+        record("completion_tokens", completion_tokens)
+
+
+def record_rows(rows):
+    ROWS_RETURNED.observe(rows)
+    record("rows", rows)
+
+
+def render_latest():
+    #Exposition text; aggregates all workers when PROMETHEUS_MULTIPROC_DIR is set
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
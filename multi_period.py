@@ -0,0 +1,607 @@
+#Questions over a range of weekly tables: period range resolution, per-period SQL and merging of partial aggregates
+import re
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from decimal import Decimal
+
+import config
+from period import period_sort_key, table_for_period
+from rollups import hide_literals, matching_paren, restore_literals
+from sql_guard import strip_comments
+
+
+#Stands in for the weekly table in SQL generated against the current one
+TABLE_PLACEHOLDER = "{table}"
+
+#Column added in front of every per-period row
+PERIOD_COLUMN = "periodcode"
+
+
+class PeriodQueryError(ValueError):
+    """The question names no usable period range, or its SQL cannot be run per period."""
+
+
+class _Unmergeable(Exception):
+    #Raised while splitting: the query's per-period results cannot be merged into one answer
+    pass
+
+
+_WORD_NUMBERS = {"two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+                 "eleven": 11, "twelve": 12, "twenty": 20}
+_PERIOD_CODE = r"\d{4}\s*-?\s*w\s*\d{1,2}"
+_LAST_N = re.compile(
+    r"\b(?:(?:over|in|for|during|across|within)\s+)?(?:the\s+)?(?:last|past|previous|recent|latest)\s+"
+    r"(?P<n>\d+|" + "|".join(_WORD_NUMBERS) + r")\s+(?:weeks?|periods?)\b", re.I)
+_BETWEEN = re.compile(
+    r"\b(?:(?:over|in|for|during|across)\s+)?(?:(?:the\s+)?(?:weeks?|periods?)\s+)?(?:from|between)\s+"
+    r"(?P<start>" + _PERIOD_CODE + r")\s+(?:to|and|through|until|-)\s+(?P<end>" + _PERIOD_CODE + r")\b", re.I)
+_SINCE = re.compile(r"\bsince\s+(?:(?:week|period)\s+)?(?P<start>" + _PERIOD_CODE + r")\b", re.I)
+#The period is always a dimension of the answer, the question need not ask for it
+_PER_PERIOD = re.compile(
+    r"\b(?:(?:per|by|each|every|for each|in each)\s+(?:week|period)|week\s+(?:over|on|by)\s+week|weekly)\b", re.I)
+
+
+def _range_phrase(question):
+    return _LAST_N.search(question) or _BETWEEN.search(question) or _SINCE.search(question)
+
+
+def strip_range(question):
+    #question without its period range and "per week" phrases: what to generate the single-period SQL for
+    found = _range_phrase(question)
+    if found is not None:
+        question = question[:found.start()] + " " + question[found.end():]
+    question = re.sub(r"\s+", " ", _PER_PERIOD.sub(" ", question))
+    return re.sub(r"\s+([?.,!])", r"\1", question).strip(" ,")
+
+
+def find_period(code, available):
+    key = period_sort_key(re.sub(r"[\s-]+", "", code))[:2]
+    for periodcode in available:
+        if period_sort_key(periodcode)[:2] == key:
+            return periodcode
+    raise PeriodQueryError(f"No weekly table for period {code.strip()}")
+
+
+def parse_period_range(question, available):
+    """Period codes named by question, oldest first, or None when it names no range.
+
+    Understands "last 8 weeks", "from 2024W20 to 2024W28" and "since
+    2024W20"; available is the list of queryable periods, oldest first.
+    """
+    found = _range_phrase(question)
+    if found is None:
+        return None
+    groups = found.groupdict()
+    if groups.get("n"):
+        n = groups["n"].lower()
+        n = int(n) if n.isdigit() else _WORD_NUMBERS[n]
+        return available[-n:] if n > 0 else []
+    start = available.index(find_period(groups["start"], available))
+    end = available.index(find_period(groups["end"], available)) if groups.get("end") else len(available) - 1
+    return available[min(start, end):max(start, end) + 1]
+
+
+def select_periods(question, available, periods=None, last=None, max_periods=None):
+    """(period codes oldest first, question to generate SQL for).
+
+    Explicit periods or last (the N most recent periods) win over a range
+    named in the question. Raises PeriodQueryError when there is no range
+    or it is empty or too long.
+    """
+    max_periods = config.PERIOD_MAX_RANGE if max_periods is None else max_periods
+    if periods:
+        codes = sorted({find_period(code, available) for code in periods}, key=period_sort_key)
+    elif last is not None:
+        if last < 1:
+            raise PeriodQueryError(f"last_periods must be at least 1, not {last}")
+        codes = available[-last:]
+    else:
+        codes = parse_period_range(question, available)
+    if codes is None:
+        raise PeriodQueryError("No period range in the question: ask e.g. 'over the last 8 weeks', "
+                               "or pass periods or last_periods")
+    if not codes:
+        raise PeriodQueryError("The period range matches no weekly tables")
+    if len(codes) > max_periods:
+        raise PeriodQueryError(f"At most {max_periods} periods per question, the range has {len(codes)}")
+    text = strip_range(question)
+    if not text:
+        raise PeriodQueryError("The question has nothing to ask besides the period range")
+    return codes, text
+
+
+def period_template(sql, this_table):
+    #sql with the current weekly table replaced by TABLE_PLACEHOLDER, to run against any period
+    work, literals = hide_literals(sql)
+    work, replaced = re.subn(r'(?<![\w$])"?' + re.escape(this_table) + r'"?(?![\w$])', TABLE_PLACEHOLDER, work,
+                             flags=re.I)
+    if not replaced:
+        raise PeriodQueryError(f"The generated SQL does not read the weekly table: {sql}")
+    return restore_literals(work, literals)
+
+
+def for_period(template, periodcode):
+    return template.replace(TABLE_PLACEHOLDER, table_for_period(periodcode))
+
+
+def concat_periods(codes, results):
+    #(col_keys, rows) of every period's result with its periodcode in front
+    col_keys = next((list(col_keys) for col_keys, rows in results), [])
+    rows = [(code, *row) for code, (col_keys_, period_rows) in zip(codes, results) for row in period_rows]
+    return [PERIOD_COLUMN, *col_keys], rows
+
+
+_CLAUSE = re.compile(r"\b(select|from|where|group\s+by|having|order\s+by|limit|offset|fetch|window|for)\b", re.I)
+_CLAUSE_ORDER = ("select", "from", "where", "group by", "having", "order by", "limit", "offset")
+_AGGREGATE = re.compile(r"\b(count|sum|min|max|avg)\s*\(", re.I)
+_NOT_SPLITTABLE = re.compile(
+    r"\b(over|union|intersect|except|lateral|with|filter|within|grouping|rollup|cube|tablesample)\b", re.I)
+_WORD = re.compile(r"\b[a-z_][a-z0-9_]*\b", re.I)
+_FUNCTION_CALL = re.compile(r"\b(\w+)\s*\(", re.I)
+_COLUMN_REF = re.compile(r"^(?:\w+\.)?(\w+)$")
+_NUMBER = re.compile(r"^\d+(?:\.\d*)?$")
+_HIDDEN_LITERAL = re.compile(r"^__literal\d+__$")
+_TRAILING_CAST = re.compile(r"^(?P<inner>.+?)\s*::\s*(?P<type>[a-z_]\w*)$", re.I | re.S)
+_CAST_CALL = re.compile(r"^cast\s*\((?P<inner>.+)\s+as\s+(?P<type>[a-z_]\w*)\s*\)$", re.I | re.S)
+#SQL type names whose cast is named after the internal type
+_TYPE_NAMES = {"int": "int4", "integer": "int4", "smallint": "int2", "bigint": "int8", "real": "float4",
+               "float": "float8", "decimal": "numeric", "boolean": "bool", "character": "bpchar", "char": "bpchar"}
+_ALIAS = re.compile(r"^(?P<expr>.*?[\w)\"])\s+(?P<as>as\s+)?(?P<alias>\"[^\"]+\"|[a-z_]\w*)$", re.I | re.S)
+_ORDER_ITEM = re.compile(r"^(?P<expr>.*?)(?P<direction>(?:\s+(?:asc|desc))?(?:\s+nulls\s+(?:first|last))?)$", re.I | re.S)
+_MARKER = re.compile(r"__m(\d+)__")
+_INTERNAL = re.compile(r"^(?:__m\d+__|__literal\d+__|_k\d+)$")
+
+#Words that may appear in merged expressions besides aggregates and group keys
+_MERGE_WORDS = {
+    "and", "or", "not", "case", "when", "then", "else", "end", "null", "is", "in", "between", "like", "ilike", "true",
+    "false", "as", "nullif", "coalesce", "round", "cast", "abs", "greatest", "least", "ceil", "ceiling", "floor",
+    "trunc", "numeric", "decimal", "float", "real", "double", "precision", "integer", "int", "bigint", "smallint",
+    "float4", "float8", "int4", "int8", "text", "varchar",
+}
+#Functions allowed in group keys and outside aggregates
+_SCALAR_CALLS = _MERGE_WORDS | {
+    "lower", "upper", "trim", "initcap", "concat", "length", "substring", "substr", "replace", "date_trunc", "extract",
+    "date_part", "to_char", "split_part", "left", "right",
+}
+
+
+@dataclass(frozen=True)
+class PeriodSplit:
+    """A query split into a per-period partial query and the merge of its results.
+
+    partial (a template with TABLE_PLACEHOLDER) returns the group keys
+    _k0.._kN and the additive measures _c0.._cM of one period. The
+    original select list, HAVING and ORDER BY are re-evaluated over the
+    measures summed across periods, so ratios are derived from the
+    merged counts rather than averaged.
+    """
+    partial: str
+    keys: int
+    measures: tuple  # count, sum, min or max per _c column
+    columns: tuple  # output column names of the original query
+    select: tuple  # merged expression per output column, with __mN__ standing for measure N merged
+    having: str = None
+    order: tuple = ()  # (merged expression, direction)
+    limit: int = None
+    offset: int = 0
+    literals: tuple = ()
+
+
+def _depths(work):
+    #Parenthesis depth at each character; an opening parenthesis counts as inside
+    depth, depths = 0, []
+    for char in work:
+        if char == "(":
+            depth += 1
+        depths.append(depth)
+        if char == ")":
+            depth -= 1
+    return depths
+
+
+def _clauses(work):
+    depths = _depths(work)
+    marks = [(found.start(), found.end(), re.sub(r"\s+", " ", found.group(1).lower()))
+             for found in _CLAUSE.finditer(work) if depths[found.start()] == 0]
+    names = [name for _, _, name in marks]
+    if not marks or marks[0][0] != 0 or any(name not in _CLAUSE_ORDER for name in names):
+        raise _Unmergeable()
+    if names != sorted(set(names), key=_CLAUSE_ORDER.index):
+        raise _Unmergeable()
+    ends = [start for start, _, _ in marks[1:]] + [len(work)]
+    return {name: work[end:next_start].strip() for (start, end, name), next_start in zip(marks, ends)}
+
+
+def _split_list(text):
+    items, depth, start = [], 0, 0
+    for i, char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            items.append(text[start:i].strip())
+            start = i + 1
+    items.append(text[start:].strip())
+    if not all(items):
+        raise _Unmergeable()
+    return items
+
+
+def _same(a, b):
+    return re.sub(r"\s+", "", a).lower() == re.sub(r"\s+", "", b).lower()
+
+
+def _output_name(expr, alias):
+    #The column name Postgres gives a select item: a column, function, CASE or cast names it, any operator does not
+    if alias:
+        return alias[1:-1] if alias.startswith('"') else alias.lower()
+    expr = expr.strip()
+    if _enclosed(expr):
+        return _output_name(expr[1:-1], None)
+    # :: binds tighter than any operator, so a - b::int is not a cast of the whole expression
+    cast = _CAST_CALL.match(expr)
+    if cast is None or matching_paren(expr, expr.index("(")) != len(expr) - 1:
+        cast = _TRAILING_CAST.match(expr)
+    if cast and (cast.re is _CAST_CALL or _operand(cast.group("inner").strip())):
+        # CASE is a weak name, the type wins over it as it does over no name
+        name = _output_name(cast.group("inner"), None)
+        if name not in ("?column?", "case"):
+            return name
+        type_name = cast.group("type").lower()
+        return _TYPE_NAMES.get(type_name, type_name)
+    column = _COLUMN_REF.match(expr)
+    if column and not _NUMBER.match(expr) and not _HIDDEN_LITERAL.match(expr):
+        return column.group(1).lower()
+    call = re.match(r"^(\w+)\s*\(", expr)
+    if call and matching_paren(expr, call.end() - 1) == len(expr) - 1:
+        return call.group(1).lower()
+    return "case" if _whole_case(expr) else "?column?"
+
+
+def _enclosed(expr):
+    return expr.startswith("(") and matching_paren(expr, 0) == len(expr) - 1
+
+
+def _whole_case(expr):
+    #True when expr is one CASE ... END, not CASE ... END + 1
+    depth = 0
+    for found in re.finditer(r"\b(case|end)\b", expr, re.I):
+        if depth == 0 and found.start() != 0:
+            return False
+        depth += 1 if found.group(1).lower() == "case" else -1
+        if depth == 0:
+            return found.end() == len(expr)
+    return False
+
+
+def _operand(expr):
+    #A single operand (column, call, CASE, literal or parenthesized expression) rather than an operator expression
+    call = re.match(r"^(\w+)\s*\(", expr)
+    return bool(_enclosed(expr) or _COLUMN_REF.match(expr) or _whole_case(expr)
+                or (call and matching_paren(expr, call.end() - 1) == len(expr) - 1))
+
+
+def _check_calls(expr):
+    #Functions outside mergeable aggregates must be scalar; anything else may be an aggregate like string_agg
+    if any(name.lower() not in _SCALAR_CALLS for name in _FUNCTION_CALL.findall(expr)):
+        raise _Unmergeable()
+
+
+class _Splitter:
+    #Registry of the keys and measures the partial query has to return
+
+    def __init__(self, literals):
+        self.literals = literals
+        self.keys = []
+        self.measures = []
+
+    def _same(self, a, b):
+        # The same literal gets a new placeholder each time it occurs
+        return _same(restore_literals(a, self.literals), restore_literals(b, self.literals))
+
+    def key(self, expr):
+        _check_calls(expr)
+        for i, known in enumerate(self.keys):
+            if self._same(known, expr):
+                return f"_k{i}"
+        self.keys.append(expr)
+        return f"_k{len(self.keys) - 1}"
+
+    def measure(self, kind, expr):
+        for i, (known_kind, known) in enumerate(self.measures):
+            if known_kind == kind and self._same(known, expr):
+                return f"__m{i}__"
+        self.measures.append((kind, expr))
+        return f"__m{len(self.measures) - 1}__"
+
+    def _aggregate(self, function, argument):
+        #Merged form of function(argument) as a marker expression
+        if re.match(r"\s*distinct\b", argument, re.I) or _AGGREGATE.search(argument):
+            raise _Unmergeable()
+        call = f"{function.upper()}({argument})"
+        if function == "avg":
+            total = self.measure("sum", f"SUM({argument})")
+            count = self.measure("count", f"COUNT({argument})")
+            return f"(CAST({total} AS numeric) / NULLIF({count}, 0))"
+        return self.measure(function, call)
+
+    def merged(self, expr):
+        """expr with aggregates replaced by merged measures and group keys by their columns."""
+        for key_index, key in enumerate(self.keys):
+            if self._same(key, expr):
+                return f"_k{key_index}"
+        parts, position = [], 0
+        for call in _AGGREGATE.finditer(expr):
+            if call.start() < position:
+                raise _Unmergeable()
+            open_paren = call.end() - 1
+            close_paren = matching_paren(expr, open_paren)
+            if close_paren < 0:
+                raise _Unmergeable()
+            parts.append(expr[position:call.start()])
+            parts.append(self._aggregate(call.group(1).lower(), expr[open_paren + 1:close_paren]))
+            position = close_paren + 1
+        parts.append(expr[position:])
+        merged = "".join(parts)
+        # Plain column references outside aggregates must be group keys
+        for key_index, key in enumerate(self.keys):
+            column = _COLUMN_REF.match(key)
+            if column:
+                merged = re.sub(r"(?<![\w.])(?:\w+\.)?" + re.escape(column.group(1)) + r"\b", f"_k{key_index}",
+                                merged, flags=re.I)
+        _check_calls(merged)
+        for word in _WORD.findall(merged):
+            if not _INTERNAL.match(word) and word.lower() not in _MERGE_WORDS:
+                raise _Unmergeable()
+        return merged
+
+
+def _select_items(select):
+    #(expression, alias or None) per item of a select list
+    items = []
+    for item in _split_list(select):
+        found = _ALIAS.match(item)
+        if found and (found.group("as") or found.group("alias").lower() not in _SCALAR_CALLS):
+            items.append((found.group("expr").strip(), found.group("alias")))
+        else:
+            items.append((item, None))
+    return items
+
+
+def output_names(sql):
+    """The column names Postgres gives sql's result, or None when they cannot be derived from the text.
+
+    Covers a single top-level SELECT; * items, scalar subqueries, set
+    operations and CTEs return None.
+    """
+    statement = strip_comments(sql).strip().rstrip(";").strip()
+    work, literals = hide_literals(statement)
+    if ";" in work or "'" in work:
+        return None
+    try:
+        select = _clauses(work)["select"]
+    except (_Unmergeable, KeyError):
+        return None
+    select = re.sub(r"^distinct(?:\s+on\s*\([^)]*\))?\s+", "", select, flags=re.I)
+    if re.search(r"\bselect\b", select, re.I) or re.search(r"(^|,)\s*(\w+\.)?\*", select):
+        return None
+    try:
+        items = _select_items(select)
+    except _Unmergeable:
+        return None
+    return tuple(_output_name(expr, alias) for expr, alias in items)
+
+
+def _split(template):
+    statement = strip_comments(template).strip().rstrip(";").strip()
+    work, literals = hide_literals(statement)
+    if ";" in work or "'" in work or len(re.findall(r"\bselect\b", work, re.I)) != 1:
+        raise _Unmergeable()
+    if _NOT_SPLITTABLE.search(work):
+        raise _Unmergeable()
+    clauses = _clauses(work)
+    select = clauses["select"]
+    distinct = re.match(r"distinct\b", select, re.I) is not None
+    if distinct:
+        select = select[len("distinct"):].strip()
+        if re.match(r"on\b", select, re.I):
+            raise _Unmergeable()
+    if re.search(r"(^|,)\s*(\w+\.)?\*", select):
+        raise _Unmergeable()
+
+    items = _select_items(select)
+    aggregating = any(_AGGREGATE.search(expr) for expr, alias in items)
+    grouped = "group by" in clauses or distinct
+    if not aggregating and not grouped:
+        # Row-level query: nothing to merge
+        raise _Unmergeable()
+    if distinct and aggregating:
+        raise _Unmergeable()
+
+    splitter = _Splitter(literals)
+    by_alias = [(expr, _output_name(expr, alias)) for expr, alias in items if alias]
+    group_items = _split_list(clauses["group by"]) if "group by" in clauses else []
+    if distinct:
+        group_items = [expr for expr, alias in items]
+    for expr in group_items:
+        if expr.isdigit():
+            if not 1 <= int(expr) <= len(items):
+                raise _Unmergeable()
+            expr = items[int(expr) - 1][0]
+        else:
+            # GROUP BY may name an output column
+            expr = next((item_expr for item_expr, alias in by_alias if _same(alias, expr)), expr)
+        if _AGGREGATE.search(expr):
+            raise _Unmergeable()
+        splitter.key(expr)
+    for expr, alias in items:
+        if not _AGGREGATE.search(expr):
+            splitter.key(expr)
+
+    select_merged = tuple(splitter.merged(expr) for expr, alias in items)
+    columns = tuple(_output_name(expr, alias) for expr, alias in items)
+    having = splitter.merged(clauses["having"]) if "having" in clauses else None
+
+    order = []
+    if "order by" in clauses:
+        for item in _split_list(clauses["order by"]):
+            found = _ORDER_ITEM.match(item)
+            expr, direction = found.group("expr").strip(), found.group("direction").strip()
+            if expr.isdigit():
+                if not 1 <= int(expr) <= len(items):
+                    raise _Unmergeable()
+                merged = select_merged[int(expr) - 1]
+            else:
+                # Output column names first, as Postgres resolves them
+                name = expr[1:-1] if expr.startswith('"') and expr.endswith('"') else expr.lower()
+                named = [i for i, (item_expr, alias) in enumerate(items) if alias and _output_name(item_expr, alias) == name]
+                merged = select_merged[named[0]] if named else splitter.merged(expr)
+            order.append((merged, direction))
+
+    limit = offset = None
+    for clause in ("limit", "offset"):
+        if clause in clauses:
+            value = clauses[clause].strip()
+            if clause == "limit" and value.lower() == "all":
+                continue
+            if not value.isdigit():
+                raise _Unmergeable()
+            if clause == "limit":
+                limit = int(value)
+            else:
+                offset = int(value)
+
+    key_list = [f"{expr} AS _k{i}" for i, expr in enumerate(splitter.keys)]
+    measure_list = [f"{expr} AS _c{i}" for i, (kind, expr) in enumerate(splitter.measures)]
+    partial = "SELECT " + ", ".join(key_list + measure_list) + " FROM " + clauses["from"]
+    if "where" in clauses:
+        partial += " WHERE " + clauses["where"]
+    if grouped and splitter.keys:
+        # By position: a key may be a constant, which GROUP BY would read as a position itself
+        partial += " GROUP BY " + ", ".join(str(i + 1) for i in range(len(splitter.keys)))
+    return PeriodSplit(
+        partial=restore_literals(partial, literals),
+        keys=len(splitter.keys),
+        measures=tuple(kind for kind, expr in splitter.measures),
+        columns=columns,
+        select=select_merged,
+        having=having,
+        order=tuple(order),
+        limit=limit,
+        offset=offset or 0,
+        literals=tuple(literals),
+    )
+
+
+def split_for_periods(template):
+    """PeriodSplit for an aggregate query template, or None when only its per-period results make sense.
+
+    Splittable are single SELECTs (joins allowed) whose aggregates are
+    COUNT, SUM, MIN, MAX and AVG without DISTINCT, and whose other output
+    columns are group keys. Row-level queries, windows, subqueries and
+    other aggregates run per period only.
+    """
+    try:
+        return _split(template)
+    except _Unmergeable:
+        return None
+
+
+def _array_type(values, default):
+    #Postgres type of a partial result column, from the Python values the driver returned
+    kinds = {type(value) for value in values if value is not None}
+    if not kinds:
+        return default
+    if kinds == {bool}:
+        return "boolean"
+    if kinds == {int}:
+        return "bigint"
+    if kinds <= {int, Decimal}:
+        return "numeric"
+    if kinds <= {int, float}:
+        return "double precision"
+    if kinds <= {int, float, Decimal}:
+        return "numeric"
+    if kinds == {str}:
+        return "text"
+    if kinds == {datetime}:
+        return "timestamptz" if any(value.tzinfo for value in values if value is not None) else "timestamp"
+    if kinds == {date}:
+        return "date"
+    if kinds == {time}:
+        return "time"
+    raise PeriodQueryError(f"Cannot merge values of type {', '.join(sorted(kind.__name__ for kind in kinds))}")
+
+
+def _merge_expression(kind, index, sql_type):
+    column = f"_c{index}"
+    if kind == "count":
+        return f"CAST(COALESCE(SUM({column}), 0) AS bigint)"
+    if kind == "sum":
+        # Same type as SUM over one period: integer sums stay integers for the original division semantics
+        return f"CAST(SUM({column}) AS {sql_type})"
+    return f"{kind.upper()}({column})"
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def merge_statements(split, codes, results):
+    """(by_period SQL, combined SQL, parameters) merging the partial results of each period.
+
+    Both statements read the partial rows from bound arrays, so they run
+    on the database with the original query's SQL semantics (integer
+    division, NULL ordering, numeric rounding).
+    """
+    width = split.keys + len(split.measures)
+    columns = [[], []] + [[] for _ in range(width)]
+    for seq, (code, (col_keys, rows)) in enumerate(zip(codes, results)):
+        for row in rows:
+            if len(row) != width:
+                raise PeriodQueryError("Partial result does not match the split query")
+            columns[0].append(seq)
+            columns[1].append(code)
+            for i, value in enumerate(row):
+                columns[2 + i].append(value)
+    types = ["integer", "text"]
+    types += [_array_type(values, "text") for values in columns[2:2 + split.keys]]
+    types += [_array_type(values, "bigint" if kind == "count" else "numeric")
+              for kind, values in zip(split.measures, columns[2 + split.keys:])]
+    names = ["_seq", "_period"] + [f"_k{i}" for i in range(split.keys)] + [f"_c{i}" for i in range(len(split.measures))]
+    source = ("unnest(" + ", ".join(f"CAST(:p{i} AS {sql_type}[])" for i, sql_type in enumerate(types))
+              + ") AS partials(" + ", ".join(names) + ")")
+    measure_types = types[2 + split.keys:]
+
+    def fill(expr):
+        expr = _MARKER.sub(lambda found: _merge_expression(split.measures[int(found.group(1))], int(found.group(1)),
+                                                             measure_types[int(found.group(1))]), expr)
+        # Literals go back in with their colons escaped from bind parameter parsing
+        return restore_literals(expr, [literal.replace(":", "\\:") for literal in split.literals])
+
+    select = [fill(expr) for expr in split.select]
+    keys = [f"_k{i}" for i in range(split.keys)]
+    having = f" HAVING {fill(split.having)}" if split.having else ""
+    order = ", ".join(f"{fill(expr)} {direction}".strip() for expr, direction in split.order)
+
+    combined = ("SELECT " + ", ".join(f"{expr} AS {_quote(name)}" for expr, name in zip(select, split.columns))
+                + f" FROM {source}" + (" GROUP BY " + ", ".join(keys) if keys else "") + having
+                + (f" ORDER BY {order}" if order else "")
+                + (f" LIMIT {split.limit}" if split.limit is not None else "")
+                + (f" OFFSET {split.offset}" if split.offset else ""))
+
+    # Per period: the same merge grouped by period, with LIMIT/OFFSET applied within each period
+    ranked = ("SELECT _seq, _period, " + ", ".join(f"{expr} AS _o{i}" for i, expr in enumerate(select))
+              + f", row_number() OVER (PARTITION BY _seq{' ORDER BY ' + order if order else ''}) AS _rank"
+              + f" FROM {source} GROUP BY " + ", ".join(["_seq", "_period"] + keys) + having)
+    window = []
+    if split.offset:
+        window.append(f"_rank > {split.offset}")
+    if split.limit is not None:
+        window.append(f"_rank <= {split.offset + split.limit}")
+    by_period = (f"SELECT _period AS {_quote(PERIOD_COLUMN)}, "
+                 + ", ".join(f"_o{i} AS {_quote(name)}" for i, name in enumerate(split.columns))
+                 + f" FROM ({ranked}) AS ranked" + (" WHERE " + " AND ".join(window) if window else "")
+                 + " ORDER BY _seq, _rank")
+    return by_period, combined, {f"p{i}": values for i, values in enumerate(columns)}
@@ -0,0 +1,136 @@
+#Resolution of the current weekly table from expanded_hts_prep.period
+import re
+import select
+import threading
+import time
+
+import config
+from metrics import span
+
+
+PERIOD_SQL = "SELECT * FROM expanded_hts_prep.period;"
+TABLES_SQL = "SELECT table_name FROM information_schema.tables WHERE table_schema = ANY(current_schemas(false));"
+
+_PERIOD_NUMBERS = re.compile(r"(\d{4})\D*(\d+)")
+
+
+def table_for_period(periodcode):
+    return "expanded_hts_weekly_" + periodcode.lower()
+
+
+def period_sort_key(periodcode):
+    #Chronological order for codes like 2024W32 (year, week), whatever the zero padding
+    found = _PERIOD_NUMBERS.search(str(periodcode))
+    if found is None:
+        return (float("inf"), 0, str(periodcode))
+    return (int(found.group(1)), int(found.group(2)), str(periodcode))
+
+
+def resolve_current_table(db_engine):
+    #Specify current table (generated from is_current table variable in period table)
+    import pandas as pd
+
+    period_df = pd.read_sql(PERIOD_SQL, db_engine)
+    this_period = period_df['periodcode'][period_df['is_current'].astype(bool)].to_string(index=False)
+    return table_for_period(this_period)
+
+
+def resolve_available_periods(db_engine):
+    #Period codes up to and including the current one whose weekly table exists, oldest first
+    import pandas as pd
+
+    period_df = pd.read_sql(PERIOD_SQL, db_engine)
+    tables = set(pd.read_sql(TABLES_SQL, db_engine)["table_name"])
+    current = period_df["periodcode"][period_df["is_current"].astype(bool)]
+    codes = sorted((code for code in period_df["periodcode"] if table_for_period(code) in tables), key=period_sort_key)
+    if len(current):
+        codes = [code for code in codes if period_sort_key(code) <= period_sort_key(current.iloc[0])]
+    return codes
+
+
+class PeriodResolver:
+    """Current weekly table, cached for ttl_seconds instead of read on every request.
+
+    Listeners registered with on_change(callback) are called as
+    callback(old_table, new_table) when the current period flips. If
+    notify_channel is set, a Postgres LISTEN on that channel (raised by a
+    trigger on expanded_hts_prep.period) expires the cached value right away.
+    """
+
+    def __init__(self, db_engine, ttl_seconds=None, notify_channel=None):
+        self._engine = db_engine
+        self.ttl_seconds = config.PERIOD_TTL if ttl_seconds is None else ttl_seconds
+        self.notify_channel = config.PERIOD_NOTIFY_CHANNEL if notify_channel is None else notify_channel
+        self._table = None
+        self._fetched_at = 0.0
+        self._periods = None
+        self._periods_fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._stop_event = threading.Event()
+        self._listen_thread = None
+
+    def on_change(self, callback):
+        self._listeners.append(callback)
+
+    def current_table(self):
+        now = time.time()
+        if self._table is not None and now - self._fetched_at < self.ttl_seconds:
+            return self._table
+        with self._lock:
+            # Another thread may have refreshed while we waited
+            if self._table is not None and time.time() - self._fetched_at < self.ttl_seconds:
+                return self._table
+            with span("period_lookup"):
+                new_table = resolve_current_table(self._engine)
+            old_table, self._table = self._table, new_table
+            self._fetched_at = time.time()
+        if old_table is not None and old_table != new_table:
+            for callback in self._listeners:
+                callback(old_table, new_table)
+        return new_table
+
+    def available_periods(self):
+        #Periods that can be queried, oldest first; cached for ttl_seconds like the current table
+        if self._periods is None or time.time() - self._periods_fetched_at >= self.ttl_seconds:
+            with span("period_lookup"):
+                self._periods = resolve_available_periods(self._engine)
+            self._periods_fetched_at = time.time()
+        return self._periods
+
+    def expire(self):
+        self._fetched_at = 0.0
+        self._periods_fetched_at = 0.0
+
+    def start(self):
+        if self.notify_channel and self._listen_thread is None:
+            self._stop_event.clear()
+            self._listen_thread = threading.Thread(target=self._listen, name="period-listener", daemon=True)
+            self._listen_thread.start()
+        return self
+
+    def close(self):
+        self._stop_event.set()
+        if self._listen_thread is not None:
+            self._listen_thread.join(timeout=5)
+            self._listen_thread = None
+
+    def _listen(self):
+        # A dedicated connection, detached so it does not hold a pool slot
+        conn = self._engine.raw_connection()
+        dbapi_conn = conn.driver_connection
+        conn.detach()
+        try:
+            dbapi_conn.autocommit = True
+            with dbapi_conn.cursor() as cursor:
+                cursor.execute('LISTEN "{}";'.format(self.notify_channel))
+            while not self._stop_event.is_set():
+                if select.select([dbapi_conn], [], [], 1.0) == ([], [], []):
+                    continue
+                dbapi_conn.poll()
+                if dbapi_conn.notifies:
+                    dbapi_conn.notifies.clear()
+                    self.expire()
+                    self.current_table()
+        finally:
+            dbapi_conn.close()
@@ -0,0 +1,162 @@
+#Compact text-to-SQL prompts: static instructions built once, top-k data dictionary columns per question
+import logging
+import threading
+from dataclasses import dataclass
+
+from llama_index.core import QueryBundle, Settings, VectorStoreIndex
+from llama_index.core.prompts import PromptTemplate, PromptType
+from llama_index.core.schema import TextNode
+from llama_index.core.utils import get_tokenizer
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+#Replaces NLSQLRetriever's default template, which asks for SQLResult/Answer lines we never use
+COMPACT_TEXT_TO_SQL_PROMPT = PromptTemplate(
+    "{query_str}\n\n"
+    "Schema ({dialect}):\n{schema}\n\n"
+    "SQLQuery: ",
+    prompt_type=PromptType.TEXT_TO_SQL,
+)
+
+#Condensed from the original custom_txt2sql_prompt, keeping only what shapes the SQL
+INSTRUCTIONS = """Write one SQL query against table {tablename} that answers the question. Output only the SQL.
+- Use only the columns listed; if a needed column is missing, reply: I'm not sure.
+- Select only the columns needed. Order multi-row answers from highest to lowest unless told otherwise.
+- Default to averages for aggregation if the question does not specify one.
+- For a proportion, rate or percentage return both the counts and the ratio (count * 100.0 / group count); skip groupings that would divide by zero.
+- Positive tests have finalhivtestresult = 'Positive'; negative, missing or null results count as negative. Positivity rate = positives / all tests in the group.
+- Negative tests are those where either test1_result OR confirmatory_result is 'No'.
+Examples:
+Q: In what states were the positivity rates highest excluding states with a rate of 100%?
+SQL: SELECT stateofresidence, COUNT(*) AS TotalTests, SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) AS TotalPositives, SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) * 100.0 / COUNT(*) AS PositivityRate FROM {tablename} GROUP BY stateofresidence HAVING SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) * 100.0 / COUNT(*) < 100 ORDER BY PositivityRate DESC;
+Q: What is the proportion of clients offered Prep who accepted Prep?
+SQL: SELECT SUM(CASE WHEN prepoffered = 'Yes' THEN 1 ELSE 0 END) AS TotalOfferedPrep, SUM(CASE WHEN prepoffered = 'Yes' AND prepaccepted = 'Yes' THEN 1 ELSE 0 END) AS TotalAcceptedPrep, SUM(CASE WHEN prepoffered = 'Yes' AND prepaccepted = 'Yes' THEN 1 ELSE 0 END) * 100.0 / NULLIF(SUM(CASE WHEN prepoffered = 'Yes' THEN 1 ELSE 0 END), 0) AS ProportionAcceptedPrep FROM {tablename};"""
+
+_OPTIONAL_FIELDS = ("synonyms", "relatedTerms", "references", "tags")
+
+
+def column_line(row):
+    #One compact line per data dictionary row; empty optional fields are left out
+    line = row["name"]
+    if row.get("displayName") and row["displayName"] != row["name"]:
+        line += f" ({row['displayName']})"
+    line += ": " + " ".join(row["description"].split())
+    for field in _OPTIONAL_FIELDS:
+        if row.get(field):
+            line += f" [{field}: {row[field]}]"
+    return line
+
+
+@dataclass
+class BuiltPrompt:
+    text: str  # query_str handed to NLSQLRetriever
+    prompt_tokens: int  # tokens of the fully rendered prompt, schema included
+    columns: list
+
+
+class PromptBuilder:
+    """Builds the per-question prompt within a token budget.
+
+    Column descriptions come from a vector index over the data dictionary
+    rows, so only the top_k most relevant are sent, most relevant first,
+    for as long as they fit in token_budget. Only the column section is
+    trimmed: the instructions, schema and question are always sent whole,
+    and a prompt they alone push past the budget is counted as over_budget.
+    embeddings (column line -> vector, see index_snapshot.py) are used
+    instead of embedding those lines again.
+    """
+
+    def __init__(self, data_dict, embed_model=None, top_k=None, token_budget=None, embeddings=None):
+        self.rows = [row for row in data_dict.values() if row.get("name")]
+        self.embed_model = embed_model
+        self.embeddings = embeddings or {}
+        self.top_k = config.PROMPT_TOP_K_COLUMNS if top_k is None else top_k
+        self.token_budget = config.PROMPT_TOKEN_BUDGET if token_budget is None else token_budget
+        self._tokenize = get_tokenizer()
+        self._retriever = None
+        self._lines = {row["name"]: column_line(row) for row in self.rows}
+        self._line_tokens = {name: self.count_tokens(line) for name, line in self._lines.items()}
+        self._static = {}
+        self._lock = threading.Lock()
+        self._counters = {"prompts": 0, "prompt_tokens": 0, "max_prompt_tokens": 0, "over_budget": 0}
+
+    def count_tokens(self, text):
+        return len(self._tokenize(text))
+
+    def compact_columns(self):
+        return "\n".join(self._lines.values())
+
+    def _column_retriever(self):
+        if self._retriever is None:
+            with self._lock:
+                if self._retriever is None:
+                    nodes = [TextNode(text=self._lines[row["name"]], id_=row["name"], metadata={"name": row["name"]},
+                                      embedding=self.embeddings.get(self._lines[row["name"]]))
+                             for row in self.rows]
+                    index = VectorStoreIndex(nodes, embed_model=self.embed_model or Settings.embed_model)
+                    self._retriever = index.as_retriever(similarity_top_k=self.top_k)
+        return self._retriever
+
+    def warm(self):
+        self._column_retriever()
+        return self
+
+    def column_lines(self):
+        return list(self._lines.values())
+
+    def static_for(self, this_table, schema_str, dialect):
+        #Instructions plus schema for one table, rendered and counted once
+        key = (this_table, schema_str, dialect)
+        static = self._static.get(key)
+        if static is None:
+            instructions = INSTRUCTIONS.format(tablename=this_table)
+            overhead = COMPACT_TEXT_TO_SQL_PROMPT.format(query_str=instructions, schema=schema_str, dialect=dialect)
+            static = (instructions, self.count_tokens(overhead))
+            if static[1] > self.token_budget:
+                logger.warning("instructions and schema for %s take %d tokens, over the %d token budget; "
+                               "no columns will be sent", this_table, static[1], self.token_budget)
+            self._static = {key: static}
+        return static
+
+    def relevant_columns(self, question, embedding=None):
+        bundle = QueryBundle(query_str=question, embedding=embedding)
+        return [node.node.metadata["name"] for node in self._column_retriever().retrieve(bundle)]
+
+    def build(self, question, this_table, schema_str, dialect, embedding=None):
+        instructions, used = self.static_for(this_table, schema_str, dialect)
+        question_part = f"Question: {question}"
+        used += self.count_tokens(question_part) + 8  # + separators and the column heading
+        columns = []
+        for name in self.relevant_columns(question, embedding):
+            if used + self._line_tokens[name] > self.token_budget:
+                break
+            columns.append(name)
+            used += self._line_tokens[name]
+
+        parts = [instructions]
+        if columns:
+            parts.append("Relevant columns:\n" + "\n".join(self._lines[name] for name in columns))
+        parts.append(question_part)
+        text = "\n\n".join(parts)
+        prompt_tokens = self.count_tokens(COMPACT_TEXT_TO_SQL_PROMPT.format(query_str=text, schema=schema_str, dialect=dialect))
+
+        with self._lock:
+            self._counters["prompts"] += 1
+            self._counters["prompt_tokens"] += prompt_tokens
+            self._counters["max_prompt_tokens"] = max(self._counters["max_prompt_tokens"], prompt_tokens)
+            if prompt_tokens > self.token_budget:
+                self._counters["over_budget"] += 1
+        logger.info("prompt_tokens=%d columns=%s", prompt_tokens, ",".join(columns))
+        return BuiltPrompt(text=text, prompt_tokens=prompt_tokens, columns=columns)
+
+    def stats(self):
+        with self._lock:
+            prompts = self._counters["prompts"]
+            return {
+                **self._counters,
+                "mean_prompt_tokens": round(self._counters["prompt_tokens"] / prompts, 1) if prompts else 0.0,
+                "token_budget": self.token_budget,
+            }
@@ -0,0 +1,241 @@
+#Two-tier cache from question to generated SQL: exact (normalized text) then embedding similarity
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import config
+
+
+_PUNCTUATION = re.compile(r"[^\w\s%]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    #Case, punctuation and spacing do not change the SQL we would generate
+    question = _PUNCTUATION.sub(" ", question.lower())
+    return _WHITESPACE.sub(" ", question).strip()
+
+
+def unit_vector(embedding):
+    #float32 numpy copy scaled to length 1, so cosine similarity is a dot product; None for a zero vector
+    import numpy as np  # deferred with the other heavy imports, see query.py
+
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+@dataclass
+class CacheEntry:
+    this_table: str
+    question: str
+    sql: str
+    embedding: list = None
+    created_at: float = field(default_factory=time.time)
+
+
+@dataclass
+class CacheLookup:
+    sql: str = None
+    kind: str = None  # "exact", "semantic" or None on a miss
+    similarity: float = None
+    embedding: list = None  # computed on a semantic lookup, reused by put()
+
+    @property
+    def hit(self):
+        return self.sql is not None
+
+
+class QuestionCache:
+    """LRU + TTL cache of generated SQL, partitioned by the current weekly table.
+
+    embed_fn maps a question to an embedding vector; without it only exact
+    matches are served. A semantic lookup is one matrix-vector product over
+    the table's unit-length embeddings, stacked once per change to that
+    table and scored outside the lock.
+    """
+
+    def __init__(self, embed_fn=None, similarity_threshold=None, max_entries=None,
+                 ttl_seconds=None, persist_path=None):
+        self.embed_fn = embed_fn
+        self.similarity_threshold = config.QUESTION_CACHE_THRESHOLD if similarity_threshold is None else similarity_threshold
+        self.max_entries = config.QUESTION_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.ttl_seconds = config.QUESTION_CACHE_TTL if ttl_seconds is None else ttl_seconds
+        self.persist_path = config.QUESTION_CACHE_PATH if persist_path is None else persist_path
+        self._entries = OrderedDict()
+        self._vectors = {}  # key -> unit_vector(entry.embedding)
+        self._matrices = {}  # this_table -> (keys, created_at, matrix), rebuilt after the table changes
+        self._versions = {}  # this_table -> changes so far, so a matrix stacked outside the lock is not stored stale
+        self._lock = threading.Lock()
+        self._counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        if self.persist_path:
+            self.load()
+
+    def _expired(self, entry, now):
+        return self.ttl_seconds > 0 and now - entry.created_at > self.ttl_seconds
+
+    def _store(self, key, entry):
+        #Add or replace an entry; call with the lock held
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        vector = unit_vector(entry.embedding) if entry.embedding is not None else None
+        if vector is None:
+            self._vectors.pop(key, None)
+        else:
+            self._vectors[key] = vector
+        self._changed(key[0])
+
+    def _remove(self, key):
+        #Call with the lock held
+        self._entries.pop(key, None)
+        self._vectors.pop(key, None)
+        self._changed(key[0])
+
+    def _changed(self, this_table):
+        self._versions[this_table] = self._versions.get(this_table, 0) + 1
+        self._matrices.pop(this_table, None)
+
+    def _evict(self):
+        #Drop the least recently used entries over max_entries; call with the lock held
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self._counters["evictions"] += 1
+
+    def _matrix(self, this_table):
+        #(keys, created_at, matrix) of this_table's embedded entries; stacking happens outside the lock
+        import numpy as np
+
+        with self._lock:
+            cached = self._matrices.get(this_table)
+            if cached is not None:
+                return cached
+            version = self._versions.get(this_table, 0)
+            rows = [(key, self._entries[key].created_at, vector) for key, vector in self._vectors.items()
+                    if key[0] == this_table]
+        if not rows:
+            return None
+        keys, created_at, vectors = zip(*rows)
+        cached = (keys, np.array(created_at), np.stack(vectors))
+        with self._lock:
+            if self._versions.get(this_table, 0) == version:
+                self._matrices[this_table] = cached
+        return cached
+
+    def embed(self, question):
+        if self.embed_fn is None:
+            return None
+        return self.embed_fn(normalize_question(question))
+
+    def has_exact(self, question, this_table):
+        #Uncounted peek, lets callers skip computing an embedding they will not need
+        key = (this_table, normalize_question(question))
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._expired(entry, time.time())
+
+    def get(self, question, this_table, embedding=None):
+        #embedding may be precomputed with embed() to overlap it with other work
+        key = (this_table, normalize_question(question))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry, now):
+                    self._entries.move_to_end(key)
+                    self._counters["exact_hits"] += 1
+                    return CacheLookup(sql=entry.sql, kind="exact", similarity=1.0)
+                self._remove(key)
+                self._counters["expirations"] += 1
+
+        if self.embed_fn is None:
+            with self._lock:
+                self._counters["misses"] += 1
+            return CacheLookup()
+
+        # Embed and score outside the lock, the embedding may be a network call
+        if embedding is None:
+            embedding = self.embed_fn(key[1])
+        best_key, best_score = self._best_match(embedding, this_table, now)
+        with self._lock:
+            entry = self._entries.get(best_key) if best_key is not None else None
+            # The entry may have been evicted or replaced while scoring
+            if entry is not None and best_score >= self.similarity_threshold:
+                self._entries.move_to_end(best_key)
+                self._counters["semantic_hits"] += 1
+                return CacheLookup(sql=entry.sql, kind="semantic", similarity=best_score, embedding=embedding)
+            self._counters["misses"] += 1
+        return CacheLookup(embedding=embedding)
+
+    def _best_match(self, embedding, this_table, now):
+        #(key, cosine similarity) of this_table's closest unexpired entry, or (None, None)
+        import numpy as np
+
+        query = unit_vector(embedding)
+        snapshot = self._matrix(this_table)
+        if query is None or snapshot is None:
+            return None, None
+        keys, created_at, matrix = snapshot
+        scores = matrix @ query
+        if self.ttl_seconds > 0:
+            scores[now - created_at > self.ttl_seconds] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] == -np.inf:
+            return None, None
+        return keys[best], float(scores[best])
+
+    def put(self, question, this_table, sql, embedding=None):
+        normalized = normalize_question(question)
+        if embedding is None and self.embed_fn is not None:
+            embedding = self.embed_fn(normalized)
+        entry = CacheEntry(this_table=this_table, question=normalized, sql=sql,
+                           embedding=list(embedding) if embedding is not None else None)
+        with self._lock:
+            self._store((this_table, normalized), entry)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._vectors.clear()
+            self._matrices.clear()
+            for this_table in self._versions:
+                self._versions[this_table] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = sum(self._counters[k] for k in ("exact_hits", "semantic_hits", "misses"))
+            hits = self._counters["exact_hits"] + self._counters["semantic_hits"]
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def load(self):
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        with open(self.persist_path, 'r') as file:
+            records = json.load(file)
+        now = time.time()
+        with self._lock:
+            for record in records:
+                entry = CacheEntry(**record)
+                if not self._expired(entry, now):
+                    self._store((entry.this_table, entry.question), entry)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def save(self):
+        if not self.persist_path:
+            return
+        with self._lock:
+            records = [entry.__dict__ for entry in self._entries.values()]
+        # Write to a temp file first so a crash never leaves a truncated cache
+        tmp_path = self.persist_path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(records, file)
+        os.replace(tmp_path, self.persist_path)
@@ -0,0 +1,226 @@
+#Optional local replica of the current weekly table: a Parquet snapshot queried in-process with DuckDB
+import fcntl
+import glob
+import logging
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import inspect
+
+import config
+from metrics import record_cache, span
+from multi_period import output_names
+
+
+logger = logging.getLogger(__name__)
+
+#Postgres column types DuckDB reads from CSV as-is; anything else is loaded as VARCHAR
+_DUCKDB_TYPES = ("smallint", "integer", "bigint", "numeric", "decimal", "real", "double precision", "float",
+                 "boolean", "date", "timestamp", "time", "varchar", "text", "char", "uuid")
+
+#Match Postgres semantics where DuckDB differs by default
+_SESSION_SETTINGS = ("SET integer_division = true",)
+_DATABASE_SETTINGS = {"default_null_order": "nulls_last_on_asc_first_on_desc"}
+
+#SELECT * lists the table's columns, which are named the same in both engines
+_SELECT_STAR = re.compile(r"^\s*select\s+(?:distinct\s+)?\*\s+from\b", re.I)
+
+
+def replica_available():
+    try:
+        import duckdb  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def duckdb_type(pg_type):
+    name = str(pg_type).lower()
+    for known in _DUCKDB_TYPES:
+        if name.startswith(known):
+            return "TIMESTAMP" if name.startswith("timestamp") else name.upper()
+    return "VARCHAR"
+
+
+@contextmanager
+def _file_lock(path):
+    #Exclusive across processes, so one uvicorn worker exports while the others wait and reuse the file
+    with open(path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class LocalReplica:
+    """Runs generated SQL against a local columnar snapshot of the weekly table.
+
+    prepare(table) exports the table once with COPY into a Parquet file
+    under directory (shared by all workers on the host), then exposes it
+    to an in-process DuckDB as a view of the same name. Queries read the
+    file through the OS page cache, so workers share one copy of the
+    data. run_sql returns None when DuckDB cannot run a query, and the
+    caller falls back to Postgres.
+    """
+
+    def __init__(self, db_engine, directory=None, threads=None, keep_snapshots=None):
+        import duckdb
+
+        self._duckdb = duckdb
+        self._engine = db_engine
+        self.directory = config.REPLICA_DIR if directory is None else directory
+        self.keep_snapshots = config.REPLICA_KEEP_SNAPSHOTS if keep_snapshots is None else keep_snapshots
+        os.makedirs(self.directory, exist_ok=True)
+        self._db = duckdb.connect(":memory:", config={
+            "threads": config.REPLICA_THREADS if threads is None else threads, **_DATABASE_SETTINGS})
+        self._ready = set()
+        self._building = set()
+        self._lock = threading.Lock()
+        self._counters = {"local": 0, "fallbacks": 0, "timeouts": 0, "snapshots": 0, "snapshot_failures": 0}
+
+    def snapshot_path(self, table):
+        return os.path.join(self.directory, f"{table}.parquet")
+
+    def has(self, table):
+        return table in self._ready
+
+    def prepare(self, table, wait=False):
+        #Snapshot (or pick up the existing snapshot of) table, in a background thread unless wait
+        with self._lock:
+            if table in self._ready or table in self._building:
+                return
+            self._building.add(table)
+        if wait:
+            self._prepare(table)
+        else:
+            threading.Thread(target=self._prepare, args=(table,), name="replica-snapshot", daemon=True).start()
+
+    def _prepare(self, table):
+        try:
+            path = self.snapshot_path(table)
+            with _file_lock(path + ".lock"):
+                if not os.path.exists(path):
+                    with span("replica_snapshot"):
+                        self.snapshot(table, path)
+                    self._count("snapshots")
+            self._attach(table, path)
+            self._prune(keep=table)
+            logger.info("Local replica ready for %s (%d bytes)", table, os.path.getsize(path))
+        except Exception:
+            # Queries keep going to Postgres
+            logger.exception("Could not snapshot %s into the local replica", table)
+            self._count("snapshot_failures")
+        finally:
+            with self._lock:
+                self._building.discard(table)
+
+    def snapshot(self, table, path):
+        #COPY the table out as CSV, then convert to Parquet with the Postgres column types
+        columns = inspect(self._engine).get_columns(table)
+        column_types = {column["name"]: duckdb_type(column["type"]) for column in columns}
+        fd, csv_path = tempfile.mkstemp(suffix=".csv", dir=self.directory)
+        try:
+            conn = self._engine.raw_connection()
+            try:
+                with os.fdopen(fd, "w") as csv_file, conn.cursor() as cursor:
+                    # One sequential scan; the export may take longer than DB_STATEMENT_TIMEOUT_MS
+                    cursor.execute("SET LOCAL statement_timeout = 0")
+                    cursor.copy_expert(f"COPY (SELECT * FROM {table}) TO STDOUT WITH (FORMAT csv, HEADER true)",
+                                       csv_file)
+                conn.rollback()
+            finally:
+                conn.close()
+            partial = path + ".partial"
+            db = self._duckdb.connect(":memory:")
+            try:
+                # Postgres CSV writes NULL unquoted and '' quoted; keep them apart
+                db.execute(
+                    f"COPY (SELECT * FROM read_csv(?, header = true, columns = {column_types!r}, "
+                    f"allow_quoted_nulls = false)) TO '{partial}' (FORMAT parquet, COMPRESSION zstd)", [csv_path])
+            finally:
+                db.close()
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(csv_path):
+                os.remove(csv_path)
+
+    def _attach(self, table, path):
+        with self._lock:
+            self._db.execute(f"CREATE OR REPLACE VIEW {table} AS SELECT * FROM read_parquet('{path}')")
+            self._ready.add(table)
+
+    def _prune(self, keep):
+        #Drop all but the newest keep_snapshots snapshots (the one just prepared always stays)
+        snapshots = sorted(glob.glob(os.path.join(self.directory, "*.parquet")), key=os.path.getmtime, reverse=True)
+        keep_path = self.snapshot_path(keep)
+        for path in [p for p in snapshots if p != keep_path][max(self.keep_snapshots - 1, 0):]:
+            table = os.path.basename(path)[:-len(".parquet")]
+            with self._lock:
+                if table in self._ready:
+                    self._db.execute(f"DROP VIEW IF EXISTS {table}")
+                    self._ready.discard(table)
+            os.remove(path)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def run_sql(self, sql, row_limit=None, timeout_ms=None):
+        """(col_keys, rows, truncated) for sql, or None if DuckDB cannot run it.
+
+        At most row_limit rows are returned; truncated says whether more
+        were available. Raises TimeoutError when the query runs past
+        timeout_ms (DB_STATEMENT_TIMEOUT_MS by default).
+        """
+        timeout_ms = config.DB_STATEMENT_TIMEOUT_MS if timeout_ms is None else timeout_ms
+        # DuckDB names unaliased expressions differently (count_star(), the expression text); answers must carry
+        # the column names Postgres would give them, or the JSON keys depend on which engine ran the query
+        names = output_names(sql)
+        if names is None and not _SELECT_STAR.match(sql):
+            return self._fallback("output column names unknown")
+        cursor = self._db.cursor()
+        timer = threading.Timer(timeout_ms / 1000, cursor.interrupt) if timeout_ms > 0 else None
+        try:
+            for setting in _SESSION_SETTINGS:
+                cursor.execute(setting)
+            if timer is not None:
+                timer.start()
+            with span("replica_execute"):
+                cursor.execute(sql)
+                col_keys = [column[0] for column in cursor.description]
+                if names is not None:
+                    if len(names) != len(col_keys):
+                        return self._fallback("output column names unknown")
+                    col_keys = list(names)
+                rows = cursor.fetchmany(row_limit) if row_limit else cursor.fetchall()
+                truncated = bool(row_limit) and bool(cursor.fetchmany(1))
+        except self._duckdb.InterruptException:
+            self._count("timeouts")
+            raise TimeoutError(f"Query was cancelled after {timeout_ms} ms")
+        except self._duckdb.Error as e:
+            # Postgres-only syntax or functions: the caller runs it remotely instead
+            return self._fallback(e)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            cursor.close()
+        self._count("local")
+        record_cache("replica", "hit")
+        return col_keys, [tuple(row) for row in rows], truncated
+
+    def _fallback(self, reason):
+        logger.info("Local replica cannot run query (%s), falling back to Postgres", reason)
+        self._count("fallbacks")
+        record_cache("replica", "fallback")
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "tables": sorted(self._ready), "directory": self.directory}
+
+    def close(self):
+        self._db.close()
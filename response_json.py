@@ -0,0 +1,41 @@
+#JSON response bodies encoded straight from result rows, with orjson when it is installed
+import json
+
+from streaming import json_default
+
+try:
+    import orjson
+except ImportError:  # optional; the json module gives the same output, slower
+    orjson = None
+
+
+class RawJSON:
+    """Already encoded JSON, inserted as is by encode_object()."""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+
+def orjson_available():
+    return orjson is not None
+
+
+def dumps(value):
+    #Compact UTF-8 JSON bytes; decimals as floats, dates and times in ISO format
+    if orjson is not None:
+        return orjson.dumps(value, default=json_default)
+    return json.dumps(value, default=json_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def encode_records(col_keys, rows):
+    #[{column: value}, ...] for rows as the cursor returned them, without a DataFrame in between
+    return dumps([dict(zip(col_keys, row)) for row in rows])
+
+
+def encode_object(fields):
+    #JSON object in the order of fields; RawJSON values are spliced in without encoding them again
+    parts = [dumps(key) + b":" + (value.data if isinstance(value, RawJSON) else dumps(value))
+             for key, value in fields.items()]
+    return b"{" + b",".join(parts) + b"}"
@@ -0,0 +1,85 @@
+#Cache of query results, keyed by the normalized SQL and the weekly table it ran against
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+import config
+
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    #Whitespace and trailing semicolons only; case matters inside string literals
+    return _WHITESPACE.sub(" ", sql).strip().rstrip(";").strip()
+
+
+def estimate_size(col_keys, rows):
+    size = sys.getsizeof(rows) + sum(sys.getsizeof(key) for key in col_keys)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
+
+
+class ResultCache:
+    """LRU cache of (col_keys, rows) bounded by an estimate of their memory use.
+
+    Weekly tables are immutable once loaded, so entries never go stale on
+    their own and results of past periods stay useful to multi-period
+    questions. Nothing is invalidated when the current period changes; the
+    least recently used entries go first when the cache is full.
+    """
+
+    def __init__(self, max_bytes=None, max_entry_bytes=None):
+        self.max_bytes = config.RESULT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_entry_bytes = config.RESULT_CACHE_MAX_ENTRY_BYTES if max_entry_bytes is None else max_entry_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "skipped_too_large": 0}
+
+    def get(self, sql, this_table):
+        key = (this_table, normalize_sql(sql))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            col_keys, rows, size = entry
+            return col_keys, rows
+
+    def put(self, sql, this_table, col_keys, rows):
+        col_keys, rows = list(col_keys), [tuple(row) for row in rows]
+        size = estimate_size(col_keys, rows)
+        if size > self.max_entry_bytes:
+            with self._lock:
+                self._counters["skipped_too_large"] += 1
+            return
+        key = (this_table, normalize_sql(sql))
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[2]
+            self._entries[key] = (col_keys, rows, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                self._bytes -= self._entries.popitem(last=False)[1][2]
+                self._counters["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hit_rate": round(self._counters["hits"] / lookups, 4) if lookups else 0.0,
+            }
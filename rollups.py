@@ -0,0 +1,293 @@
+#Pre-aggregated rollups of the current weekly table and routing of generated SQL onto them
+import logging
+import re
+import threading
+from dataclasses import dataclass
+
+from sqlalchemy import inspect, text
+
+import config
+from metrics import record, record_cache, span
+from sql_guard import strip_comments
+
+
+logger = logging.getLogger(__name__)
+
+#Count column of every rollup: raw rows behind each group
+ROWS_COLUMN = "rollup_rows"
+
+#Categorical data dictionary columns the generated SQL filters on or computes rates from; kept in every rollup
+MEASURE_COLUMNS = ("finalhivtestresult", "prepoffered", "prepaccepted")
+
+
+@dataclass(frozen=True)
+class RollupSpec:
+    name: str  # suffix of the rollup table name
+    dimensions: tuple  # data dictionary columns to group by, besides MEASURE_COLUMNS
+
+
+#Positivity by state and sex, PrEP by key population, counts by facility
+ROLLUPS = (
+    RollupSpec("by_state", ("stateofresidence", "sex", "targetgroup")),
+    RollupSpec("by_facility", ("datimcode", "state", "lga", "sex")),
+    RollupSpec("by_population", ("targetgroup", "sex", "testingsetting", "firsttimevisit", "previouslytested",
+                                 "indexclient")),
+)
+
+
+@dataclass(frozen=True)
+class Rollup:
+    name: str  # rollup table
+    source: str  # weekly table it summarizes
+    columns: frozenset
+    rows: int
+
+
+@dataclass(frozen=True)
+class RoutedQuery:
+    sql: str
+    rollup: Rollup
+
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDER = re.compile(r"__literal(\d+)__")
+_WORD = re.compile(r"\b[a-z_][a-z0-9_]*\b", re.I)
+_FUNCTION_CALL = re.compile(r"\b(\w+)\s*\(", re.I)
+_NOT_ROUTABLE = re.compile(r"\b(join|over|union|intersect|except|lateral|with|filter|within|tablesample)\b", re.I)
+_STAR_SELECT = re.compile(r"\bselect\s+(distinct\s+)?\*|\w\.\*", re.I)
+_AGGREGATING = re.compile(r"\b(count|sum|min|max)\s*\(|\bgroup\s+by\b|\bselect\s+distinct\b", re.I)
+_CLAUSE_END = r"(?=\s*(?:\bwhere\b|\bgroup\b|\bhaving\b|\border\b|\blimit\b|\boffset\b|\bfetch\b|$))"
+_NUMBER = re.compile(r"^[-+]?\d+(\.\d+)?$")
+_CASE_VALUE = re.compile(r"\b(?:then|else)\s+([^\s()]+)", re.I)
+
+#Functions (and keywords that can precede a parenthesis) whose result is the same over rollup rows
+_SAFE_CALLS = {
+    "count", "sum", "min", "max", "nullif", "coalesce", "round", "cast", "abs", "lower", "upper", "trim", "greatest",
+    "least", "numeric", "decimal", "float", "real", "in", "and", "or", "not", "as", "then", "else", "when", "case",
+    "where", "having", "on", "by", "between", "like", "ilike", "is", "end", "select", "distinct",
+}
+
+
+def hide_literals(sql):
+    #(sql with string literals replaced by __literalN__ placeholders, the literals), so keywords in strings do not count
+    literals = []
+
+    def hide(match):
+        literals.append(match.group(0))
+        return f"__literal{len(literals) - 1}__"
+
+    return _LITERAL.sub(hide, sql), literals
+
+
+def restore_literals(work, literals):
+    return _PLACEHOLDER.sub(lambda match: literals[int(match.group(1))], work)
+
+
+def matching_paren(sql, start):
+    #Index of the parenthesis closing the one at start
+    depth = 0
+    for i in range(start, len(sql)):
+        if sql[i] == "(":
+            depth += 1
+        elif sql[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+
+def _rewrite_aggregate(function, argument):
+    #Aggregate over rollup rows equal to function(argument) over the raw rows, or None if there is none
+    arg = argument.strip()
+    if re.search(r"\b(count|sum)\s*\(", arg, re.I):
+        return None
+    if function == "count":
+        if arg in ("*", "1"):
+            return f"COALESCE(SUM({ROWS_COLUMN}), 0)"
+        if re.match(r"distinct\b", arg, re.I):
+            return f"COUNT({arg})"
+        return f"COALESCE(SUM(CASE WHEN ({arg}) IS NOT NULL THEN {ROWS_COLUMN} ELSE 0 END), 0)"
+    # SUM of a constant or of CASE WHEN ... THEN <number> ELSE <number> END: weight it by the group size
+    if _NUMBER.match(arg):
+        return f"SUM({arg} * {ROWS_COLUMN})"
+    if re.match(r"case\b", arg, re.I) and re.search(r"\bend$", arg, re.I) and len(re.findall(r"\bcase\b", arg, re.I)) == 1:
+        if all(_NUMBER.match(value) for value in _CASE_VALUE.findall(arg)):
+            return f"SUM(({arg}) * {ROWS_COLUMN})"
+    return None
+
+
+def _unaliased_item(work, start, end):
+    #True when work[start:end] is a whole select list item without an alias
+    before, after = work[:start].rstrip(), work[end:].lstrip()
+    return bool((before.endswith(",") or re.search(r"\bselect(\s+distinct)?$", before, re.I))
+                and (after.startswith(",") or re.match(r"from\b", after, re.I)))
+
+
+def rewrite_for_rollup(sql, table, source_columns, rollups):
+    """SQL answering sql from the smallest fitting rollup, as (sql, rollup), or None.
+
+    Only single-table aggregations are rewritten: COUNT, COUNT(DISTINCT),
+    SUM of constant CASE expressions, MIN and MAX, with every referenced
+    column present in the rollup. Anything else stays on the raw table.
+    """
+    statement = strip_comments(sql).strip().rstrip(";").strip()
+    if ";" in statement or "$" in statement:
+        return None
+    work, literals = hide_literals(statement)
+    if "'" in work or len(re.findall(r"\bselect\b", work, re.I)) != 1:
+        return None
+    if _NOT_ROUTABLE.search(work) or _STAR_SELECT.search(work) or not _AGGREGATING.search(work):
+        return None
+    if any(name.lower() not in _SAFE_CALLS for name in _FUNCTION_CALL.findall(work)):
+        return None
+
+    # FROM must name only the weekly table, optionally schema-qualified and aliased
+    table_ref = re.compile(
+        r"\bfrom\s+((?:\w+\.)?\"?" + re.escape(table) + r"\"?)(\s+(?:as\s+)?(?!where\b|group\b|having\b|order\b|limit\b"
+        r"|offset\b|fetch\b)\w+)?" + _CLAUSE_END, re.I)
+    found = table_ref.search(work)
+    if found is None or len(re.findall(r"\bfrom\b", work, re.I)) != 1:
+        return None
+
+    referenced = {word.lower() for word in _WORD.findall(work)} & source_columns
+    candidates = [rollup for rollup in rollups if referenced <= rollup.columns]
+    if not candidates:
+        return None
+    rollup = min(candidates, key=lambda candidate: candidate.rows)
+
+    parts, position = [], 0
+    for call in re.finditer(r"\b(count|sum)\s*\(", work, re.I):
+        if call.start() < position:
+            return None
+        open_paren = call.end() - 1
+        close_paren = matching_paren(work, open_paren)
+        if close_paren < 0:
+            return None
+        rewritten = _rewrite_aggregate(call.group(1).lower(), work[open_paren + 1:close_paren])
+        if rewritten is None:
+            return None
+        parts.append(work[position:call.start()])
+        parts.append(rewritten)
+        # COALESCE(SUM(...)) would be named coalesce; an unaliased COUNT(...) select item keeps its name
+        if rewritten.startswith("COALESCE") and _unaliased_item(work, call.start(), close_paren + 1):
+            parts.append(" AS count")
+        position = close_paren + 1
+    parts.append(work[position:])
+    work = "".join(parts)
+
+    # The FROM clause is untouched by the aggregate rewrites; find it again in the rewritten text
+    found = table_ref.search(work)
+    work = work[:found.start(1)] + rollup.name + work[found.end(1):]
+    return restore_literals(work, literals), rollup
+
+
+class RollupManager:
+    """Builds rollup tables for each weekly table and routes queries onto them.
+
+    Each RollupSpec becomes <weekly table>_<name>, grouped by the spec's
+    dimensions and MEASURE_COLUMNS (those the table has) with the raw row
+    count per group. Rollups are built in the background when a table is
+    prepared and are only used once built; an existing rollup (e.g. from
+    another worker) is reused. Rollups not much smaller than their
+    source are not worth routing to and are left unused.
+    """
+
+    def __init__(self, db_engine, specs=ROLLUPS, max_ratio=None, enabled=None):
+        self._engine = db_engine
+        self.specs = specs
+        self.max_ratio = config.ROLLUP_MAX_RATIO if max_ratio is None else max_ratio
+        self.enabled = config.ROLLUPS_ENABLED if enabled is None else enabled
+        self._ready = {}  # weekly table -> (source columns, [Rollup])
+        self._building = set()
+        self._lock = threading.Lock()
+        self._counters = {"routed": 0, "not_routed": 0, "build_failures": 0}
+
+    def prepare(self, table, wait=False):
+        #Build (or pick up) the rollups of table, in a background thread unless wait
+        if not self.enabled:
+            return
+        with self._lock:
+            if table in self._ready or table in self._building:
+                return
+            self._building.add(table)
+        if wait:
+            self._build_all(table)
+        else:
+            threading.Thread(target=self._build_all, args=(table,), name="rollup-build", daemon=True).start()
+
+    def _build_all(self, table):
+        try:
+            with span("rollup_build"):
+                source_columns = {column["name"].lower() for column in inspect(self._engine).get_columns(table)}
+                source_rows = self._count(table)
+                rollups = []
+                for spec in self.specs:
+                    rollup = self.build(spec, table, source_columns)
+                    if rollup is None:
+                        continue
+                    if source_rows and rollup.rows > source_rows * self.max_ratio:
+                        logger.info("Not routing to %s: %d rows for %d source rows", rollup.name, rollup.rows, source_rows)
+                        continue
+                    rollups.append(rollup)
+            with self._lock:
+                self._ready[table] = (source_columns, rollups)
+            logger.info("Rollups ready for %s: %s", table, ", ".join(f"{r.name} ({r.rows} rows)" for r in rollups))
+        except Exception:
+            # No CREATE permission, table gone, ...: queries keep running on the raw table
+            logger.exception("Could not build rollups for %s", table)
+            with self._lock:
+                self._counters["build_failures"] += 1
+        finally:
+            with self._lock:
+                self._building.discard(table)
+
+    def _count(self, table):
+        with self._engine.connect() as conn:
+            return conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+
+    def build(self, spec, table, source_columns):
+        columns = [column for column in spec.dimensions + MEASURE_COLUMNS if column in source_columns]
+        if not any(column in source_columns for column in spec.dimensions):
+            return None
+        name = f"{table}_{spec.name}"
+        column_list = ", ".join(columns)
+        with self._engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                # Sessions are read-only by default (DB_READ_ONLY); serialize builds across workers.
+                # The build is one scan of the week, it is allowed to outlast DB_STATEMENT_TIMEOUT_MS
+                conn.execute(text("SET TRANSACTION READ WRITE"))
+                conn.execute(text("SET LOCAL statement_timeout = 0"))
+                conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+            if not inspect(conn).has_table(name):
+                conn.execute(text(
+                    f"CREATE TABLE {name} AS SELECT {column_list}, CAST(COUNT(*) AS integer) AS {ROWS_COLUMN} "
+                    f"FROM {table} GROUP BY {column_list}"))
+            rows = conn.execute(text(f"SELECT COUNT(*) FROM {name}")).scalar()
+        return Rollup(name=name, source=table, columns=frozenset(columns), rows=rows)
+
+    def rollups_for(self, table):
+        ready = self._ready.get(table)
+        return ready[1] if ready is not None else []
+
+    def route(self, sql, table):
+        #RoutedQuery when a built rollup can answer sql, else None
+        ready = self._ready.get(table)
+        if ready is None or not ready[1]:
+            return None
+        source_columns, rollups = ready
+        rewritten = rewrite_for_rollup(sql, table, source_columns, rollups)
+        with self._lock:
+            self._counters["routed" if rewritten is not None else "not_routed"] += 1
+        record_cache("rollup", "miss" if rewritten is None else "hit")
+        if rewritten is None:
+            return None
+        record("rollup_table", rewritten[1].name)
+        return RoutedQuery(sql=rewritten[0], rollup=rewritten[1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                "enabled": self.enabled,
+                "tables": {table: [r.name for r in rollups] for table, (columns, rollups) in self._ready.items()},
+            }
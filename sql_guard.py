@@ -0,0 +1,241 @@
+#Execution guard between SQL generation and execution: read-only check, EXPLAIN cost gate, LIMIT injection
+import json
+import logging
+import re
+import threading
+from dataclasses import dataclass
+
+from sqlalchemy import exc, text
+
+import config
+from metrics import record, span
+
+
+logger = logging.getLogger(__name__)
+
+#Postgres SQLSTATE for a statement cancelled by statement_timeout
+QUERY_CANCELED = "57014"
+
+#String literals (incl. dollar quoting), quoted identifiers and comments, so keywords inside them are not matched
+_TOKENS = re.compile(
+    r"(?P<literal>'(?:[^']|'')*'|\$(?P<tag>\w*)\$.*?\$(?P=tag)\$)"
+    r"|(?P<identifier>\"(?:[^\"]|\"\")*\")"
+    r"|(?P<comment>--[^\n]*|/\*.*?\*/)",
+    re.S,
+)
+#A single statement starting with SELECT/WITH/VALUES/TABLE can only write through a data-modifying WITH query or
+#SELECT INTO; other statements cannot nest in it, so their keywords are harmless aliases or column names there
+_NESTED_WRITE = re.compile(
+    r"\(\s*(insert(?=\s+into\b)|delete(?=\s+from\b)|merge(?=\s+into\b)"
+    r"|update(?=\s+(?:only\s+)?[\w.\"]+(?:\s+(?:as\s+)?\w+)?\s+set\b))",
+    re.I,
+)
+#INTO, except as an alias (AS into) or a qualified column name (t.into)
+_SELECT_INTO = re.compile(r"(?P<label>\bas\s+|\.\s*)?\binto\b", re.I)
+_FORBIDDEN_FUNCTIONS = re.compile(
+    r"\b(pg_sleep\w*|pg_terminate_backend|pg_cancel_backend|pg_reload_conf|pg_rotate_logfile|pg_read_\w*file"
+    r"|pg_ls_\w+|pg_stat_file|lo_\w+|dblink\w*|set_config|pg_advisory\w*|nextval|setval)\s*\(",
+    re.I,
+)
+_ROW_LOCK = re.compile(r"\b(for\s+(?:no\s+key\s+)?(?:update|share|key\s+share))\b", re.I)
+_TRAILING_LIMIT = re.compile(
+    r"\b(?:limit\s+(?P<limit>\d+|all)(?:\s+offset\s+\d+)?|offset\s+\d+\s+limit\s+(?P<limit2>\d+|all)"
+    r"|fetch\s+(?:first|next)\s+(?P<fetch>\d+)?\s*rows?\s+only)\s*$",
+    re.I,
+)
+
+
+class QueryRejected(Exception):
+    """Generated SQL that was refused before, or cancelled during, execution.
+
+    to_dict() is the structured error /query returns.
+    """
+
+    def __init__(self, reason, message, query=None, status_code=422, **details):
+        super().__init__(message)
+        self.reason = reason
+        self.query = query
+        self.status_code = status_code
+        self.details = details
+
+    def to_dict(self):
+        return {"error": self.reason, "message": str(self), "query": self.query, **self.details}
+
+
+@dataclass
+class GuardedQuery:
+    sql: str  # what will actually run
+    original: str
+    cost: float = None  # planner Total Cost, None when EXPLAIN was skipped
+    plan_rows: int = None
+    limit: int = None  # injected LIMIT, None when the query runs as generated
+
+    @property
+    def limited(self):
+        return self.limit is not None
+
+
+def _scrub(sql, keep_literals=False):
+    #Drop comments; unless keep_literals, also blank out literal and quoted identifier contents
+    def replace(match):
+        if match.group("comment") is not None:
+            return " "
+        if keep_literals:
+            return match.group(0)
+        return "''" if match.group("literal") is not None else '""'
+    return _TOKENS.sub(replace, sql)
+
+
+def strip_comments(sql):
+    return _scrub(sql, keep_literals=True)
+
+
+def check_read_only(sql):
+    """Raise QueryRejected unless sql is a single SELECT (or WITH ... SELECT) statement.
+
+    Returns the statement without comments or a trailing semicolon, ready
+    to be wrapped or have a LIMIT appended. This catches mistakes early with
+    a clear message; the read-only transactions of DB_READ_ONLY are what
+    actually stop writes.
+    """
+    statement = strip_comments(sql).strip().rstrip(";").strip()
+    bare = _scrub(statement)
+    if not bare.strip():
+        raise QueryRejected("empty_query", "The model did not produce a SQL query", query=sql)
+    if ";" in bare:
+        raise QueryRejected("multiple_statements", "Only a single SQL statement can be run", query=sql)
+    first_word = re.match(r"[\s(]*(\w+)", bare)
+    if first_word is None or first_word.group(1).lower() not in ("select", "with", "values", "table"):
+        raise QueryRejected("not_read_only", "Only SELECT queries can be run", query=sql)
+    for pattern, what in ((_NESTED_WRITE, "statement"), (_FORBIDDEN_FUNCTIONS, "function"), (_ROW_LOCK, "row lock")):
+        found = pattern.search(bare)
+        if found is not None:
+            name = " ".join(found.group(1).split()).upper()
+            raise QueryRejected("not_read_only", f"Query uses the {what} {name}, which is not allowed", query=sql)
+    if any(found.group("label") is None for found in _SELECT_INTO.finditer(bare)):
+        raise QueryRejected("not_read_only", "Query uses SELECT INTO, which is not allowed", query=sql)
+    return statement
+
+
+def trailing_limit(statement):
+    #The statement's own top-level row limit: None when there is none, 0 for LIMIT ALL
+    found = _TRAILING_LIMIT.search(_scrub(statement))
+    if found is None:
+        return None
+    value = found.group("limit") or found.group("limit2") or found.group("fetch") or "1"
+    return 0 if value.lower() == "all" else int(value)
+
+
+def inject_limit(statement, limit):
+    #LIMIT at most `limit` rows, leaving a smaller existing limit alone
+    existing = trailing_limit(statement)
+    if existing is None:
+        return f"{statement}\nLIMIT {limit}"
+    if 0 < existing <= limit:
+        return statement
+    # Rewriting the existing clause in place is fragile, wrapping keeps the query intact
+    return f"SELECT * FROM (\n{statement}\n) AS limited_result\nLIMIT {limit}"
+
+
+def statement_timeout(sql):
+    return QueryRejected(
+        "statement_timeout", f"Query was cancelled after {config.DB_STATEMENT_TIMEOUT_MS} ms", query=sql,
+        status_code=504, timeout_ms=config.DB_STATEMENT_TIMEOUT_MS)
+
+
+def timeout_rejection(error, sql):
+    #QueryRejected for an error caused by statement_timeout, else None; follows SQLDatabase's wrapping
+    while error is not None:
+        if isinstance(error, exc.DBAPIError) and getattr(error.orig, "pgcode", None) == QUERY_CANCELED:
+            return statement_timeout(sql)
+        error = error.__cause__
+    return None
+
+
+class SqlGuard:
+    """Checks generated SQL before it reaches the warehouse.
+
+    Rejects anything but a single read-only SELECT, asks the planner for
+    cost and row estimates (Postgres only), refuses plans costlier than
+    max_cost and adds a LIMIT to queries expected to return more than
+    row_limit rows. Estimates can be wrong, so callers also stop reading
+    after row_limit rows.
+    """
+
+    def __init__(self, db_engine, max_cost=None, row_limit=None, enabled=None):
+        self._engine = db_engine
+        self.max_cost = config.SQL_MAX_COST if max_cost is None else max_cost
+        self.row_limit = config.SQL_ROW_LIMIT if row_limit is None else row_limit
+        self.enabled = config.SQL_GUARD_ENABLED if enabled is None else enabled
+        self._lock = threading.Lock()
+        self._counters = {"checked": 0, "rejected": 0, "limited": 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def explain(self, sql):
+        #(total cost, estimated rows) of the top plan node
+        try:
+            with self._engine.connect() as conn:
+                plan = conn.execute(text("EXPLAIN (FORMAT JSON) " + sql)).scalar()
+        except exc.DBAPIError as e:
+            rejected = timeout_rejection(e, sql)
+            if rejected is not None:
+                raise rejected from e
+            # Unknown columns, syntax errors: the planner's first line is what is worth showing
+            message = str(e.orig).strip().splitlines()[0] if e.orig is not None else str(e)
+            raise QueryRejected("invalid_sql", message, query=sql) from e
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        top = plan[0]["Plan"]
+        return top["Total Cost"], top["Plan Rows"]
+
+    def check(self, sql, row_limit=None, plan=True):
+        """Return the GuardedQuery to run for sql, or raise QueryRejected.
+
+        With plan=False only the read-only check is done, for engines that
+        bound the result themselves (the local replica).
+        """
+        if not self.enabled:
+            return GuardedQuery(sql=sql, original=sql)
+        row_limit = self.row_limit if row_limit is None else row_limit
+        self._count("checked")
+        try:
+            with span("sql_guard"):
+                guarded = self._check(sql, row_limit, plan)
+        except QueryRejected as e:
+            self._count("rejected")
+            record("sql_rejected", e.reason)
+            logger.warning("Rejected generated SQL (%s): %s\n%s", e.reason, e, sql)
+            raise
+        if guarded.limited:
+            self._count("limited")
+            record("row_limit", guarded.limit)
+            logger.info("Limited generated SQL to %d rows (planner expected %d)", guarded.limit, guarded.plan_rows)
+        return guarded
+
+    def _check(self, sql, row_limit, plan):
+        statement = check_read_only(sql)
+        guarded = GuardedQuery(sql=statement, original=sql)
+        # EXPLAIN output and its cost units are Postgres specific
+        if not plan or self._engine is None or self._engine.dialect.name != "postgresql":
+            return guarded
+
+        guarded.cost, guarded.plan_rows = self.explain(statement)
+        if row_limit and guarded.plan_rows > row_limit:
+            limited_sql = inject_limit(statement, row_limit)
+            if limited_sql != statement:
+                guarded.sql, guarded.limit = limited_sql, row_limit
+                guarded.cost, _ = self.explain(limited_sql)
+        if self.max_cost and guarded.cost > self.max_cost:
+            raise QueryRejected(
+                "cost_exceeded",
+                f"Query is too expensive to run (planner cost {guarded.cost:.0f}, limit {self.max_cost:.0f})",
+                query=sql, cost=guarded.cost, max_cost=self.max_cost, plan_rows=guarded.plan_rows)
+        return guarded
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return {**counters, "enabled": self.enabled, "max_cost": self.max_cost, "row_limit": self.row_limit}
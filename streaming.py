@@ -0,0 +1,172 @@
+#Streaming /query bodies: batched rows from a server-side cursor, capped, as NDJSON or Arrow IPC
+import datetime
+import decimal
+import itertools
+import json
+import uuid
+
+from sqlalchemy import text
+
+import config
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+class RowStream:
+    """Fixed-size batches of a query result, stopping after row_cap rows.
+
+    Reads from a server-side cursor so only one batch is in memory at a
+    time. Built with rows= it replays an already materialized result (e.g.
+    from the result cache) through the same interface.
+    """
+
+    def __init__(self, db_engine, sql, batch_size=None, row_cap=None, columns=None, rows=None):
+        self._engine = db_engine
+        self.sql = sql
+        self.batch_size = batch_size or config.STREAM_BATCH_SIZE
+        self.row_cap = min(row_cap or config.STREAM_ROW_CAP, config.STREAM_ROW_CAP)
+        self.columns = list(columns) if columns is not None else None
+        self._rows = rows
+        self._conn = None
+        self._result = None
+        self._fetch = None
+        self.row_count = 0
+        self.truncated = False
+
+    def open(self):
+        if self._rows is not None:
+            iterator = iter(self._rows)
+            self._fetch = lambda n: list(itertools.islice(iterator, n))
+            return self
+        self._conn = self._engine.connect().execution_options(stream_results=True, max_row_buffer=self.batch_size)
+        self._result = self._conn.execute(text(self.sql))
+        self.columns = list(self._result.keys())
+        self._fetch = self._result.fetchmany
+        return self
+
+    def next_batch(self):
+        #Returns the next list of row tuples, or [] when the result or the cap is exhausted
+        remaining = self.row_cap - self.row_count
+        if self._fetch is None:
+            return []
+        if remaining <= 0:
+            # Only look one row past the cap to know whether we cut anything off
+            self.truncated = bool(self._fetch(1))
+            self._fetch = None
+            return []
+        batch = [tuple(row) for row in self._fetch(min(self.batch_size, remaining))]
+        if not batch:
+            self._fetch = None
+        self.row_count += len(batch)
+        return batch
+
+    def close(self):
+        self._fetch = None
+        if self._result is not None:
+            self._result.close()
+            self._result = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def summary(self):
+        return {"row_count": self.row_count, "truncated": self.truncated, "row_cap": self.row_cap}
+
+
+def json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (uuid.UUID, datetime.timedelta)):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _ndjson_line(record):
+    return (json.dumps(record, default=json_default) + "\n").encode()
+
+
+async def ndjson_body(meta, stream, batches):
+    #One meta line up front, one line per batch, a summary line with truncation at the end
+    yield _ndjson_line({"type": "meta", **meta, "columns": stream.columns, "row_cap": stream.row_cap})
+    async for batch in batches:
+        yield _ndjson_line({"type": "rows", "rows": batch})
+    yield _ndjson_line({"type": "end", **stream.summary()})
+
+
+def arrow_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _arrow_column(pa, values, arrow_type=None):
+    values = [float(v) if isinstance(v, decimal.Decimal) else v for v in values]
+    return pa.array(values, type=arrow_type)
+
+
+class _ChunkSink:
+    #Write-only file object that hands back whatever was written since the last drain()
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def arrow_body(meta, stream, batches):
+    #Arrow IPC stream; meta is in the schema metadata, the summary on a trailing empty batch
+    import pyarrow as pa
+
+    sink = _ChunkSink()
+    schema_metadata = {key: json.dumps(value, default=json_default)
+                       for key, value in {**meta, "row_cap": stream.row_cap}.items()}
+    schema = None
+    writer = None
+
+    async for batch in batches:
+        columns = list(zip(*batch))
+        if schema is None:
+            arrays = [_arrow_column(pa, values) for values in columns]
+            # A column that is all null in the first batch is typed as nullable text
+            schema = pa.schema([pa.field(name, pa.string() if array.type == pa.null() else array.type)
+                                for name, array in zip(stream.columns, arrays)], metadata=schema_metadata)
+            writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+        arrays = [_arrow_column(pa, values, field.type) for values, field in zip(columns, schema)]
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+
+    if schema is None:
+        schema = pa.schema([pa.field(name, pa.string()) for name in stream.columns or []], metadata=schema_metadata)
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+    empty = pa.RecordBatch.from_arrays([pa.array([], type=field.type) for field in schema], schema=schema)
+    writer.write_batch(empty, custom_metadata={key: json.dumps(value) for key, value in stream.summary().items()})
+    writer.close()
+    yield sink.drain()
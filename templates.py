@@ -0,0 +1,247 @@
+#Deterministic fast path: known question shapes are answered from SQL templates without calling the LLM
+import re
+import threading
+from dataclasses import dataclass, field
+
+import config
+
+
+#Dictionary column names that mean another column in questions: "state" is the state of residence, as in the
+#prompt's examples, and the facility's is "facility state"; likewise for "lga"
+NAME_OVERRIDES = {
+    "state": "stateofresidence",
+    "lga": "lgaofresidence",
+}
+
+#Column terms the data dictionary does not list yet (its synonyms column is empty); the dictionary's own names and
+#synonyms win over these
+EXTRA_SYNONYMS = {
+    "state of residence": "stateofresidence",
+    "residence state": "stateofresidence",
+    "psnu": "stateofresidence",
+    "facility state": "state",
+    "lga of residence": "lgaofresidence",
+    "local government area": "lgaofresidence",
+    "facility lga": "lga",
+    "facility code": "datimcode",
+    "datim code": "datimcode",
+    "gender": "sex",
+    "key population": "targetgroup",
+    "key population group": "targetgroup",
+    "key population target group": "targetgroup",
+    "target group": "targetgroup",
+    "population": "targetgroup",
+    "testing setting": "testingsetting",
+    "setting": "testingsetting",
+    "referral source": "referredfrom",
+    "referred from": "referredfrom",
+    "referral": "referredfrom",
+    "marital status": "maritalstatus",
+    "counseling type": "counselingtype",
+    "counselling type": "counselingtype",
+}
+
+#Columns that are identifiers, dates or free counts, not something to group a rate by
+NOT_GROUPABLE = {"clientcode", "dateofbirth", "datevisit", "period", "period_start_date", "numberofcondomsgiven",
+                 "numberoflubricantsgiven", "numberofchildren", "numberofwives"}
+
+#Yes/no conditions a proportion can be built from: phrase -> (SQL condition, label, column)
+CONDITIONS = {
+    "offered prep": ("prepoffered = 'Yes'", "OfferedPrep", "prepoffered"),
+    "accepted prep": ("prepaccepted = 'Yes'", "AcceptedPrep", "prepaccepted"),
+    "tested positive": ("finalhivtestresult = 'Positive'", "Positive", "finalhivtestresult"),
+    "positive": ("finalhivtestresult = 'Positive'", "Positive", "finalhivtestresult"),
+}
+
+_CONDITION_PHRASES = "|".join(sorted(CONDITIONS, key=len, reverse=True))
+_POSITIVE = "SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END)"
+
+_GROUP_MARKERS = re.compile(
+    r"\b(for each|for every|in each|in every|broken down by|grouped by|split by|per|across|among|by)\b")
+_FILLER = {
+    "what", "whats", "which", "is", "are", "was", "were", "the", "show", "me", "give", "list", "please", "of", "a",
+    "an", "all", "tell", "find", "get", "calculate", "compute", "return", "their", "there", "do", "does", "have", "has",
+    "had", "with", "clients", "individuals", "people", "persons", "patients", "those", "them", "current", "respective",
+    "its", "from", "sorted", "ordered", "order", "in",
+}
+_WORD_NUMBERS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9,
+                 "ten": 10, "twenty": 20}
+
+
+@dataclass(frozen=True)
+class SqlTemplate:
+    name: str
+    pattern: object  # compiled regex over the normalized question
+    sql: str  # format string: {table}, {dim}, {order}, ... from the slots
+    columns: tuple = ()  # columns the template itself needs, besides the matched dimension
+
+
+TEMPLATES = (
+    SqlTemplate(
+        "positivity_rate_by_dimension",
+        re.compile(r"(?:(?P<dir>highest|lowest) )?(?:hiv )?positivity rates? by (?P<dim>.+?)"
+                   r"(?: (?P<dir2>highest|lowest)(?: to (?:highest|lowest))?(?: first)?)?"),
+        "SELECT {dim}, COUNT(*) AS TotalTests, " + _POSITIVE + " AS TotalPositives, "
+        + _POSITIVE + " * 100.0 / COUNT(*) AS PositivityRate FROM {table} GROUP BY {dim} ORDER BY PositivityRate {order};",
+        ("finalhivtestresult",),
+    ),
+    SqlTemplate(
+        "dimension_by_positivity_rate",
+        re.compile(r"(?P<dim>.+?) (?P<dir>highest|lowest) (?:hiv )?positivity rates?"),
+        "SELECT {dim}, COUNT(*) AS TotalTests, " + _POSITIVE + " AS TotalPositives, "
+        + _POSITIVE + " * 100.0 / COUNT(*) AS PositivityRate FROM {table} GROUP BY {dim} ORDER BY PositivityRate {order};",
+        ("finalhivtestresult",),
+    ),
+    SqlTemplate(
+        "proportion_by_dimension",
+        re.compile(r"(?:proportion|percentage|percent|share|rate) (?P<a>" + _CONDITION_PHRASES + r") (?:who )?"
+                   r"(?P<b>" + _CONDITION_PHRASES + r")(?: by (?P<dim>.+?))?"),
+        "SELECT {select_dim}SUM(CASE WHEN {a} THEN 1 ELSE 0 END) AS Total{a_label}, "
+        "SUM(CASE WHEN {a} AND {b} THEN 1 ELSE 0 END) AS Total{b_label}, "
+        "SUM(CASE WHEN {a} AND {b} THEN 1 ELSE 0 END) * 100.0 / NULLIF(SUM(CASE WHEN {a} THEN 1 ELSE 0 END), 0) "
+        "AS Proportion{b_label} FROM {table}{group_by} ORDER BY Proportion{b_label} {order};",
+    ),
+    SqlTemplate(
+        "top_n_by_positives",
+        # Only with an explicit N: without one the LLM decides whether to cut the list at all
+        re.compile(r"(?:(?:top|(?P<dir>highest|lowest|bottom)) )?(?P<n>\d+|" + "|".join(_WORD_NUMBERS) + r") "
+                   r"(?P<dim>.+?) (?:by|(?P<dir2>most|fewest)) (?:number )?(?:hiv )?"
+                   r"(?:positives|positive tests|positive results|positive cases)"),
+        "SELECT {dim}, " + _POSITIVE + " AS TotalPositives FROM {table} GROUP BY {dim} "
+        "ORDER BY TotalPositives {order} LIMIT {n};",
+        ("finalhivtestresult",),
+    ),
+    SqlTemplate(
+        "tests_by_dimension",
+        re.compile(r"(?:how many|number|count|total) (?:hiv )?tests(?: conducted| done)? by (?P<dim>.+?)"),
+        "SELECT {dim}, COUNT(*) AS TotalTests FROM {table} GROUP BY {dim} ORDER BY TotalTests DESC;",
+    ),
+)
+
+
+def normalize_question(question):
+    #Lowercase words only, group markers folded into "by", filler words dropped
+    text = re.sub(r"[^a-z0-9%]+", " ", question.lower())
+    text = _GROUP_MARKERS.sub("by", text)
+    return " ".join(word for word in text.split() if word not in _FILLER)
+
+
+@dataclass
+class TemplateMatch:
+    """A question answered by a template; stands in for a question cache lookup."""
+    sql: str
+    template: str
+    slots: dict = field(default_factory=dict)
+    kind: str = "template"
+    embedding: list = None
+
+    @property
+    def hit(self):
+        return True
+
+
+class TemplateMatcher:
+    """Maps questions onto TEMPLATES using the data dictionary's column terms.
+
+    The whole normalized question has to fit a template and every slot has
+    to resolve (a known column, condition or number); anything else
+    returns None and goes to the LLM.
+    """
+
+    def __init__(self, data_dict, templates=TEMPLATES, enabled=None):
+        self.templates = templates
+        self.enabled = config.TEMPLATES_ENABLED if enabled is None else enabled
+        self.terms = self._column_terms(data_dict)
+        self._lock = threading.Lock()
+        self._counters = {"matched": 0, "unmatched": 0}
+        self._by_template = {}
+
+    @staticmethod
+    def _column_terms(data_dict):
+        terms = {}
+        for row in data_dict.values():
+            column = row.get("name")
+            if not column:
+                continue
+            for phrase in (column, row.get("displayName") or ""):
+                if normalize_question(phrase):
+                    terms.setdefault(normalize_question(phrase), column)
+            for phrase in re.split(r"[,;|]", row.get("synonyms") or ""):
+                if normalize_question(phrase):
+                    terms[normalize_question(phrase)] = column
+        terms.update(NAME_OVERRIDES)
+        for phrase, column in EXTRA_SYNONYMS.items():
+            terms.setdefault(phrase, column)
+        return terms
+
+    def column_for(self, phrase):
+        phrase = phrase.strip()
+        column = self.terms.get(phrase)
+        if column is None and phrase.endswith("ies"):
+            column = self.terms.get(phrase[:-3] + "y")
+        if column is None and phrase.endswith("s"):
+            column = self.terms.get(phrase[:-1])
+        return column
+
+    def _slots(self, template, found, this_table, columns):
+        groups = {key: value for key, value in found.groupdict().items() if value}
+        direction = groups.get("dir") or groups.get("dir2")
+        slots = {"table": this_table, "order": "ASC" if direction in ("lowest", "bottom", "fewest") else "DESC"}
+        needed = set(template.columns)
+        if "dim" in groups:
+            dim = self.column_for(groups["dim"])
+            if dim is None or dim in NOT_GROUPABLE:
+                return None
+            slots["dim"] = dim
+            needed.add(dim)
+        if "a" in groups:
+            a, b = CONDITIONS.get(groups["a"]), CONDITIONS.get(groups["b"])
+            if a is None or b is None:
+                return None
+            slots.update(a=a[0], a_label=a[1], b=b[0], b_label=b[1])
+            needed.update((a[2], b[2]))
+            slots["select_dim"] = f"{slots['dim']}, " if "dim" in slots else ""
+            slots["group_by"] = f" GROUP BY {slots['dim']}" if "dim" in slots else ""
+        if "n" in groups:
+            n = groups["n"]
+            slots["n"] = int(n) if n.isdigit() else _WORD_NUMBERS[n]
+        if columns is not None and not needed <= columns:
+            return None
+        return slots
+
+    def match(self, question, this_table, columns=None, count=True):
+        """TemplateMatch for question against this_table (whose columns are columns), or None.
+
+        count=False leaves the hit-rate counters alone, for look-ahead checks.
+        """
+        if not self.enabled:
+            return None
+        text = normalize_question(question)
+        for template in self.templates:
+            found = template.pattern.fullmatch(text)
+            if found is None:
+                continue
+            slots = self._slots(template, found, this_table, columns)
+            if slots is None:
+                continue
+            if not count:
+                return TemplateMatch(sql=template.sql.format(**slots), template=template.name)
+            with self._lock:
+                self._counters["matched"] += 1
+                self._by_template[template.name] = self._by_template.get(template.name, 0) + 1
+            return TemplateMatch(sql=template.sql.format(**slots), template=template.name,
+                                 slots={k: v for k, v in slots.items() if k != "table"})
+        if count:
+            with self._lock:
+                self._counters["unmatched"] += 1
+        return None
+
+    def stats(self):
+        with self._lock:
+            total = self._counters["matched"] + self._counters["unmatched"]
+            return {
+                **self._counters,
+                "hit_rate": round(self._counters["matched"] / total, 3) if total else 0.0,
+                "by_template": dict(self._by_template),
+                "enabled": self.enabled,
+            }
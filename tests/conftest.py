@@ -0,0 +1,21 @@
+#The modules under test are top-level files in the repository root
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def warehouse():
+    #Engine on a local Postgres loaded with the fixture; tests using it skip unless DB_TRANSPORT=direct
+    if os.environ.get("DB_TRANSPORT") != "direct":
+        pytest.skip("needs a local Postgres: DB_TRANSPORT=direct DB_HOST=... DB_USER=... DB_PASSWORD=... DB_NAME=...")
+    from benchmarks.fixture import dictionary_columns, load_fixture, week_codes
+    from connection import ConnectionManager
+
+    connections = ConnectionManager(check_interval=0).start()
+    load_fixture(connections.engine, rows=2000, periods=week_codes(4), columns=dictionary_columns())
+    yield connections.engine
+    connections.close()
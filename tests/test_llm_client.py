@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+import pytest
+
+from benchmarks.stubs import StubLLM
+from llm_client import CircuitBreaker, LLMTimeout, LLMUnavailable, ResilientLLM
+
+
+RESET = 0.05
+
+
+def resilient(primary, fallback=None, deadline=0.1, **kwargs):
+    llm = ResilientLLM(primary, fallback=fallback, deadline=deadline, hedge=False, retries=0, **kwargs)
+    for model in (llm._primary, llm._fallback):
+        if model is not None:
+            model.breaker.failure_threshold = 2
+            model.breaker.reset_timeout = RESET
+    return llm
+
+
+def test_breaker_trial_released_without_outcome():
+    breaker = CircuitBreaker("stub", failure_threshold=1, reset_timeout=RESET)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(RESET)
+    permit = breaker.allow()
+    assert permit == "trial"
+    assert not breaker.allow()
+    breaker.release(permit)
+    assert breaker.allow() == "trial"
+
+
+def test_timeouts_open_the_breaker_and_a_trial_recovers_it():
+    primary = StubLLM(latency=0.5)
+    llm = resilient(primary)
+    breaker = llm._primary.breaker
+    for _ in range(2):
+        with pytest.raises(LLMTimeout):
+            llm.complete("question")
+    assert breaker.state == "open"
+    with pytest.raises(LLMUnavailable):
+        llm.complete("question")
+
+    # The trial times out too: open again, and the slot is free for the next trial
+    time.sleep(RESET)
+    assert breaker.state == "half_open"
+    with pytest.raises(LLMTimeout):
+        llm.complete("question")
+    assert breaker.state == "open"
+
+    primary.latency = 0.0
+    time.sleep(RESET)
+    assert llm.complete("question").text.startswith("SQLQuery:")
+    assert breaker.stats()["state"] == "closed"
+    assert breaker.stats()["consecutive_failures"] == 0
+
+
+def test_cancelled_trial_does_not_wedge_the_breaker():
+    primary = StubLLM(latency=0.5)
+    llm = resilient(primary, deadline=1.0)
+    breaker = llm._primary.breaker
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(RESET)
+
+    async def cancelled_trial():
+        task = asyncio.ensure_future(llm.acomplete("question"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancelled_trial())
+    assert breaker.state == "half_open"
+    primary.latency = 0.0
+    assert asyncio.run(llm.acomplete("question")).text.startswith("SQLQuery:")
+    assert breaker.state == "closed"
+
+
+def test_timed_out_primary_falls_back_within_the_deadline():
+    llm = resilient(StubLLM(latency=1.0), fallback=StubLLM(latency=0.0), deadline=0.4, fallback_reserve=0.2)
+    started = time.monotonic()
+    assert llm.complete("question").text.startswith("SQLQuery:")
+    assert time.monotonic() - started < 0.4
+    assert llm._primary.breaker.stats()["consecutive_failures"] == 1
+    assert asyncio.run(llm.acomplete("question")).text.startswith("SQLQuery:")
+    assert llm.stats()["fallbacks"] == 2
+
+
+def test_stream_complete_yields_the_whole_completion():
+    llm = resilient(StubLLM())
+    chunks = list(llm.stream_complete("question"))
+    assert len(chunks) > 1
+    assert chunks[-1].text == llm.complete("question").text
+    assert "".join(chunk.delta for chunk in chunks) == chunks[-1].text
+
+
+def test_stream_falls_back_when_the_first_chunk_is_late():
+    primary, fallback = StubLLM(latency=0.5), StubLLM(default_sql="SELECT 2")
+    llm = resilient(primary, fallback, deadline=0.2, fallback_reserve=0.1)
+    assert list(llm.stream_complete("question"))[-1].text == "SQLQuery: SELECT 2"
+    assert llm._primary.breaker.stats()["consecutive_failures"] == 1
+    assert llm.stats()["fallbacks"] == 1
+
+
+def test_astream_complete_falls_back():
+    primary, fallback = StubLLM(latency=0.5), StubLLM(default_sql="SELECT 2")
+    llm = resilient(primary, fallback, deadline=0.2, fallback_reserve=0.1)
+
+    async def scenario():
+        return [chunk async for chunk in await llm.astream_complete("question")]
+
+    chunks = asyncio.run(scenario())
+    assert chunks[-1].text == "SQLQuery: SELECT 2"
+    assert llm._primary.breaker.stats()["consecutive_failures"] == 1
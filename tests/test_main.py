@@ -0,0 +1,29 @@
+import json
+from decimal import Decimal
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_batch_rows_are_encoded_like_query(monkeypatch):
+    rows = [{"sex": "Male", "positivity": Decimal("17.857142857142857143")}]
+
+    async def run_batch(async_pipeline, items, write):
+        for item in items:
+            failed = item.question == "bad"
+            write({"id": item.id, "question": item.question, "query": "SELECT 1", "path": "llm",
+                   "rows": None if failed else rows, "error": "ValueError: bad" if failed else None})
+        return {"unique_questions": 2, "succeeded": len(items) - 1, "failed": 1}
+
+    monkeypatch.setattr(main, "run_batch", run_batch)
+    response = TestClient(main.app).post("/query/batch", json={"questions": ["positivity by sex", "bad",
+                                                                            "positivity by sex"]})
+    assert response.status_code == 200
+    body = json.loads(response.content)
+    assert [result["question"] for result in body["results"]] == ["positivity by sex", "bad", "positivity by sex"]
+    assert body["results"][0]["output_df"] == [{"sex": "Male", "positivity": 17.857142857142858}]
+    assert body["results"][2]["output_df"] == body["results"][0]["output_df"]
+    assert body["results"][1] == {"question": "bad", "query": "SELECT 1", "path": "llm", "output_df": None,
+                                  "error": "ValueError: bad"}
+    assert (body["unique_questions"], body["succeeded"], body["failed"]) == (2, 2, 1)
@@ -0,0 +1,105 @@
+import pytest
+
+from benchmarks.verify_periods import PER_PERIOD_ONLY, SPLIT_QUERIES
+from multi_period import (
+    TABLE_PLACEHOLDER, PeriodQueryError, _output_name, for_period, output_names, parse_period_range, period_template,
+    select_periods, split_for_periods)
+
+
+AVAILABLE = ["2024W29", "2024W30", "2024W31", "2024W32"]
+
+
+def test_parse_period_range():
+    assert parse_period_range("positives over the last 2 weeks", AVAILABLE) == ["2024W31", "2024W32"]
+    assert parse_period_range("positives from 2024W30 to 2024W31", AVAILABLE) == ["2024W30", "2024W31"]
+    assert parse_period_range("positives since 2024w31", AVAILABLE) == ["2024W31", "2024W32"]
+    assert parse_period_range("positives by state", AVAILABLE) is None
+
+
+def test_select_periods_explicit_and_last():
+    assert select_periods("positives by state", AVAILABLE, periods=["2024W32", "2024W30"]) == (
+        ["2024W30", "2024W32"], "positives by state")
+    assert select_periods("positives by state", AVAILABLE, last=3)[0] == AVAILABLE[1:]
+    assert select_periods("positives by state over the last 2 weeks", AVAILABLE)[0] == AVAILABLE[2:]
+
+
+@pytest.mark.parametrize("last", [0, -1])
+def test_select_periods_rejects_non_positive_last(last):
+    with pytest.raises(PeriodQueryError):
+        select_periods("positives by state", AVAILABLE, last=last)
+
+
+def test_select_periods_limits():
+    with pytest.raises(PeriodQueryError):
+        select_periods("positives by state", AVAILABLE)
+    with pytest.raises(PeriodQueryError):
+        select_periods("positives by state", AVAILABLE, last=4, max_periods=3)
+    with pytest.raises(PeriodQueryError):
+        select_periods("positives by state", AVAILABLE, periods=["2023W01"])
+
+
+def test_period_template():
+    template = period_template("SELECT COUNT(*) FROM expanded_hts_weekly_2024w32 WHERE x = 'expanded_hts_weekly_2024w32'",
+                               "expanded_hts_weekly_2024w32")
+    assert template == "SELECT COUNT(*) FROM " + TABLE_PLACEHOLDER + " WHERE x = 'expanded_hts_weekly_2024w32'"
+    assert "expanded_hts_weekly_2024w30" in for_period(template, "2024W30")
+    with pytest.raises(PeriodQueryError):
+        period_template("SELECT 1", "expanded_hts_weekly_2024w32")
+
+
+@pytest.mark.parametrize("template", SPLIT_QUERIES)
+def test_aggregations_split(template):
+    split = split_for_periods(template)
+    assert split is not None
+    assert TABLE_PLACEHOLDER in split.partial
+
+
+@pytest.mark.parametrize("template", PER_PERIOD_ONLY)
+def test_other_shapes_are_not_split(template):
+    assert split_for_periods(template) is None
+
+
+def test_split_keeps_postgres_output_names():
+    split = split_for_periods("SELECT sex, MAX(age) - MIN(age), COUNT(*) AS n, (SUM(age)) FROM {table} GROUP BY sex")
+    assert split.columns == ("sex", "?column?", "n", "sum")
+
+
+@pytest.mark.parametrize("expr, alias, name", [
+    ("sex", None, "sex"),
+    ("t.sex", None, "sex"),
+    ("COUNT(*)", None, "count"),
+    ("COUNT(*)", "N", "n"),
+    ("COUNT(*)", '"Tested Clients"', "Tested Clients"),
+    ("MAX(age) - MIN(age)", None, "?column?"),
+    ("(MAX(age))", None, "max"),
+    ("COUNT(*)::numeric", None, "count"),
+    ("1::numeric", None, "numeric"),
+    ("CAST(SUM(age) AS numeric)", None, "sum"),
+    ("CAST(1 AS int)", None, "int4"),
+    ("CAST(MAX(age) - MIN(age) AS bigint)", None, "int8"),
+    ("MAX(age) - MIN(age)::int", None, "?column?"),
+    ("CAST(MAX(age) AS int) - CAST(MIN(age) AS int)", None, "?column?"),
+    ("__literal0__::char", None, "bpchar"),
+    ("now()::date", None, "now"),
+    ("-MAX(age)", None, "?column?"),
+    ("CASE WHEN sex = __literal0__ THEN 1 ELSE 0 END", None, "case"),
+    ("CASE WHEN sex = __literal0__ THEN 1 ELSE 0 END::text", None, "text"),
+    ("CASE WHEN sex = __literal0__ THEN 1 ELSE 0 END + 1", None, "?column?"),
+    ("__literal0__", None, "?column?"),
+    ("42", None, "?column?"),
+])
+def test_output_name(expr, alias, name):
+    assert _output_name(expr, alias) == name
+
+
+@pytest.mark.parametrize("sql, names", [
+    ("SELECT sex, COUNT(*), string_agg(sex, ',') AS Sexes FROM t GROUP BY sex;", ("sex", "count", "sexes")),
+    ("SELECT DISTINCT stateofresidence FROM t", ("stateofresidence",)),
+    ("SELECT sex, n FROM (SELECT sex, COUNT(*) AS n FROM t GROUP BY sex) s", ("sex", "n")),
+    ("SELECT * FROM t", None),
+    ("SELECT (SELECT MAX(age) FROM t)", None),
+    ("SELECT a FROM t UNION SELECT b FROM u", None),
+    ("WITH x AS (SELECT 1) SELECT * FROM x", None),
+])
+def test_output_names(sql, names):
+    assert output_names(sql) == names
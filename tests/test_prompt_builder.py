@@ -0,0 +1,37 @@
+from benchmarks.stubs import stub_embed_model
+from prompt_builder import INSTRUCTIONS, PromptBuilder
+from query import load_data_dictionary
+
+
+TABLE = "expanded_hts_weekly_2024w32"
+SCHEMA = "Table 'expanded_hts_weekly_2024w32' has columns: sex (VARCHAR), age (INTEGER)."
+
+
+def builder(token_budget):
+    return PromptBuilder(load_data_dictionary(), embed_model=stub_embed_model(), top_k=8, token_budget=token_budget)
+
+
+def test_instructions_keep_the_rules_that_shape_the_sql():
+    assert "Default to averages" in INSTRUCTIONS
+    assert "test1_result OR confirmatory_result" in INSTRUCTIONS
+
+
+def test_columns_are_trimmed_to_the_budget():
+    roomy = builder(5000).build("positivity rate by state", TABLE, SCHEMA, "postgresql")
+    assert len(roomy.columns) == 8
+    assert roomy.text.startswith(INSTRUCTIONS.format(tablename=TABLE))
+
+    static = builder(5000).static_for(TABLE, SCHEMA, "postgresql")[1]
+    tight = builder(static + 60)
+    prompt = tight.build("positivity rate by state", TABLE, SCHEMA, "postgresql")
+    assert 0 < len(prompt.columns) < 8
+    assert prompt.prompt_tokens <= tight.token_budget
+    assert tight.stats()["over_budget"] == 0
+
+
+def test_static_part_over_budget_is_sent_whole_and_counted():
+    small = builder(50)
+    prompt = small.build("positivity rate by state", TABLE, SCHEMA, "postgresql")
+    assert prompt.columns == []
+    assert INSTRUCTIONS.format(tablename=TABLE) in prompt.text
+    assert small.stats()["over_budget"] == 1
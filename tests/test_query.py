@@ -0,0 +1,17 @@
+from llama_index.core import Settings
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+from query import reset_http_clients
+
+
+def test_reset_http_clients_drops_inherited_sockets():
+    previous = Settings._embed_model
+    Settings.embed_model = OpenAIEmbedding(api_key="stub")
+    try:
+        client = Settings.embed_model._get_client()
+        reset_http_clients()
+        assert Settings.embed_model._client is None
+        assert Settings.embed_model._get_client() is not client
+    finally:
+        Settings._embed_model = previous
+
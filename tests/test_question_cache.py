@@ -0,0 +1,71 @@
+import time
+
+from question_cache import QuestionCache, normalize_question
+
+
+EMBEDDINGS = {
+    "how many tested positive in lagos": [1.0, 0.0, 0.0],
+    "number of positives in lagos": [0.99, 0.1, 0.0],
+    "average age of clients": [0.0, 1.0, 0.0],
+    "total tests by sex": [0.0, 0.0, 1.0],
+}
+
+
+def cache(**kwargs):
+    options = {"embed_fn": EMBEDDINGS.__getitem__, "similarity_threshold": 0.95, "max_entries": 10,
+               "ttl_seconds": 0, "persist_path": ""}
+    return QuestionCache(**{**options, **kwargs})
+
+
+def test_normalize_question():
+    assert normalize_question("  How many  tested POSITIVE in Lagos? ") == "how many tested positive in lagos"
+
+
+def test_exact_and_semantic_hits():
+    questions = cache()
+    questions.put("How many tested positive in Lagos?", "t1", "SELECT 1")
+    assert questions.get("how many tested positive in lagos", "t1").kind == "exact"
+
+    lookup = questions.get("Number of positives in Lagos", "t1")
+    assert (lookup.kind, lookup.sql) == ("semantic", "SELECT 1")
+    assert lookup.similarity > 0.95
+    assert not questions.get("average age of clients", "t1").hit
+
+
+def test_partitioned_by_table():
+    questions = cache()
+    questions.put("how many tested positive in lagos", "t1", "SELECT 1")
+    assert not questions.get("how many tested positive in lagos", "t2").hit
+    assert not questions.get("number of positives in lagos", "t2").hit
+
+
+def test_semantic_matches_follow_puts_and_evictions():
+    questions = cache(max_entries=2)
+    questions.put("average age of clients", "t1", "SELECT age")
+    assert not questions.get("number of positives in lagos", "t1").hit
+    questions.put("how many tested positive in lagos", "t1", "SELECT 1")
+    assert questions.get("number of positives in lagos", "t1").sql == "SELECT 1"
+
+    # Evicts the least recently used, which is the Lagos question after the average age lookup
+    questions.get("average age of clients", "t1")
+    questions.put("total tests by sex", "t1", "SELECT sex")
+    assert not questions.get("number of positives in lagos", "t1").hit
+    assert questions.stats()["evictions"] == 1
+
+
+def test_expired_entries_are_not_matched():
+    questions = cache(ttl_seconds=60)
+    questions.put("how many tested positive in lagos", "t1", "SELECT 1")
+    questions._entries[("t1", "how many tested positive in lagos")].created_at = time.time() - 120
+    questions._changed("t1")
+    assert not questions.get("number of positives in lagos", "t1").hit
+    assert not questions.get("how many tested positive in lagos", "t1").hit
+    assert questions.stats()["expirations"] == 1
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "question_cache.json")
+    questions = cache(persist_path=path)
+    questions.put("how many tested positive in lagos", "t1", "SELECT 1")
+    questions.save()
+    assert cache(persist_path=path).get("number of positives in lagos", "t1").sql == "SELECT 1"
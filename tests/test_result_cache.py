@@ -0,0 +1,35 @@
+from result_cache import ResultCache, estimate_size, normalize_sql
+
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT  *\n FROM t ;") == "SELECT * FROM t"
+    assert normalize_sql("SELECT 'A  b'") == "SELECT 'A b'"
+
+
+def test_keyed_by_sql_and_table():
+    cache = ResultCache(max_bytes=10 ** 6, max_entry_bytes=10 ** 6)
+    cache.put("SELECT 1;", "t1", ["n"], [(1,)])
+    assert cache.get("SELECT  1", "t1") == (["n"], [(1,)])
+    assert cache.get("SELECT 1", "t2") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_evicts_least_recently_used_by_size():
+    rows = [(i, "x" * 50) for i in range(10)]
+    size = estimate_size(["n", "s"], rows)
+    cache = ResultCache(max_bytes=size * 2, max_entry_bytes=size)
+    cache.put("SELECT a", "t1", ["n", "s"], rows)
+    cache.put("SELECT b", "t1", ["n", "s"], rows)
+    cache.get("SELECT a", "t1")
+    cache.put("SELECT c", "t1", ["n", "s"], rows)
+    assert cache.get("SELECT b", "t1") is None
+    assert cache.get("SELECT a", "t1") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == size * 2
+
+
+def test_skips_results_over_the_entry_limit():
+    cache = ResultCache(max_bytes=10 ** 6, max_entry_bytes=10)
+    cache.put("SELECT 1", "t1", ["n"], [(1,)])
+    assert cache.get("SELECT 1", "t1") is None
+    assert cache.stats()["skipped_too_large"] == 1
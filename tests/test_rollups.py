@@ -0,0 +1,59 @@
+import pytest
+
+from benchmarks.fixture import dictionary_columns
+from benchmarks.verify_rollups import QUERIES, RAW_ONLY
+from rollups import MEASURE_COLUMNS, ROLLUPS, ROWS_COLUMN, Rollup, hide_literals, restore_literals, rewrite_for_rollup
+
+
+TABLE = "expanded_hts_weekly_2024w32"
+SOURCE_COLUMNS = set(dictionary_columns())
+#Sizes as on the fixture: by_state is the smallest
+ROLLUP_TABLES = [Rollup(name=f"{TABLE}_{spec.name}", source=TABLE, rows=rows,
+                        columns=frozenset(spec.dimensions + MEASURE_COLUMNS))
+                 for spec, rows in zip(ROLLUPS, (600, 8000, 3000))]
+
+
+def rewrite(sql):
+    return rewrite_for_rollup(sql.format(table=TABLE), TABLE, SOURCE_COLUMNS, ROLLUP_TABLES)
+
+
+@pytest.mark.parametrize("sql", QUERIES)
+def test_aggregations_are_routed(sql):
+    routed = rewrite(sql)
+    assert routed is not None
+    assert TABLE + " " not in routed[0] + " "
+
+
+@pytest.mark.parametrize("sql", RAW_ONLY)
+def test_other_shapes_stay_on_the_raw_table(sql):
+    assert rewrite(sql) is None
+
+
+def test_smallest_rollup_with_every_column_is_used():
+    assert rewrite("SELECT sex, COUNT(*) FROM {table} GROUP BY sex")[1].name == TABLE + "_by_state"
+    assert rewrite("SELECT lga, COUNT(*) FROM {table} GROUP BY lga")[1].name == TABLE + "_by_facility"
+    assert rewrite("SELECT clientcode, COUNT(*) FROM {table} GROUP BY clientcode") is None
+
+
+def test_aggregates_are_weighted_by_group_size():
+    sql, _ = rewrite("SELECT sex, COUNT(*) AS n, COUNT(finalhivtestresult) AS tested, "
+                     "SUM(CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) AS positives "
+                     "FROM {table} WHERE stateofresidence = 'Lagos' GROUP BY sex")
+    assert f"COALESCE(SUM({ROWS_COLUMN}), 0) AS n" in sql
+    assert f"THEN {ROWS_COLUMN} ELSE 0 END), 0) AS tested" in sql
+    assert f"SUM((CASE WHEN finalhivtestresult = 'Positive' THEN 1 ELSE 0 END) * {ROWS_COLUMN}) AS positives" in sql
+    assert "WHERE stateofresidence = 'Lagos'" in sql
+
+
+def test_unaliased_counts_keep_their_column_name():
+    sql, _ = rewrite("SELECT sex, COUNT(*), COUNT(finalhivtestresult) FROM {table} GROUP BY sex ORDER BY 2 DESC")
+    assert sql.count(" AS count") == 2
+    sql, _ = rewrite("SELECT sex, COUNT(*) * 100.0 / 7 AS pct FROM {table} GROUP BY sex")
+    assert " AS count" not in sql
+
+
+def test_literals_are_not_parsed_as_sql():
+    assert rewrite("SELECT COUNT(*) FROM {table} WHERE sex = 'select * from x join y'") is not None
+    work, literals = hide_literals("SELECT 'a''b', 'c' FROM t")
+    assert work == "SELECT __literal0__, __literal1__ FROM t"
+    assert restore_literals(work, literals) == "SELECT 'a''b', 'c' FROM t"
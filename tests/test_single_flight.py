@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from async_query import SingleFlight
+
+
+def test_concurrent_calls_compute_once():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "rows"
+
+    async def scenario():
+        flights = SingleFlight("test", wait_timeout=1.0)
+        results = await asyncio.gather(*(flights.run("key", compute) for _ in range(5)))
+        return flights, results
+
+    flights, results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert sorted(results) == [("rows", False)] + [("rows", True)] * 4
+    assert flights.stats()["in_flight"] == 0
+    assert (flights.leaders, flights.coalesced) == (1, 4)
+
+
+def test_errors_are_shared():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("bad SQL")
+
+    async def scenario():
+        flights = SingleFlight("test", wait_timeout=1.0)
+        return await asyncio.gather(*(flights.run("key", compute) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_different_keys_and_disabled_compute_separately():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def scenario(flights, keys):
+        return await asyncio.gather(*(flights.run(key, compute) for key in keys))
+
+    asyncio.run(scenario(SingleFlight("test", wait_timeout=1.0), ["a", "b"]))
+    assert len(calls) == 2
+    results = asyncio.run(scenario(SingleFlight("test", wait_timeout=1.0, enabled=False), ["a", "a"]))
+    assert len(calls) == 4
+    assert all(not coalesced for _, coalesced in results)
+
+
+def test_follower_that_times_out_computes_itself():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.2 if len(calls) == 1 else 0)
+        return len(calls)
+
+    async def scenario():
+        flights = SingleFlight("test", wait_timeout=0.05)
+        leader = asyncio.create_task(flights.run("key", compute))
+        await asyncio.sleep(0)
+        follower = await flights.run("key", compute)
+        return flights, await leader, follower
+
+    flights, leader, follower = asyncio.run(scenario())
+    assert follower == (2, False)
+    assert leader[1] is False
+    assert flights.timeouts == 1
+
+
+def test_leader_cancelled_does_not_cancel_followers():
+    async def compute():
+        await asyncio.sleep(0.05)
+        return "rows"
+
+    async def scenario():
+        flights = SingleFlight("test", wait_timeout=1.0)
+        leader = asyncio.create_task(flights.run("key", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights.run("key", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(scenario()) == ("rows", True)
@@ -0,0 +1,60 @@
+import pytest
+
+from sql_guard import QueryRejected, check_read_only, inject_limit, trailing_limit
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT count(*) AS do FROM t",
+    "SELECT set, lock, comment FROM t",
+    "SELECT count(*) AS into FROM t",
+    "SELECT t.into FROM t",
+    "SELECT 'delete from t' AS note FROM t",
+    'SELECT "update" FROM t',
+    "SELECT (age + 1) AS update FROM t",
+    "WITH a AS (SELECT 1) SELECT * FROM a",
+    "(SELECT 1) UNION (SELECT 2)",
+    "VALUES (1)",
+])
+def test_read_only_queries_pass(sql):
+    assert check_read_only(sql) == sql
+
+
+@pytest.mark.parametrize("sql, message", [
+    ("WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d", "DELETE"),
+    ("WITH u AS (UPDATE t SET a = 1 RETURNING *) SELECT 1", "UPDATE"),
+    ("WITH u AS (\n  update only public.t AS x set a = 1 RETURNING *) SELECT 1", "UPDATE"),
+    ("WITH i AS (INSERT INTO t VALUES (1) RETURNING *) SELECT 1", "INSERT"),
+    ("SELECT * INTO copy_of_t FROM t", "INTO"),
+    ("SELECT pg_sleep(10)", "PG_SLEEP"),
+    ("SELECT * FROM t FOR NO KEY UPDATE", "FOR NO KEY UPDATE"),
+    ("DROP TABLE t", "Only SELECT"),
+    ("SELECT 1; DROP TABLE t", "single SQL statement"),
+    ("-- nothing", "did not produce"),
+])
+def test_writes_are_rejected(sql, message):
+    with pytest.raises(QueryRejected) as rejected:
+        check_read_only(sql)
+    assert message in str(rejected.value)
+
+
+def test_comments_and_trailing_semicolon_are_dropped():
+    assert check_read_only("SELECT 1 -- one\n;") == "SELECT 1"
+    assert check_read_only("/* a */ SELECT ';' FROM t;") == "SELECT ';' FROM t"
+
+
+def test_trailing_limit():
+    assert trailing_limit("SELECT * FROM t") is None
+    assert trailing_limit("SELECT * FROM t LIMIT 5") == 5
+    assert trailing_limit("SELECT * FROM t LIMIT ALL") == 0
+    assert trailing_limit("SELECT * FROM t OFFSET 2 LIMIT 7") == 7
+    assert trailing_limit("SELECT * FROM t FETCH FIRST 3 ROWS ONLY") == 3
+    assert trailing_limit("SELECT * FROM (SELECT * FROM t LIMIT 5) s") is None
+    assert trailing_limit("SELECT 'LIMIT 5' FROM t") is None
+
+
+def test_inject_limit():
+    assert inject_limit("SELECT * FROM t", 100) == "SELECT * FROM t\nLIMIT 100"
+    assert inject_limit("SELECT * FROM t LIMIT 10", 100) == "SELECT * FROM t LIMIT 10"
+    wrapped = inject_limit("SELECT * FROM t LIMIT 500", 100)
+    assert wrapped.startswith("SELECT * FROM (") and wrapped.endswith("LIMIT 100")
+    assert inject_limit("SELECT * FROM t LIMIT ALL", 100).endswith("LIMIT 100")
@@ -0,0 +1,72 @@
+import pytest
+
+from query import load_data_dictionary
+from templates import TemplateMatcher
+
+
+TABLE = "expanded_hts_weekly_2024w32"
+
+
+@pytest.fixture
+def matcher():
+    return TemplateMatcher(load_data_dictionary(), enabled=True)
+
+
+def test_positivity_rate_by_state(matcher):
+    found = matcher.match("What is the HIV positivity rate by state, lowest first?", TABLE)
+    assert found.template == "positivity_rate_by_dimension"
+    assert found.slots == {"dim": "stateofresidence", "order": "ASC"}
+    assert found.sql.startswith("SELECT stateofresidence, COUNT(*) AS TotalTests")
+    assert f"FROM {TABLE} GROUP BY stateofresidence ORDER BY PositivityRate ASC;" in found.sql
+
+
+def test_top_n_and_proportion(matcher):
+    found = matcher.match("Top three states by number of positives", TABLE)
+    assert found.template == "top_n_by_positives"
+    assert found.sql.endswith("ORDER BY TotalPositives DESC LIMIT 3;")
+    found = matcher.match("Proportion offered PrEP who accepted PrEP", TABLE)
+    assert found.template == "proportion_by_dimension"
+    assert "GROUP BY" not in found.sql
+
+
+@pytest.mark.parametrize("question", [
+    "Positivity rate by favourite colour",
+    "Positivity rate by client code",
+    "Which states had more positives last year than this year?",
+])
+def test_unresolved_questions_go_to_the_llm(matcher, question):
+    assert matcher.match(question, TABLE) is None
+
+
+def test_missing_columns_are_not_matched(matcher):
+    question = "Positivity rate by sex"
+    assert matcher.match(question, TABLE, columns={"sex"}) is None
+    assert matcher.match(question, TABLE, columns={"sex", "finalhivtestresult"}) is not None
+
+
+def test_counters(matcher):
+    matcher.match("Positivity rate by sex", TABLE, count=False)
+    assert matcher.stats()["matched"] == 0
+    matcher.match("Positivity rate by sex", TABLE)
+    matcher.match("Positivity rate by favourite colour", TABLE)
+    stats = matcher.stats()
+    assert (stats["matched"], stats["unmatched"], stats["hit_rate"]) == (1, 1, 0.5)
+    assert stats["by_template"] == {"positivity_rate_by_dimension": 1}
+
+
+def test_disabled():
+    assert TemplateMatcher(load_data_dictionary(), enabled=False).match("Positivity rate by sex", TABLE) is None
+
+
+def test_dictionary_columns_win_over_extra_synonyms(matcher):
+    assert matcher.column_for("facility") == "facility"
+    assert matcher.column_for("facility code") == "datimcode"
+    # Deliberate overrides: the state and LGA of residence, the facility's are named as such
+    assert matcher.column_for("state") == "stateofresidence"
+    assert matcher.column_for("facility state") == "state"
+    assert matcher.column_for("lga") == "lgaofresidence"
+
+
+def test_top_n_needs_an_explicit_n(matcher):
+    assert matcher.match("States with the most positives", TABLE) is None
+    assert matcher.match("Top 5 states by positives", TABLE).slots["n"] == 5
@@ -0,0 +1,108 @@
+#Rollup routing, multi-period merging and the local replica against a local Postgres; skipped without one (see conftest.warehouse)
+from decimal import Decimal
+
+import pytest
+
+from benchmarks.verify_periods import ALL_PERIODS_VIEW, SPLIT_QUERIES, create_view
+from benchmarks.verify_rollups import QUERIES, fetch, same_rows
+from multi_period import TABLE_PLACEHOLDER, merge_statements, split_for_periods
+from period import resolve_available_periods, table_for_period
+from replica import LocalReplica, replica_available
+from rollups import RollupManager
+
+
+#Unaliased output columns, which the merge has to name the way Postgres does
+NAMED_QUERIES = [
+    "SELECT sex, MAX(age) - MIN(age), COUNT(*)::numeric, (MAX(age)) FROM {table} GROUP BY sex ORDER BY sex",
+    "SELECT sex, CASE WHEN COUNT(*) > 0 THEN 1 ELSE 0 END, CAST(SUM(age) AS numeric) FROM {table} GROUP BY sex "
+    "ORDER BY sex",
+    "SELECT sex, (COUNT(*) * 100)::int, CAST(MAX(age) - MIN(age) AS bigint) FROM {table} GROUP BY sex ORDER BY sex",
+]
+
+
+@pytest.fixture(scope="module")
+def periods(warehouse):
+    codes = resolve_available_periods(warehouse)
+    create_view(warehouse, codes)
+    return codes
+
+
+@pytest.fixture(scope="module")
+def rollups(warehouse, periods):
+    manager = RollupManager(warehouse, max_ratio=1.0, enabled=True)
+    manager.prepare(table_for_period(periods[-1]), wait=True)
+    return manager
+
+
+@pytest.mark.parametrize("template", QUERIES)
+def test_routed_query_matches_raw_table(warehouse, periods, rollups, template):
+    table = table_for_period(periods[-1])
+    sql = template.format(table=table)
+    routed = rollups.route(sql, table)
+    assert routed is not None
+    with warehouse.connect() as conn:
+        raw_keys, raw = fetch(conn, sql)
+        routed_keys, rolled = fetch(conn, routed.sql)
+    assert routed_keys == raw_keys
+    assert same_rows(raw, rolled, sql, raw_keys)
+
+
+@pytest.mark.parametrize("template", SPLIT_QUERIES + NAMED_QUERIES)
+def test_merged_periods_match_union_of_tables(warehouse, periods, template):
+    split = split_for_periods(template)
+    assert split is not None
+    with warehouse.connect() as conn:
+        partials = [fetch(conn, split.partial.replace(TABLE_PLACEHOLDER, table_for_period(code))) for code in periods]
+        by_period_sql, combined_sql, params = merge_statements(split, periods, partials)
+        combined_keys, combined = fetch(conn, combined_sql, params)
+        truth_keys, truth = fetch(conn, template.replace(TABLE_PLACEHOLDER, ALL_PERIODS_VIEW))
+        _, by_period = fetch(conn, by_period_sql, params)
+        for code in periods:
+            _, expected = fetch(conn, template.replace(TABLE_PLACEHOLDER, table_for_period(code)))
+            assert same_rows(expected, [row[1:] for row in by_period if row[0] == code], template, truth_keys)
+    assert combined_keys == truth_keys
+    assert same_rows(truth, combined, template, truth_keys)
+
+
+#Unaliased expressions DuckDB would name after itself (count_star(), the expression text)
+REPLICA_QUERIES = QUERIES + NAMED_QUERIES + [
+    "SELECT sex, COUNT(*), string_agg(DISTINCT stateofresidence, ',' ORDER BY stateofresidence) FROM {table} "
+    "GROUP BY sex ORDER BY sex",
+    "SELECT stateofresidence AS State, COUNT(*) AS TotalTests FROM {table} GROUP BY stateofresidence ORDER BY 2 DESC",
+    "SELECT clientcode, age FROM {table} ORDER BY clientcode LIMIT 5",
+    "SELECT * FROM {table} ORDER BY clientcode LIMIT 5",
+]
+
+
+def rounded(rows):
+    #DuckDB computes numeric division in double precision where Postgres returns numeric
+    return [tuple(round(float(value), 9) if isinstance(value, (Decimal, float)) else value for value in row)
+            for row in rows]
+
+
+@pytest.fixture(scope="module")
+def replica(warehouse, periods, tmp_path_factory):
+    if not replica_available():
+        pytest.skip("duckdb is not installed")
+    local = LocalReplica(warehouse, directory=str(tmp_path_factory.mktemp("replica")), threads=1)
+    local.prepare(table_for_period(periods[-1]), wait=True)
+    yield local
+    local.close()
+
+
+@pytest.mark.parametrize("template", REPLICA_QUERIES)
+def test_replica_matches_postgres(warehouse, periods, replica, template):
+    sql = template.format(table=table_for_period(periods[-1]))
+    answered = replica.run_sql(sql)
+    assert answered is not None
+    local_keys, local, truncated = answered
+    with warehouse.connect() as conn:
+        keys, rows = fetch(conn, sql)
+    assert local_keys == keys
+    assert same_rows(rounded(rows), rounded(local), sql, keys)
+
+
+def test_replica_leaves_unnamed_columns_to_postgres(periods, replica):
+    table = table_for_period(periods[-1])
+    assert replica.run_sql(f"SELECT (SELECT MAX(age) FROM {table}), COUNT(*) FROM {table}") is None
+    assert replica.run_sql(f"WITH t AS (SELECT COUNT(*) FROM {table}) SELECT * FROM t") is None